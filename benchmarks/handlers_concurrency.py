@@ -0,0 +1,103 @@
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, Master, TimeSlot, TimeSlotStatus
+from utils.availability import get_free_slots
+
+# Сравнение синхронных сессий внутри хендлеров (блокируют цикл событий) с асинхронными:
+# CONCURRENT «пользователей» одновременно читают свободные слоты на день,
+# параллельно тикер раз в миллисекунду замеряет, на сколько цикл событий был занят.
+MASTERS = 15
+DAYS = 30
+CONCURRENT = 50
+START = datetime(2030, 1, 1)
+
+
+def build_database(path):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with sessionmaker(engine)() as session:
+        for master_id in range(1, MASTERS + 1):
+            session.add(Master(id=master_id, name=f"Мастер {master_id}", login=f"master{master_id}",
+                               password="-", telegram_id=str(master_id)))
+            for day in range(DAYS):
+                day_start = START + timedelta(days=day, hours=9)
+                session.add_all(
+                    TimeSlot(master_id=master_id, start_time=day_start + timedelta(minutes=15 * quarter),
+                             status=TimeSlotStatus.free)
+                    for quarter in range(40)
+                )
+        session.commit()
+    engine.dispose()
+
+
+def day_bounds(user):
+    start = START + timedelta(days=user % DAYS)
+    return start, start + timedelta(days=1)
+
+
+async def measure(handler, users):
+    """Время обработки всех пользователей и самая долгая задержка цикла событий."""
+    max_lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal max_lag
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_lag = max(max_lag, time.perf_counter() - before - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(user) for user in users))
+    elapsed = time.perf_counter() - started
+    running = False
+    await tick
+    return elapsed, max_lag
+
+
+async def main(path):
+    sync_engine = create_engine(f"sqlite:///{path}")
+    SyncSession = sessionmaker(sync_engine)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+    master_ids = list(range(1, MASTERS + 1))
+
+    async def sync_handler(user):
+        with SyncSession() as session:
+            return get_free_slots(session, master_ids, *day_bounds(user))
+
+    async def async_handler(user):
+        async with AsyncSession() as session:
+            return await session.run_sync(get_free_slots, master_ids, *day_bounds(user))
+
+    users = range(CONCURRENT)
+    # Прогрев пулов соединений
+    await sync_handler(0)
+    await async_handler(0)
+
+    sync_elapsed, sync_lag = await measure(sync_handler, users)
+    async_elapsed, async_lag = await measure(async_handler, users)
+
+    print(f"{CONCURRENT} одновременных запросов, {MASTERS} мастеров, {DAYS} дней расписания")
+    print(f"синхронные сессии:  {sync_elapsed * 1e3:8.1f} мс всего, цикл событий стоял до {sync_lag * 1e3:6.1f} мс")
+    print(f"асинхронные сессии: {async_elapsed * 1e3:8.1f} мс всего, цикл событий стоял до {async_lag * 1e3:6.1f} мс")
+
+    sync_engine.dispose()
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        build_database(path)
+        asyncio.run(main(path))
@@ -1,18 +1,27 @@
 import asyncio
 import logging
 import os
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
 from handlers import (
     start_handler,
-    services_handler,
-    master_handler,
-    calendar_handler,
+    # Роутеров у этих модулей нет: импорт нужен только ради регистрации их маршрутов в callback_routes
+    services_handler,  # noqa: F401
+    calendar_handler,  # noqa: F401
     booking_handler,
     general_handler,
 )
 from dotenv import load_dotenv
+from utils.rate_limiter import SendScheduler
+from utils.fsm_storage import SQLiteStorage, BoundedMemoryStorage, FLUSH_INTERVAL
+from utils.reminders import reminder_scheduler, reminder_worker
+from utils.completion import completion_worker
+from utils.catalog import service_catalog, master_lists
+from utils import webhook
+from utils.user_queue import PerUserSerializer
+from utils.callbacks import callback_routes
+from database import AsyncSessionLocal
 
 # Загружаем переменные из .env
 load_dotenv()
@@ -27,22 +36,97 @@ if not TOKEN:
 
 # Создание объекта бота с использованием DefaultBotProperties
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-storage = MemoryStorage()
+# Все исходящие сообщения проходят через ограничитель частоты Telegram
+send_scheduler = SendScheduler()
+bot.session.middleware(send_scheduler)
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Состояния записи хранятся в базе (FSM_STORAGE=sqlite), чтобы переживать перезапуск
+# и быть общими для нескольких процессов бота; FSM_STORAGE=memory — только в памяти процесса,
+# с ограничением на число пользователей и временем жизни без обращений
+if os.getenv("FSM_STORAGE", "sqlite") == "memory":
+    storage = BoundedMemoryStorage(max_entries=int(os.getenv("FSM_MAX_ENTRIES", "10000")))
+else:
+    # Отложенная запись видна только своему процессу. В режиме вебхука за балансировщиком
+    # несколько экземпляров читают состояния друг друга из базы, поэтому там запись сквозная
+    flush_interval = 0 if BOT_MODE == "webhook" else float(os.getenv("FSM_FLUSH_INTERVAL", str(FLUSH_INTERVAL)))
+    storage = SQLiteStorage(flush_interval=flush_interval)
 dp = Dispatcher(storage=storage)
+# Обновления разных пользователей обрабатываются одновременно, одного пользователя — по очереди
+user_serializer = PerUserSerializer()
+dp.update.outer_middleware(user_serializer)
 
 # Регистрация обработчиков
+# Все нажатия на кнопки маршрутизируются по callback_data одним обработчиком;
+# модули хендлеров регистрируют в нём свои маршруты при импорте
+dp.include_router(callback_routes.router)
 dp.include_router(start_handler.router)
-dp.include_router(services_handler.router)
-dp.include_router(master_handler.router)
-dp.include_router(calendar_handler.router)
 dp.include_router(booking_handler.router)
 dp.include_router(general_handler.router)
 
 
+# Публичный адрес, на который Telegram шлёт обновления (например, адрес балансировщика)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(webhook.WEBHOOK_WORKERS)))
+# Напоминания и закрытие прошедших записей должны работать ровно в одном процессе;
+# на дополнительных экземплярах за балансировщиком их выключают BACKGROUND_JOBS=0
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") == "1"
+# Если записи принимают несколько экземпляров, очередь напоминаний перечитывается из базы
+REMINDER_RELOAD_INTERVAL = 60
+
+
+def start_workers():
+    if not BACKGROUND_JOBS:
+        return []
+    return [
+        asyncio.create_task(reminder_worker(
+            bot, reload_interval=REMINDER_RELOAD_INTERVAL if BOT_MODE == "webhook" else None
+        )),
+        # Прошедшие записи становятся completed, и клиент может оставить отзыв
+        asyncio.create_task(completion_worker()),
+    ]
+
+
+async def run_webhook():
+    """Принимает обновления aiohttp-сервером; можно запустить несколько экземпляров за балансировщиком."""
+    if WEBHOOK_URL:
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    app = webhook.build_webhook_app(dp, bot, WEBHOOK_PATH, workers=WEBHOOK_WORKERS, secret_token=WEBHOOK_SECRET)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # reuse_port позволяет запустить несколько процессов на одном порту
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=True).start()
+    logging.info("Вебхук слушает %s:%s%s, обработчиков: %s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_WORKERS)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await dp.storage.close()
+
+
 # Основная функция
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if BOT_MODE != "webhook":
+        await bot.delete_webhook(drop_pending_updates=True)
+    # Напоминания о предстоящих записях: после перезапуска очередь строится заново из базы
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(reminder_scheduler.load)
+    # Каталог услуг и мастера загружаются заранее, чтобы первый клиент не ждал запросов к базе
+    await service_catalog.current()
+    await master_lists.current()
+    workers = start_workers()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot, handle_as_tasks=True)
+    finally:
+        for worker in workers:
+            worker.cancel()
 
 
 if __name__ == "__main__":
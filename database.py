@@ -1,7 +1,9 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Float, Table, event
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, ForeignKey, Enum, Float, Table, Index, event
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 import enum
+from datetime import datetime
 import csv
 import os
 
@@ -11,11 +13,18 @@ engine = create_engine('sqlite:///database.db', echo=False)
 
 SessionLocal = sessionmaker(bind=engine)
 
+# Асинхронные сессии для хендлеров бота: запросы к SQLite не блокируют event loop aiogram
+async_engine = create_async_engine('sqlite+aiosqlite:///database.db', echo=False)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
 master_service_association = Table(
     'master_service_association',
     Base.metadata,
     Column('master_id', Integer, ForeignKey('masters.id')),
-    Column('service_id', Integer, ForeignKey('services.id'))
+    Column('service_id', Integer, ForeignKey('services.id')),
+    # Мастера услуги для экрана календаря
+    Index('ix_master_service_service_master', 'service_id', 'master_id'),
 )
 
 
@@ -65,6 +74,12 @@ class TimeSlotStatus(enum.Enum):
 
 class TimeSlot(Base):
     __tablename__ = 'timeslots'
+    __table_args__ = (
+        # Поиск свободных слотов мастера за период: покрывающий индекс, таблицу не читаем
+        Index('ix_timeslots_master_status_start', 'master_id', 'status', 'start_time'),
+        # Предстоящие записи всех мастеров по времени начала (напоминания)
+        Index('ix_timeslots_start', 'start_time'),
+    )
 
     id = Column(Integer, primary_key=True)
     master_id = Column(Integer, ForeignKey('masters.id'), nullable=False)
@@ -78,11 +93,142 @@ class TimeSlot(Base):
         return f"<TimeSlot(id={self.id}, master_id={self.master_id}, start_time={self.start_time}, status='{self.status.value}')>"
 
 
+# Интервальный режим хранения расписания (AVAILABILITY_MODE=intervals):
+# смены и занятость хранятся диапазонами [start_time, end_time), а свободные окна
+# вычисляются как смены минус занятые интервалы. В timeslots остаются только
+# "якорные" слоты записей, на которые ссылается Appointment.timeslot_id.
+class WorkShift(Base):
+    __tablename__ = 'work_shifts'
+    __table_args__ = (
+        Index('ix_work_shifts_master_start', 'master_id', 'start_time', 'end_time'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    master_id = Column(Integer, ForeignKey('masters.id'), nullable=False)
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime, nullable=False)
+
+    master = relationship("Master")
+
+    def __repr__(self):
+        return f"<WorkShift(id={self.id}, master_id={self.master_id}, start_time={self.start_time}, end_time={self.end_time})>"
+
+
+class BookedInterval(Base):
+    __tablename__ = 'booked_intervals'
+    __table_args__ = (
+        Index('ix_booked_intervals_master_start', 'master_id', 'start_time', 'end_time'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    master_id = Column(Integer, ForeignKey('masters.id'), nullable=False)
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime, nullable=False)
+
+    master = relationship("Master")
+
+    def __repr__(self):
+        return (
+            f"<BookedInterval(id={self.id}, master_id={self.master_id}, start_time={self.start_time}, "
+            f"end_time={self.end_time})>"
+        )
+
+
+# Журнал изменений расписания: по нему процессы бота сбрасывают закэшированную занятость мастеров.
+# Пустая дата означает, что изменилось всё расписание мастера или список его услуг.
+class AvailabilityChange(Base):
+    __tablename__ = 'availability_changes'
+
+    id = Column(Integer, primary_key=True)
+    master_id = Column(Integer, ForeignKey('masters.id'), nullable=False)
+    date = Column(Date, nullable=True)
+    # Для очистки журнала: старые изменения всеми процессами уже прочитаны
+    created_at = Column(DateTime, nullable=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<AvailabilityChange(id={self.id}, master_id={self.master_id}, date={self.date})>"
+
+
+# Версии редко меняющихся данных (каталог услуг, мастера услуг). Сайт увеличивает версию при изменении,
+# а боты по ней понимают, что закэшированные в памяти данные пора перечитать.
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    # Время последнего изменения (UTC) — для Last-Modified в админке
+    updated_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<DataVersion(name='{self.name}', version={self.version})>"
+
+
+# Отметки фоновых задач: до какого момента данные уже обработаны
+class JobWatermark(Base):
+    __tablename__ = 'job_watermarks'
+
+    name = Column(String, primary_key=True)
+    value = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<JobWatermark(name='{self.name}', value={self.value})>"
+
+
+# Состояния FSM бота клиентов: переживают перезапуск и общие для нескольких процессов бота.
+# data — JSON словаря шагов записи, updated_at — для удаления брошенных сценариев.
+class FSMRecord(Base):
+    __tablename__ = 'fsm_states'
+    __table_args__ = (
+        Index('ix_fsm_states_updated', 'updated_at'),
+    )
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=False, default='{}')
+    updated_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<FSMRecord(key='{self.key}', state='{self.state}', updated_at={self.updated_at})>"
+
+
+class NotificationKind(enum.Enum):
+    booking = 'booking'
+    cancellation = 'cancellation'
+
+
+# Исходящие уведомления мастерам. Строка пишется в той же транзакции, что и запись или отмена,
+# а отправляет её фоновый обработчик бота мастеров; sent_at пуст, пока уведомление не доставлено.
+class NotificationOutbox(Base):
+    __tablename__ = 'notification_outbox'
+    __table_args__ = (
+        Index('ix_notification_outbox_pending', 'sent_at', 'next_attempt_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(Enum(NotificationKind), nullable=False)
+    master_id = Column(Integer, ForeignKey('masters.id'), nullable=False)
+    user_telegram_id = Column(String, nullable=False)
+    slot_time = Column(DateTime, nullable=False)
+    service_name = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    def __repr__(self):
+        return (
+            f"<NotificationOutbox(id={self.id}, kind='{self.kind.value}', master_id={self.master_id}, "
+            f"attempts={self.attempts}, sent_at={self.sent_at})>"
+        )
+
+
 class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
     telegram_id = Column(String, nullable=False, unique=True)
+    # Имя из профиля Telegram, запоминается ботом клиентов — бот мастеров берёт его для уведомлений
+    display_name = Column(String, nullable=True)
 
     appointments = relationship("Appointment", back_populates="user")
     reviews = relationship("Review", back_populates="user")
@@ -99,6 +245,11 @@ class AppointmentStatus(enum.Enum):
 
 class Appointment(Base):
     __tablename__ = 'appointments'
+    __table_args__ = (
+        # "Мои записи" и отзывы: записи пользователя по статусу
+        Index('ix_appointments_user_status', 'user_id', 'status'),
+        Index('ix_appointments_timeslot', 'timeslot_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -121,6 +272,9 @@ class Appointment(Base):
 
 class Review(Base):
     __tablename__ = 'reviews'
+    __table_args__ = (
+        Index('ix_reviews_master', 'master_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -297,4 +451,35 @@ def delete_master_rating(mapper, connection, target):
 event.listen(Review, 'after_insert', update_master_rating)
 event.listen(Review, 'after_delete', delete_master_rating)
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+
+def ensure_columns(bind):
+    """
+    create_all не добавляет новые столбцы в уже существующие таблицы,
+    поэтому на старых базах недостающие необязательные столбцы добавляем через ALTER TABLE.
+    """
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns and column.nullable:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def ensure_indexes(bind):
+    """
+    create_all не добавляет индексы в уже существующие таблицы,
+    поэтому на старых базах создаём недостающие индексы отдельно (CREATE INDEX IF NOT EXISTS).
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+
+
+Base.metadata.create_all(engine)
+ensure_columns(engine)
+ensure_indexes(engine)
@@ -1,19 +1,30 @@
-from aiogram import Router, F
+from aiogram import Router
+from sqlalchemy import select
 from sqlalchemy.orm import joinedload
 from states import BookingStates
-from master_bot import insertion_send_telegram_notification
 
 router = Router()
 
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from database import SessionLocal, TimeSlot, Master, master_service_association, TimeSlotStatus, AppointmentStatus, Review, Appointment, User
-from datetime import datetime, timedelta
+from database import AsyncSessionLocal, Master, AppointmentStatus, Review, Appointment, User
+from datetime import timedelta
 from aiogram.fsm.context import FSMContext
-from utils.calendar import find_available_slots
+from utils.calendar import get_day_slots_page, get_candidate_master_ids, get_nearest_slot
+from utils.any_master import book_any_master
+from utils.availability import book_appointment
+from utils.availability_cache import record_change
+from utils.notifications import enqueue_notification, client_display_name
+from utils.reminders import reminder_scheduler
+from utils.data_version import MASTERS, bump_data_version
+from utils.catalog import master_lists
+from utils.booking import get_master_names, slot_callback_data
+from utils.callbacks import (
+    callback_routes, DATE, SLOT, ANY_SLOT, NEAREST_SLOT, SLOTS_NEXT, SLOTS_PREV, CHANGE_WEEK, CONFIRM_BOOKING, ADD_TO_CALENDAR, LEAVE_REVIEW, REVIEW, RATE
+)
 import logging
 
-@router.callback_query(F.data.startswith("date_"))
-async def date_selected_handler(callback_query: CallbackQuery, state: FSMContext):
+@callback_routes.route(DATE)
+async def date_selected_handler(callback_query: CallbackQuery, state: FSMContext, payload=None):
     user_id = callback_query.from_user.id
     logging.info(f"Handling date selection for user_id {user_id}")
 
@@ -33,47 +44,69 @@ async def date_selected_handler(callback_query: CallbackQuery, state: FSMContext
         return
 
     # Извлечение данных из callback_data
-    data_parts = callback_query.data.split("_")
     try:
-        date_iso = data_parts[1]
-        week_offset = int(data_parts[2])
-        selected_date = datetime.fromisoformat(date_iso).date()
+        payload = payload or DATE.unpack(callback_query.data)
+        selected_date, week_offset = payload.day, payload.week_offset
         logging.info(f"Selected date: {selected_date}, week_offset: {week_offset}")
     except Exception as e:
         logging.error(f"Error parsing date data for user_id {user_id}: {e}")
         await callback_query.message.edit_text("Ошибка обработки даты.")
         return
 
-    # Данные из FSMContext
+    # Курсоры начала просмотренных страниц; первая страница начинается с начала дня
+    await state.update_data(slot_date=selected_date, week_offset=week_offset, slot_pages=[None])
+    await show_slot_page(callback_query, state, booking_data, selected_date, week_offset, [None])
+
+
+@callback_routes.route(SLOTS_NEXT)
+async def slots_next_handler(callback_query: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    if not data.get("slot_date") or not data.get("slot_next"):
+        await callback_query.answer()
+        return
+    pages = data["slot_pages"] + [data["slot_next"]]
+    await show_slot_page(callback_query, state, data, data["slot_date"], data.get("week_offset", 0), pages)
+
+
+@callback_routes.route(SLOTS_PREV)
+async def slots_prev_handler(callback_query: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    if not data.get("slot_date") or len(data.get("slot_pages", [])) < 2:
+        await callback_query.answer()
+        return
+    pages = data["slot_pages"][:-1]
+    await show_slot_page(callback_query, state, data, data["slot_date"], data.get("week_offset", 0), pages)
+
+
+def slot_button(slot, master_names):
+    if slot.master_id is None:
+        # Мастер не важен: время одно на всех мастеров, мастер назначается при записи
+        return InlineKeyboardButton(text=slot.start_time.strftime('%H:%M'),
+                                    callback_data=ANY_SLOT.pack(start_time=slot.start_time))
+    return InlineKeyboardButton(
+        text=f"{slot.start_time.strftime('%H:%M')} ({master_names[slot.master_id]})",
+        callback_data=slot_callback_data(slot)
+    )
+
+
+async def show_slot_page(callback_query, state, booking_data, selected_date, week_offset, pages):
+    """Показывает одну страницу времён на дату; курсор страницы — последний элемент pages."""
+    user_id = callback_query.from_user.id
     master_id = booking_data.get("master_id")
     service_id = booking_data.get("service_id")
     service_duration = booking_data.get("service_duration")
+    # В хранилище FSM курсор мог превратиться из кортежа в список
+    cursor = tuple(pages[-1]) if pages[-1] else None
 
-    start_datetime = datetime.combine(selected_date, datetime.min.time())
-    end_datetime = start_datetime + timedelta(days=1)
-
-    # Поиск доступных слотов
-    with SessionLocal() as session:
+    # Поиск доступных слотов: только для одной страницы
+    async with AsyncSessionLocal() as session:
         try:
-            if master_id is None:
-                masters = session.query(Master).join(master_service_association).filter(
-                    master_service_association.c.service_id == service_id
-                ).all()
-                master_ids = [master.id for master in masters]
-            else:
-                master_ids = [master_id]
-            available_slots = []
-            for master_id in master_ids:
-                print(master_id)
-                all_slots = session.query(TimeSlot).filter(
-                    TimeSlot.master_id == master_id,
-                    TimeSlot.start_time >= start_datetime,
-                    TimeSlot.start_time < end_datetime,
-                    TimeSlot.status == TimeSlotStatus.free
-                ).order_by(TimeSlot.start_time).all()
-
-            for slot in find_available_slots(all_slots, service_duration):
-                available_slots.append(slot)
+            available_slots, has_more = await session.run_sync(
+                get_day_slots_page, service_id, master_id, selected_date, service_duration, cursor
+            )
+            master_names = await session.run_sync(
+                get_master_names, {slot.master_id for slot in available_slots if slot.master_id is not None}
+            )
 
             logging.info(f"Found {len(available_slots)} available slots for user_id {user_id}")
         except Exception as e:
@@ -81,46 +114,57 @@ async def date_selected_handler(callback_query: CallbackQuery, state: FSMContext
             await callback_query.message.edit_text("Ошибка при загрузке доступных слотов.")
             return
 
-    if not available_slots:
+    if not available_slots and cursor is None:
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
-                [InlineKeyboardButton(text="Назад", callback_data=f"change_week_{week_offset}")],
+                [InlineKeyboardButton(text="Назад", callback_data=CHANGE_WEEK.pack(week_offset=week_offset))],
                 [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
             ]
         )
         await callback_query.message.edit_text("Нет доступных слотов на эту дату.", reply_markup=keyboard)
         return
 
+    last = available_slots[-1] if available_slots else None
+    await state.update_data(
+        slot_pages=pages,
+        slot_next=(last.start_time, last.master_id) if has_more else None
+    )
+
+    navigation_buttons = []
+    if len(pages) > 1:
+        navigation_buttons.append(InlineKeyboardButton(text="⬅️ Раньше", callback_data=SLOTS_PREV.pack()))
+    if has_more:
+        navigation_buttons.append(InlineKeyboardButton(text="Позже ➡️", callback_data=SLOTS_NEXT.pack()))
+
     # Формирование клавиатуры с доступными слотами
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{slot.start_time.strftime('%H:%M')} ({slot.master.name})",
-                callback_data=f"slot_{slot.id}"
-            )]
+            [slot_button(slot, master_names)]
             for slot in available_slots
-        ] + [
-            [InlineKeyboardButton(text="Назад", callback_data=f"change_week_{week_offset}")],
+        ] + ([navigation_buttons] if navigation_buttons else []) + [
+            [InlineKeyboardButton(text="Назад", callback_data=CHANGE_WEEK.pack(week_offset=week_offset))],
             [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
         ]
     )
 
+    # По этому состоянию кнопка "Назад" понимает, куда вернуться
+    await state.set_state(BookingStates.selecting_time)
     await callback_query.message.edit_text("Выберите время:", reply_markup=keyboard)
 
 
+@callback_routes.route(SLOT)
+@callback_routes.route(ANY_SLOT)
+async def confirm_booking_handler(callback_query: CallbackQuery, state: FSMContext, payload=None):
+    if payload is None:
+        payload = (ANY_SLOT if callback_query.data.startswith(ANY_SLOT.key) else SLOT).unpack(callback_query.data)
+    master_id = getattr(payload, "master_id", None)
+    start_time = payload.start_time
 
-@router.callback_query(F.data.startswith("slot_"))
-async def confirm_booking_handler(callback_query: CallbackQuery, state: FSMContext):
-    slot_id = int(callback_query.data.split("_")[1])
-
-    with SessionLocal() as session:
-        slot = session.query(TimeSlot).options(joinedload(TimeSlot.master)).filter(TimeSlot.id == slot_id).first()
-
-    await state.update_data(slot_id=slot_id, slot_time=slot.start_time, master_id=slot.master.id)
+    await state.update_data(slot_time=start_time, master_id=master_id)
 
     data = await state.get_data()
     service_name = data["service_name"]
-    slot_time = slot.start_time.strftime('%Y-%m-%d %H:%M')
+    slot_time = start_time.strftime('%Y-%m-%d %H:%M')
     week_offset = data.get("week_offset", 0)
 
     keyboard = InlineKeyboardMarkup(
@@ -137,19 +181,40 @@ async def confirm_booking_handler(callback_query: CallbackQuery, state: FSMConte
     )
 
 
+@callback_routes.route(NEAREST_SLOT)
+async def nearest_slot_handler(callback_query: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    if not data.get("service_id") or not data.get("service_duration"):
+        await callback_query.answer("Пожалуйста, начните запись заново.", show_alert=True)
+        return
+
+    master_id = data.get("master_id")
+    async with AsyncSessionLocal() as session:
+        slot = await session.run_sync(get_nearest_slot, data["service_id"], master_id, data["service_duration"])
+    if slot is None:
+        await callback_query.answer("В ближайшие недели свободного времени нет.", show_alert=True)
+        return
+
+    # Сразу переходим к подтверждению; если мастер не важен, он назначится при записи
+    if master_id is None:
+        payload = ANY_SLOT.payload_type(slot.start_time)
+    else:
+        payload = SLOT.payload_type(slot.master_id, slot.start_time)
+    await confirm_booking_handler(callback_query, state, payload=payload)
+
 
-@router.callback_query(F.data == "confirm_booking")
+@callback_routes.route(CONFIRM_BOOKING)
 async def save_booking(callback_query: CallbackQuery, state: FSMContext):
     # Получение данных из состояния FSM
     data = await state.get_data()
 
     service_id = data.get("service_id")
     master_id = data.get("master_id")
-    slot_id = data.get("slot_id")
+    slot_time = data.get("slot_time")
     service_duration = data.get("service_duration")
 
-    # Проверка на неполноту данных
-    if not service_id or not master_id or not slot_id or not service_duration:
+    # Проверка на неполноту данных; master_id нет, если клиенту не важен мастер
+    if not service_id or not slot_time or not service_duration:
         await callback_query.message.edit_text(
             "Ошибка: данные записи неполны. Пожалуйста, начните заново.",
             reply_markup=InlineKeyboardMarkup(
@@ -160,30 +225,34 @@ async def save_booking(callback_query: CallbackQuery, state: FSMContext):
         )
         return
 
-    with SessionLocal() as session:
-        # Проверяем наличие слота
-        slot = session.query(TimeSlot).filter(TimeSlot.id == slot_id).first()
-        if not slot or slot.status != TimeSlotStatus.free:
-            await callback_query.message.edit_text(
-                "Извините, выбранное время больше недоступно.",
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(text="Назад", callback_data="back_to_menu")]
-                    ]
-                )
+    async with AsyncSessionLocal() as session:
+        # Проверяем, существует ли пользователь
+        user_id = callback_query.from_user.id
+        user = (await session.execute(select(User).filter(User.telegram_id == str(user_id)))).scalars().first()
+        if not user:
+            user = User(telegram_id=str(user_id))
+            session.add(user)
+        # Запоминаем имя клиента, чтобы бот мастеров не запрашивал его у Telegram
+        user.display_name = client_display_name(callback_query.from_user)
+        await session.flush()
+
+        if master_id is None:
+            # Мастера назначаем сейчас; неудачная попытка занять время откатывает транзакцию,
+            # поэтому клиент сохраняется заранее
+            user_db_id = user.id
+            await session.commit()
+            master_ids = await session.run_sync(get_candidate_master_ids, service_id, None)
+            appointment = await session.run_sync(
+                book_any_master, user_db_id, service_id, master_ids, slot_time, service_duration
             )
-            return
-
-        # Бронируем слоты
-        required_slots = service_duration // 15
-        slots_to_book = session.query(TimeSlot).filter(
-            TimeSlot.master_id == master_id,
-            TimeSlot.start_time >= slot.start_time,
-            TimeSlot.start_time < slot.start_time + timedelta(minutes=service_duration),
-            TimeSlot.status == TimeSlotStatus.free
-        ).order_by(TimeSlot.start_time).all()
-
-        if len(slots_to_book) < required_slots:
+            user = await session.get(User, user_db_id) if appointment is not None else None
+            master_id = appointment.master_id if appointment is not None else None
+        else:
+            # Занимаем время и создаем запись на прием в одной транзакции
+            appointment = await session.run_sync(
+                book_appointment, user.id, master_id, service_id, slot_time, service_duration
+            )
+        if appointment is None:
             await callback_query.message.edit_text(
                 "Извините, выбранное время больше недоступно.",
                 reply_markup=InlineKeyboardMarkup(
@@ -193,39 +262,21 @@ async def save_booking(callback_query: CallbackQuery, state: FSMContext):
                 )
             )
             return
-
-        for s in slots_to_book:
-            s.status = TimeSlotStatus.booked
-
-        # Проверяем, существует ли пользователь
-        user_id = callback_query.from_user.id
-        user = session.query(User).filter(User.telegram_id == str(user_id)).first()
-        if not user:
-            user = User(telegram_id=str(user_id))
-            session.add(user)
-            session.commit()
-
-        user_telegram_id = user.telegram_id
-
-        # Создаем запись на прием
-        appointment = Appointment(
-            user_id=user.id,
-            master_id=master_id,
-            service_id=service_id,
-            timeslot_id=slot.id,
-            status="scheduled"
-        )
-        session.add(appointment)
+        record_change(session, master_id, slot_time.date())
+        enqueue_notification(session, "booking", master_id, user.telegram_id, slot_time, data["service_name"])
 
         # Фиксируем изменения
-        session.commit()
+        await session.commit()
+        reminder_scheduler.add(appointment.id, slot_time, data["service_name"], user.telegram_id)
+
+        master_name = (await session.execute(select(Master.name).filter(Master.id == master_id))).scalar()
 
         # Подготовка сообщения о подтверждении
         confirmation_message = (
             f"Вы успешно записаны на:\n"
-            f"Дата: {slot.start_time.strftime('%Y-%m-%d %H:%M')}\n"
+            f"Дата: {slot_time.strftime('%Y-%m-%d %H:%M')}\n"
             f"Услуга: {data['service_name']}\n"
-            f"Мастер: {slot.master.name}"
+            f"Мастер: {master_name}"
         )
 
     # Отправляем сообщение пользователю
@@ -238,7 +289,7 @@ async def save_booking(callback_query: CallbackQuery, state: FSMContext):
     await callback_query.message.edit_text(confirmation_message, reply_markup=keyboard)
     slot_time = data["slot_time"]
     service_name = data["service_name"]
-    await state.update_data(slot_time=slot.start_time, service_name=data["service_name"], service_duration=data["service_duration"])
+    await state.update_data(slot_time=slot_time, service_name=data["service_name"], service_duration=data["service_duration"])
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="Добавить в календарь", callback_data="add_to_calendar")],
@@ -252,7 +303,6 @@ async def save_booking(callback_query: CallbackQuery, state: FSMContext):
         f"Вы хотите добавить запись в календарь?",
         reply_markup=keyboard
     )
-    await insertion_send_telegram_notification(master_id, user_telegram_id, data)
 
 
 from icalendar import Calendar, Event
@@ -261,7 +311,7 @@ from io import BytesIO
 
 from urllib.parse import urlencode
 
-@router.callback_query(F.data == "add_to_calendar")
+@callback_routes.route(ADD_TO_CALENDAR)
 async def add_to_calendar(callback_query: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     slot_time = data.get("slot_time")
@@ -294,12 +344,12 @@ async def add_to_calendar(callback_query: CallbackQuery, state: FSMContext):
     await callback_query.message.edit_text("Добавьте запись в ваш календарь:", reply_markup=keyboard)
 
 
-@router.callback_query(F.data == "leave_review")
+@callback_routes.route(LEAVE_REVIEW)
 async def leave_review_handler(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
 
-    with SessionLocal() as session:
-        user = session.query(User).filter(User.telegram_id == str(user_id)).first()
+    async with AsyncSessionLocal() as session:
+        user = (await session.execute(select(User).filter(User.telegram_id == str(user_id)))).scalars().first()
         if not user:
             keyboard = InlineKeyboardMarkup(
                 inline_keyboard=[[InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")]]
@@ -307,13 +357,14 @@ async def leave_review_handler(callback_query: CallbackQuery):
             await callback_query.message.edit_text("У вас пока нет завершённых записей.", reply_markup=keyboard)
             return
 
-        completed_appointments = session.query(Appointment).options(
+        completed_appointments = (await session.execute(select(Appointment).options(
             joinedload(Appointment.service),
-            joinedload(Appointment.master)
+            joinedload(Appointment.master),
+            joinedload(Appointment.timeslot)
         ).filter(
             Appointment.user_id == user.id,
             Appointment.status == AppointmentStatus.completed
-        ).all()
+        ))).scalars().all()
 
         if not completed_appointments:
             keyboard = InlineKeyboardMarkup(
@@ -326,7 +377,7 @@ async def leave_review_handler(callback_query: CallbackQuery):
             inline_keyboard=[
                 [InlineKeyboardButton(
                     text=f"{appt.service.name} | {appt.master.name} | {appt.timeslot.start_time.strftime('%Y-%m-%d %H:%M')}",
-                    callback_data=f"review_{appt.id}"
+                    callback_data=REVIEW.pack(appointment_id=appt.id)
                 )]
                 for appt in completed_appointments
             ] + [[InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")]]
@@ -335,25 +386,22 @@ async def leave_review_handler(callback_query: CallbackQuery):
         await callback_query.message.edit_text("Выберите запись для отзыва:", reply_markup=keyboard)
 
 
-@router.callback_query(F.data.startswith("review_"))
-async def review_handler(callback_query: CallbackQuery, state: FSMContext):
-    appointment_id = int(callback_query.data.split("_")[1])
+@callback_routes.route(REVIEW)
+async def review_handler(callback_query: CallbackQuery, state: FSMContext, payload=None):
+    appointment_id = (payload or REVIEW.unpack(callback_query.data)).appointment_id
     await state.update_data(appointment_id=appointment_id)
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="1⭐️", callback_data="rate_1"),
-             InlineKeyboardButton(text="2⭐️", callback_data="rate_2"),
-             InlineKeyboardButton(text="3⭐️", callback_data="rate_3"),
-             InlineKeyboardButton(text="4⭐️", callback_data="rate_4"),
-             InlineKeyboardButton(text="5⭐️", callback_data="rate_5")]
+            [InlineKeyboardButton(text=f"{rating}⭐️", callback_data=RATE.pack(rating=rating))
+             for rating in range(1, 6)]
         ]
     )
     await callback_query.message.edit_text("Оцените услугу от 1 до 5:", reply_markup=keyboard)
 
-@router.callback_query(F.data.startswith("rate_"))
-async def rate_handler(callback_query: CallbackQuery, state: FSMContext):
-    rating = int(callback_query.data.split("_")[1])
+@callback_routes.route(RATE)
+async def rate_handler(callback_query: CallbackQuery, state: FSMContext, payload=None):
+    rating = (payload or RATE.unpack(callback_query.data)).rating
     await state.update_data(rating=rating)
 
     await callback_query.message.edit_text("Напишите ваш отзыв в сообщении:")
@@ -370,8 +418,8 @@ async def review_text_handler(message, state: FSMContext):
     rating = data.get("rating")
     review_text = message.text
 
-    with SessionLocal() as session:
-        appointment = session.query(Appointment).filter(Appointment.id == appointment_id).first()
+    async with AsyncSessionLocal() as session:
+        appointment = await session.get(Appointment, appointment_id) if appointment_id else None
         if appointment:
             review = Review(
                 user_id=appointment.user_id,
@@ -380,7 +428,10 @@ async def review_text_handler(message, state: FSMContext):
                 review_text=review_text
             )
             session.add(review)
-            session.commit()
+            # Рейтинг мастера изменился — списки мастеров в ботах устарели
+            await session.run_sync(bump_data_version, MASTERS)
+            await session.commit()
+            master_lists.invalidate()
 
     # Клавиатура с кнопкой "Назад в меню"
     keyboard = InlineKeyboardMarkup(
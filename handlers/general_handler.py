@@ -1,7 +1,7 @@
 from aiogram import Router
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from database import SessionLocal, Service
+from utils.catalog import service_catalog
 
 
 
@@ -28,17 +28,7 @@ async def handle_unrecognized_message(message: Message, state: FSMContext):
         await message.answer(new_text, reply_markup=keyboard)
     else:
         # Пользователь еще не выбрал услугу, предлагаем ему выбрать услугу
-        with SessionLocal() as session:
-            services = session.query(Service).all()
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text=f"{service.name} - {service.cost} руб.",
-                                          callback_data=f"service_{service.id}")]
-                    for service in services
-                ] + [
-                    [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
-                ]
-            )
+        keyboard = (await service_catalog.current()).keyboard
         new_text = "Выберите услугу:"
         await message.answer("Используйте кнопки для выбора.")
         await message.answer(new_text, reply_markup=keyboard)
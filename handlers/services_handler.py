@@ -1,50 +1,42 @@
-from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import select
 from sqlalchemy.orm import joinedload
-from database import SessionLocal, Service, Master, TimeSlot, TimeSlotStatus, master_service_association, User, Appointment
+from database import AsyncSessionLocal, TimeSlot, User, Appointment
 import logging
 from datetime import datetime, timedelta
 
-from master_bot import delete_send_telegram_notification
-
 from utils.calendar import show_calendar
-
-# Создаем роутер
-router = Router()
-
-# Хранилище данных для текущего выбора пользователя
-user_booking_data = {}
+from utils.catalog import service_catalog, master_lists
+from utils.callbacks import (
+    callback_routes, SERVICES, SERVICE, SELECT_MASTER, MASTER, SELECT_TIME_NO_MASTER, MY_BOOKINGS,
+    CANCEL_BOOKING, PREVIOUS_STEP
+)
+from utils.availability import cancel_appointment
+from utils.availability_cache import record_change
+from utils.notifications import enqueue_notification, client_display_name
+from utils.reminders import reminder_scheduler
 
 logging.basicConfig(level=logging.INFO)
 # Обработчик команды "Посмотреть услуги"
-@router.callback_query(F.data == "services")
+@callback_routes.route(SERVICES)
 async def services_handler(callback_query: CallbackQuery):
-    with SessionLocal() as session:
-        services = session.query(Service).all()
-
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=f"{service.name} - {service.cost} руб.",
-                                  callback_data=f"service_{service.id}")]
-            for service in services
-        ] + [
-            [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
-        ]
-    )
-    await callback_query.message.edit_text("Выберите услугу:", reply_markup=keyboard)
+    catalog = await service_catalog.current()
+    await callback_query.message.edit_text("Выберите услугу:", reply_markup=catalog.keyboard)
 
 
 # Обработчик выбора услуги
 # При выборе услуги
 from states import BookingStates
 
-@router.callback_query(F.data.startswith("service_"))
-async def select_service_handler(callback_query: CallbackQuery, state: FSMContext):
-    service_id = int(callback_query.data.split("_")[1])
+@callback_routes.route(SERVICE)
+async def select_service_handler(callback_query: CallbackQuery, state: FSMContext, payload=None):
+    service_id = (payload or SERVICE.unpack(callback_query.data)).service_id
 
-    with SessionLocal() as session:
-        service = session.query(Service).filter(Service.id == service_id).first()
+    service = await service_catalog.get(service_id)
+    if service is None:
+        await callback_query.answer("Услуга больше недоступна.", show_alert=True)
+        return
 
     # Сохраняем данные в состоянии FSM
     await state.update_data(service_id=service_id, service_name=service.name, service_duration=service.duration)
@@ -60,7 +52,7 @@ async def select_service_handler(callback_query: CallbackQuery, state: FSMContex
         ]
     )
     await callback_query.message.edit_text("Как вы хотите продолжить?", reply_markup=keyboard)
-@router.callback_query(F.data == "select_master")
+@callback_routes.route(SELECT_MASTER)
 async def select_master_handler(callback_query: CallbackQuery, state: FSMContext):
     user_id = callback_query.from_user.id
     data = await state.get_data()
@@ -70,49 +62,43 @@ async def select_master_handler(callback_query: CallbackQuery, state: FSMContext
         await callback_query.message.edit_text("Ошибка: услуга не выбрана.")
         return
 
-    with SessionLocal() as session:
-        service = session.query(Service).filter(Service.id == service_id).first()
-        if not service or not service.masters:
-            await callback_query.message.edit_text("Нет доступных мастеров для выбранной услуги.")
-            return
+    # Кнопки мастеров с рейтингами берутся из памяти
+    master_buttons = await master_lists.buttons(service_id)
+    if not master_buttons:
+        await callback_query.message.edit_text("Нет доступных мастеров для выбранной услуги.")
+        return
 
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(
-                    text=f"{master.name} (Рейтинг: {master.rating})",
-                    callback_data=f"master_{master.id}"
-                )]
-                for master in service.masters
-            ] + [
-                [InlineKeyboardButton(text="Назад", callback_data=f"service_{service_id}")],
-                [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
-            ]
-        )
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=master_buttons + [
+            [InlineKeyboardButton(text="Назад", callback_data=SERVICE.pack(service_id=service_id))],
+            [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
+        ]
+    )
     await callback_query.message.edit_text("Выберите мастера:", reply_markup=keyboard)
 
 
 # Обработчик выбора мастера
-@router.callback_query(F.data.startswith("master_"))
-async def select_master_calendar_handler(callback_query: CallbackQuery, state: FSMContext):
-    master_id = int(callback_query.data.split("_")[1])
+@callback_routes.route(MASTER)
+async def select_master_calendar_handler(callback_query: CallbackQuery, state: FSMContext, payload=None):
+    master_id = (payload or MASTER.unpack(callback_query.data)).master_id
     await state.update_data(master_id=master_id)  # Сохраняем выбор мастера в состояние
 
     await show_calendar(callback_query.message, state, week_offset=0)
 
 
 # Обработчик выбора времени без мастера
-@router.callback_query(F.data == "select_time_no_master")
+@callback_routes.route(SELECT_TIME_NO_MASTER)
 async def select_time_no_master_handler(callback_query: CallbackQuery, state: FSMContext):
     await state.update_data(master_id=None)  # Устанавливаем, что мастер не выбран
 
     await show_calendar(callback_query.message, state, week_offset=0)
 # Обработчик кнопки "Мои записи"
-@router.callback_query(F.data == "my_bookings")
+@callback_routes.route(MY_BOOKINGS)
 async def my_bookings_handler(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
 
-    with SessionLocal() as session:
-        user = session.query(User).filter(User.telegram_id == str(user_id)).first()
+    async with AsyncSessionLocal() as session:
+        user = (await session.execute(select(User).filter(User.telegram_id == str(user_id)))).scalars().first()
         if not user:
             keyboard = InlineKeyboardMarkup(
                 inline_keyboard=[
@@ -122,7 +108,11 @@ async def my_bookings_handler(callback_query: CallbackQuery):
             await callback_query.message.edit_text("У вас пока нет активных записей.", reply_markup=keyboard)
             return
 
-        bookings = session.query(Appointment).options(
+        # Имя клиента для уведомлений мастеру держим актуальным
+        user.display_name = client_display_name(callback_query.from_user)
+        await session.commit()
+
+        bookings = (await session.execute(select(Appointment).options(
             joinedload(Appointment.timeslot).joinedload(TimeSlot.master),
             joinedload(Appointment.service),
             joinedload(Appointment.master)
@@ -130,7 +120,7 @@ async def my_bookings_handler(callback_query: CallbackQuery):
             Appointment.user_id == user.id,
             TimeSlot.start_time > (datetime.utcnow() + timedelta(hours=2, minutes=45)),
             Appointment.status != "cancelled"
-        ).all()
+        ))).scalars().all()
 
         if not bookings:
             keyboard = InlineKeyboardMarkup(
@@ -148,7 +138,7 @@ async def my_bookings_handler(callback_query: CallbackQuery):
                 f"{booking.timeslot.start_time.strftime('%Y-%m-%d %H:%M')} | "
                 f"{booking.service.name} | Мастер: {booking.master.name}"
             )
-            cancel_callback = f"cancel_booking_{booking.id}"
+            cancel_callback = CANCEL_BOOKING.pack(appointment_id=booking.id)
             keyboard_buttons.append([InlineKeyboardButton(text=button_text, callback_data="noop")])
             keyboard_buttons.append([InlineKeyboardButton(text="❌ Отменить", callback_data=cancel_callback)])
 
@@ -159,50 +149,28 @@ async def my_bookings_handler(callback_query: CallbackQuery):
     await callback_query.message.edit_text("Ваши записи:", reply_markup=keyboard)
 
 
-@router.callback_query(F.data.startswith("cancel_booking_"))
-async def cancel_booking_handler(callback_query: CallbackQuery):
-    booking_id = int(callback_query.data.split("_")[2])  # Получаем ID записи
+@callback_routes.route(CANCEL_BOOKING)
+async def cancel_booking_handler(callback_query: CallbackQuery, payload=None):
+    booking_id = (payload or CANCEL_BOOKING.unpack(callback_query.data)).appointment_id  # Получаем ID записи
 
-    with SessionLocal() as session:
-        # Находим запись
-        booking = session.query(Appointment).filter(Appointment.id == booking_id).first()
-        if not booking:
+    async with AsyncSessionLocal() as session:
+        # Отменяем запись и освобождаем её время
+        cancelled = await session.run_sync(cancel_appointment, booking_id)
+        if cancelled is None:
             await callback_query.answer("Запись не найдена или уже отменена.", show_alert=True)
             return
-        # Помечаем запись как отменённую
-        booking.status = "cancelled"
-
-        # Освобождаем все временные слоты, связанные с этой записью
-        timeslot = session.query(TimeSlot).filter(TimeSlot.id == booking.timeslot_id).first()
-        if not timeslot:
-            await callback_query.answer("Связанные временные слоты не найдены.", show_alert=True)
-            return
-
-        # Рассчитываем длительность услуги
-        service_duration = booking.service.duration  # В минутах
-        required_slots = service_duration // 15
-
-        # Ищем последовательные слоты для освобождения
-        end_time = timeslot.start_time + timedelta(minutes=service_duration)
-        booked_slots = session.query(TimeSlot).filter(
-            TimeSlot.master_id == timeslot.master_id,
-            TimeSlot.start_time >= timeslot.start_time,
-            TimeSlot.start_time < end_time,
-            TimeSlot.status == TimeSlotStatus.booked
-        ).order_by(TimeSlot.start_time).all()
-        print(booking.master_id, booking.user.telegram_id,
-                                                booking.timeslot.start_time, booking.service.name)
-        for slot in booked_slots:
-            slot.status = TimeSlotStatus.free  # Освобождаем слот
-        await delete_send_telegram_notification(booking.master_id, booking.user.telegram_id,
-                                                booking.timeslot.start_time, booking.service.name)
-        session.commit()
+        record_change(session, cancelled.master_id, cancelled.start_time.date())
+        # Уведомление мастеру отправит бот мастеров после коммита
+        enqueue_notification(session, "cancellation", cancelled.master_id, cancelled.user_telegram_id,
+                             cancelled.start_time, cancelled.service_name)
+        await session.commit()
+    reminder_scheduler.remove(booking_id)
 
     # Обновляем список записей
     await my_bookings_handler(callback_query)
 
 
-@router.callback_query(F.data == "previous_step")
+@callback_routes.route(PREVIOUS_STEP)
 async def previous_step_handler(callback_query: CallbackQuery, state: FSMContext):
     """Обработчик для кнопки 'Назад'."""
     data = await state.get_data()
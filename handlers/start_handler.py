@@ -1,6 +1,9 @@
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram import Router, F
 from utils.main_menu import send_main_menu
+from utils.callbacks import callback_routes, START, BACK_TO_MENU
+from utils.notifications import remember_display_name
+from database import AsyncSessionLocal
 
 
 
@@ -8,6 +11,11 @@ router = Router()
 
 @router.message(F.text == "/start")
 async def first_interaction(message: Message):
+    # Имя клиента для уведомлений мастеру держим актуальным
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(remember_display_name, message.from_user)
+        await session.commit()
+
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="Старт", callback_data="start")],
@@ -16,12 +24,12 @@ async def first_interaction(message: Message):
     await message.answer("Добро пожаловать! Нажмите 'Старт', чтобы начать.", reply_markup=keyboard)
 
 
-@router.callback_query(F.data == "start")
+@callback_routes.route(START)
 async def start_handler(callback_query: CallbackQuery):
     await send_main_menu(callback_query.message)
 
 
 # Обработчик кнопки "Назад в меню"
-@router.callback_query(F.data == "back_to_menu")
+@callback_routes.route(BACK_TO_MENU)
 async def back_to_menu_handler(callback_query: CallbackQuery):
     await send_main_menu(callback_query.message)
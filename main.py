@@ -1,26 +1,43 @@
+import asyncio
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 
 from fastapi import FastAPI, Form, Request, Depends, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from database import SessionLocal, Master, Service, TimeSlot, TimeSlotStatus, Admin, Review, export_database, User
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from database import (
+    AsyncSessionLocal, Master, Service, TimeSlotStatus, Admin, Review, export_database, User,
+    master_service_association
+)
+from utils.availability import get_schedule as get_master_schedule, replace_schedule
+from utils.availability_cache import record_change
+from utils.data_version import CATALOG, MASTERS, bump_data_version, get_data_versions
 import uvicorn, random, string, os, json
 from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime as format_http_date, parsedate_to_datetime
 from babel.dates import format_datetime
 
 app = FastAPI()
 
 templates = Jinja2Templates(directory="templates")
 
-def get_db():
-    db = SessionLocal()
-    try:
+# Экспорт базы остаётся синхронным (пишет CSV-файлы), поэтому выполняется в отдельном потоке;
+# один поток — чтобы одновременные выгрузки не писали в один каталог
+export_executor = ThreadPoolExecutor(max_workers=1)
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+async def get_master_by_login(db, login, *options):
+    return (await db.execute(select(Master).filter(Master.login == login).options(*options))).scalars().first()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_login(request: Request):
@@ -32,10 +49,14 @@ async def login_user(
     request: Request,
     login: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    admin = db.query(Admin).filter(Admin.login == login, Admin.password == password).first()
-    master = db.query(Master).filter(Master.login == login, Master.password == password).first()
+    admin = (await db.execute(
+        select(Admin).filter(Admin.login == login, Admin.password == password)
+    )).scalars().first()
+    master = (await db.execute(
+        select(Master).filter(Master.login == login, Master.password == password)
+    )).scalars().first()
     if admin:
         return RedirectResponse(url="/masters", status_code=302)
     elif master:
@@ -44,8 +65,8 @@ async def login_user(
 
 # регистрация администратора
 @app.post("/register-admin", response_class=HTMLResponse)
-async def register_admin(request: Request, login: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    existing_admin = db.query(Admin).filter(Admin.login == login).first()
+async def register_admin(request: Request, login: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    existing_admin = (await db.execute(select(Admin).filter(Admin.login == login))).scalars().first()
     if existing_admin:
         return templates.TemplateResponse("login.html", {
             "request": request,
@@ -53,25 +74,59 @@ async def register_admin(request: Request, login: str = Form(...), password: str
         })
     new_admin = Admin(login=login, password=password)
     db.add(new_admin)
-    db.commit()
+    await db.commit()
     return templates.TemplateResponse("login.html", {"request": request})
 
+def not_modified(request, etag, last_modified):
+    """Совпадает ли то, что уже есть у браузера, с текущей версией страницы."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
 # первая страница администратора с мастерами и услугами
 @app.get("/masters", response_class=HTMLResponse)
-async def masters(request: Request, db: Session = Depends(get_db)):
-    ms = db.query(Master).all()
+async def masters(request: Request, db: AsyncSession = Depends(get_db)):
+    # Страница меняется только вместе с мастерами (услуги мастеров, отзывы) или каталогом услуг,
+    # поэтому её версия — пара версий этих данных; если у браузера она уже есть, отвечаем 304
+    versions, updated_at = await db.run_sync(get_data_versions, [MASTERS, CATALOG])
+    etag = '"masters-{}-{}"'.format(*versions)
+    last_modified = updated_at.replace(tzinfo=timezone.utc) if updated_at else None
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified:
+        headers["Last-Modified"] = format_http_date(last_modified, usegmt=True)
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    # Мастера с услугами одним запросом: названия услуг склеиваются в базе, рейтинг считается из столбцов
+    rows = (await db.execute(
+        select(Master.id, Master.name, Master.login, Master.password, Master.total_rating, Master.num_reviews,
+               func.group_concat(Service.name, ", "))
+        .outerjoin(master_service_association, master_service_association.c.master_id == Master.id)
+        .outerjoin(Service, Service.id == master_service_association.c.service_id)
+        .group_by(Master.id)
+        .order_by(Master.id)
+    )).all()
     masters_list = [
         {
-            "id": master.id,
-            "name": master.name,
-            "rating": master.rating,
-            "login": master.login,
-            "password": master.password,
-            "services": ", ".join(service.name for service in master.services)
+            "id": master_id,
+            "name": name,
+            # Так же, как Master.rating
+            "rating": total_rating / num_reviews if num_reviews > 0 else 0,
+            "login": login,
+            "password": password,
+            "services": service_names or ""
         }
-        for master in ms
+        for master_id, name, login, password, total_rating, num_reviews, service_names in rows
     ]
-    sv = db.query(Service).all()
+    sv = (await db.execute(select(Service))).scalars().all()
     services = [
         {
             "name": service.name,
@@ -80,7 +135,7 @@ async def masters(request: Request, db: Session = Depends(get_db)):
         }
         for service in sv
     ]
-    return templates.TemplateResponse("masters.html", {"request": request, "masters": masters_list, "services": services, "is_admin": True}, status_code=302)
+    return templates.TemplateResponse(request, "masters.html", {"masters": masters_list, "services": services, "is_admin": True}, headers=headers)
 
 
 # личный кабинет мастера
@@ -91,22 +146,22 @@ async def master_lk(request: Request, login: str):
 
 # расписание общее для админа и мастера (метка админа чтобы вернутся каждому в свою изначальную страницу)
 @app.get("/schedule/{login}/{is_admin}", response_class=HTMLResponse)
-async def get_schedule(request: Request, login: str, is_admin: bool, db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.login == login).first()
+async def get_schedule(request: Request, login: str, is_admin: bool, db: AsyncSession = Depends(get_db)):
+    master = await get_master_by_login(db, login)
     if not master:
         raise HTTPException(status_code=404, detail="Мастер не был найден")
 
-    timeslots = db.query(TimeSlot).filter(TimeSlot.master_id == master.id).all()
+    timeslots = await db.run_sync(get_master_schedule, master.id)
     slots_by_day = defaultdict(list)
 
-    for slot in timeslots:
-        date = slot.start_time.date()
+    for start_time, status in timeslots:
+        date = start_time.date()
         date_str = date.strftime("%d-%m-%y")
         # weekday = date.strftime("%A")
-        time = slot.start_time.strftime("%H:%M")
+        time = start_time.strftime("%H:%M")
         slots_by_day[date_str].append({
             "time": time,
-            "status": slot.status.value
+            "status": status.value
         })
     schedule = [{
         "date": date,
@@ -129,13 +184,13 @@ async def update_schedule(
         login: str,
         is_admin: bool,
         selected_slots: str = Form(...),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    master = db.query(Master).filter(Master.login == login).first()
+    master = await get_master_by_login(db, login)
     if not master:
         raise HTTPException(status_code=404, detail="Мастер не найден")
 
-    db.query(TimeSlot).filter(TimeSlot.master_id == master.id).delete()
+    quarters = []
     try:
         for line in selected_slots.split("\n"):
             parts = line.split(",")
@@ -144,42 +199,36 @@ async def update_schedule(
                 start_time = datetime.strptime(date_str, "%d-%m-%y")
                 for hour in range(9, 19):
                     for i in range(4):
-                        time_slot = TimeSlot(
-                            master_id=master.id,
-                            start_time=start_time + timedelta(hours=hour, minutes=i * 15),
-                            status=TimeSlotStatus.booked
-                        )
-                        db.add(time_slot)
+                        quarters.append((start_time + timedelta(hours=hour, minutes=i * 15), TimeSlotStatus.booked))
             else:
                 start_time = datetime.strptime(f"{date_str} {time_str}", "%d-%m-%y %H:%M")
-                time_slot = TimeSlot(
-                    master_id=master.id,
-                    start_time=start_time,
-                    status=TimeSlotStatus[status]
-                )
-                db.add(time_slot)
-        db.commit()
+                quarters.append((start_time, TimeSlotStatus[status]))
+        await db.run_sync(replace_schedule, master.id, quarters)
+        record_change(db, master.id)
+        await db.commit()
     except ValueError:
         raise HTTPException(status_code=400, detail="неверный формат")
     return RedirectResponse(url=f"/schedule/{login}/{is_admin}", status_code=302)
 # добавление услуги мастеру
 @app.get("/addservicetomaster/{master_login}", response_class=HTMLResponse)
-async def add_service_to_master(master_login: str, request: Request, db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.login == master_login).first()
+async def add_service_to_master(master_login: str, request: Request, db: AsyncSession = Depends(get_db)):
+    master = await get_master_by_login(db, master_login)
     if not master:
         raise HTTPException(status_code=404, detail="Мастер не найден")
-    services = db.query(Service).all()
+    services = (await db.execute(select(Service))).scalars().all()
     return templates.TemplateResponse("addservicetomaster.html", {"request": request, "master_login": master_login, "services": services})
 
 # добавление услуг мастеру
 @app.post("/addservicetomaster/{master_login}", response_class=HTMLResponse)
-async def save_services_to_master(master_login: str, services: list[int] = Form([]), db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.login == master_login).first()
-    selected_services = db.query(Service).filter(Service.id.in_(services)).all()
+async def save_services_to_master(master_login: str, services: list[int] = Form([]), db: AsyncSession = Depends(get_db)):
+    master = await get_master_by_login(db, master_login, selectinload(Master.services))
+    selected_services = (await db.execute(select(Service).filter(Service.id.in_(services)))).scalars().all()
     if not master:
         raise HTTPException(status_code=404, detail="Мастер не найден")
     master.services.extend(selected_services)
-    db.commit()
+    record_change(db, master.id)
+    await db.run_sync(bump_data_version, MASTERS)
+    await db.commit()
     return RedirectResponse(url="/masters", status_code=302)
 
 # редактирование расписания
@@ -198,19 +247,11 @@ async def choose_schedule(request: Request, login: str, is_admin: bool):
 
 @app.post("/chooseschedule/{login}/{is_admin}", response_class=HTMLResponse)
 async def set_schedule(request: Request, login: str, is_admin: bool, schedule: list[str] = Form([]),
-                       db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.login == login).first()
+                       db: AsyncSession = Depends(get_db)):
+    master = await get_master_by_login(db, login)
     if not master:
         raise HTTPException(status_code=404, detail="Мастер не найден")
-    selected_dates = {slot.split("_")[0] for slot in schedule}
-    for date in selected_dates:
-        start_datetime = datetime.strptime(date, "%d-%m-%y")
-        end_datetime = start_datetime + timedelta(days=1)
-        db.query(TimeSlot).filter(
-            TimeSlot.master_id == master.id,
-            TimeSlot.start_time >= start_datetime,
-            TimeSlot.start_time < end_datetime
-        ).delete()
+    quarters_by_date = defaultdict(list)
     for slot in schedule:
         date_parts = slot.split("_")
         date = date_parts[0]
@@ -219,30 +260,27 @@ async def set_schedule(request: Request, login: str, is_admin: bool, schedule: l
             # end_datetime = start_datetime + timedelta(days=1)
             for hour in range(9, 19):
                 for i in range(4):  # 4 интервала по 15 минут
-                    time_slot = TimeSlot(
-                        master_id=master.id,
-                        start_time=start_datetime + timedelta(hours=hour, minutes=i * 15),
-                        status=TimeSlotStatus.free
+                    quarters_by_date[date].append(
+                        (start_datetime + timedelta(hours=hour, minutes=i * 15), TimeSlotStatus.free)
                     )
-                    db.add(time_slot)
         else:
             hour = int(date_parts[1])
             base_time = datetime.strptime(date, "%d-%m-%y") + timedelta(hours=hour)
             for i in range(4):
-                time_slot = TimeSlot(
-                    master_id=master.id,
-                    start_time=base_time + timedelta(minutes=i * 15),
-                    status=TimeSlotStatus.free
-                )
-                db.add(time_slot)
-    db.commit()
+                quarters_by_date[date].append((base_time + timedelta(minutes=i * 15), TimeSlotStatus.free))
+    for date, quarters in quarters_by_date.items():
+        start_datetime = datetime.strptime(date, "%d-%m-%y")
+        end_datetime = start_datetime + timedelta(days=1)
+        await db.run_sync(replace_schedule, master.id, quarters, start_datetime, end_datetime)
+        record_change(db, master.id, start_datetime.date())
+    await db.commit()
     return RedirectResponse(url=f"/schedule/{login}/{is_admin}", status_code=302)
 
 # отзывы
 @app.get("/reviews/{username}/{is_admin}", response_class=HTMLResponse)
-async def master_reviews(request: Request, username: str, is_admin: bool, db: Session = Depends(get_db)):
-    master = db.query(Master).filter(Master.login == username).first()
-    rw = db.query(Review).filter(Review.master_id == master.id).all()
+async def master_reviews(request: Request, username: str, is_admin: bool, db: AsyncSession = Depends(get_db)):
+    master = await get_master_by_login(db, username)
+    rw = (await db.execute(select(Review).filter(Review.master_id == master.id))).scalars().all()
     reviews_list = [
         {
             "rating": review.rating,
@@ -264,8 +302,7 @@ async def download_db():
         export_dir = "database_export"
         archive_path = f"{export_dir}.zip"
         # Экспортируем базу данных (архив создается внутри)
-        export_database()
-        shutil.make_archive(export_dir, 'zip', export_dir)
+        await asyncio.get_running_loop().run_in_executor(export_executor, export_archive, export_dir)
         # Проверяем, существует ли созданный архив
         if not os.path.exists(archive_path):
             raise RuntimeError("Архив не найден после экспорта базы данных.")
@@ -279,15 +316,19 @@ async def download_db():
         # Возвращаем ошибку в случае проблем
         raise HTTPException(status_code=500, detail=f"Ошибка экспорта: {str(e)}")
 
+def export_archive(export_dir):
+    export_database()
+    shutil.make_archive(export_dir, 'zip', export_dir)
+
 # добавление мастеров с сгенерированными паролями и логинами
 def generate_password(length=8):
     characters = string.ascii_letters + string.digits
     return ''.join(random.choice(characters) for _ in range(length))
 @app.get("/add-master", response_class=HTMLResponse)
-async def add_master_form(request: Request, db: Session = Depends(get_db)):
+async def add_master_form(request: Request, db: AsyncSession = Depends(get_db)):
     password = generate_password()
     login = f"master{random.randint(5, 9999)}"
-    services = db.query(Service).all()
+    services = (await db.execute(select(Service))).scalars().all()
     return templates.TemplateResponse("addmaster.html", {
         "request": request,
         "login": login,
@@ -302,14 +343,18 @@ async def save_master(
     login: str = Form(...),
     password: str = Form(...),
     services: list[int] = Form([]),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     new_master = Master(name=name, telegram_id=telegram_id, login=login, password=password, services=[])
     if services:
-        selected_services = db.query(Service).filter(Service.id.in_(services)).all()
+        selected_services = (await db.execute(select(Service).filter(Service.id.in_(services)))).scalars().all()
         new_master.services.extend(selected_services)
     db.add(new_master)
-    db.commit()
+    await db.flush()
+    record_change(db, new_master.id)
+    # Новый мастер должен появиться на странице админа, даже если услуг у него пока нет
+    await db.run_sync(bump_data_version, MASTERS)
+    await db.commit()
     return RedirectResponse(url="/masters", status_code=302)
 
 # добавление сервисов
@@ -323,11 +368,13 @@ async def add_service(
     name: str = Form(...),
     price: int = Form(...),
     duration: int = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     new_service = Service(name=name, cost=price, duration=duration)
     db.add(new_service)
-    db.commit()
+    # Боты перечитают каталог услуг при следующей сверке версии
+    await db.run_sync(bump_data_version, CATALOG)
+    await db.commit()
     return RedirectResponse(url="/masters", status_code=302)
 
 
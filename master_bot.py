@@ -1,7 +1,10 @@
 import asyncio
+import logging
 import os
+from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import (
     ReplyKeyboardMarkup,
@@ -12,7 +15,9 @@ from aiogram.types import (
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.future import select
 from sqlalchemy.orm import sessionmaker
-from database import Master
+from database import Master, User, NotificationOutbox, NotificationKind
+from utils.ttl_cache import TTLCache
+from utils.rate_limiter import SendScheduler
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,20 +26,59 @@ API_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN2")
 if not API_TOKEN:
     raise ValueError("Telegram bot token is not found in environment variables")
 
+# Один бот мастеров на процесс: уведомления, ответы мастерам и запросы имён клиентов
+# проходят через общий ограничитель частоты Telegram
+bot = Bot(token=API_TOKEN)
+bot.session.middleware(SendScheduler())
+
 # Создаем асинхронный движок базы данных и сессию
 engine = create_async_engine('sqlite+aiosqlite:///database.db', echo=True)
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Очередь уведомлений: сколько строк отправлять за проход, как часто проверять очередь
+# и сколько раз повторять отправку с экспоненциальной задержкой
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 1
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BASE_BACKOFF = 5
+OUTBOX_MAX_BACKOFF = 15 * 60
+
+# Имена клиентов и чаты мастеров почти не меняются, поэтому держим их в памяти:
+# на загруженный день приходится много уведомлений об одних и тех же людях
+username_cache = TTLCache(maxsize=10000, ttl=24 * 60 * 60)
+master_chat_cache = TTLCache(maxsize=1000, ttl=10 * 60)
+
 # Функция для получения имени пользователя по Telegram ID
-async def get_username_by_telegram_id(telegram_id):
-    async with Bot(token=API_TOKEN) as master_bot:
-        try:
-            chat = await master_bot.get_chat_member(telegram_id, telegram_id)
-            return chat.user.first_name if chat.user.first_name else chat.user.username if chat.user.username else str(telegram_id)
-        except Exception as e:
-            return str(telegram_id)
+async def get_username_by_telegram_id(telegram_id, master_bot=None):
+    name = username_cache.get(str(telegram_id))
+    if name is not None:
+        return name
+
+    # Имя, которое запомнил бот клиентов, не требует запроса к Telegram
+    try:
+        async with async_session_maker() as session:
+            name = (await session.execute(
+                select(User.display_name).filter(User.telegram_id == str(telegram_id))
+            )).scalar()
+    except Exception as e:
+        name = None
+
+    if not name:
+        name = await fetch_username(master_bot or bot, telegram_id)
+    username_cache.set(str(telegram_id), name)
+    return name
+
+async def fetch_username(master_bot, telegram_id):
+    try:
+        chat = await master_bot.get_chat_member(telegram_id, telegram_id)
+        return chat.user.first_name if chat.user.first_name else chat.user.username if chat.user.username else str(telegram_id)
+    except Exception as e:
+        return str(telegram_id)
 
 async def get_telegram_id_by_master_id(master_id):
+    telegram_id = master_chat_cache.get(master_id)
+    if telegram_id is not None:
+        return telegram_id
     async with async_session_maker() as session:
         try:
             result = await session.execute(
@@ -43,43 +87,87 @@ async def get_telegram_id_by_master_id(master_id):
             master = result.scalars().first()  # Получаем первую (и единственную) запись
 
             if master:
+                master_chat_cache.set(master_id, master.telegram_id)
                 return master.telegram_id
             else:
                 return None
         except Exception as e:
             return None
 
-async def insertion_send_telegram_notification(master_id, user_telegram_id, booking_data):
-    async with Bot(token=API_TOKEN) as master_bot:
-        master_telegram_id = await get_telegram_id_by_master_id(master_id)
-        if master_telegram_id is None:
-            return
-        name = await get_username_by_telegram_id(user_telegram_id)
-        message = (
-            f"У вас новая запись на {booking_data['slot_time'].strftime('%d-%m %H:%M')}\n"  
-            f"Услуга: {booking_data['service_name']}\n"
-            f"Клиент: {name}"
-        )
-        try:
-            await master_bot.send_message(chat_id=master_telegram_id, text=message)
-        except Exception as e:
-            pass
-
-async def delete_send_telegram_notification(master_id, user_id, slot_time, service_name):
-    async with Bot(token=API_TOKEN) as master_bot:
-        master_telegram_id = await get_telegram_id_by_master_id(master_id)
-        if master_telegram_id is None:
-            return
-        name = await get_username_by_telegram_id(user_id)
-        message = (
-            f"У вас отмена записи на {slot_time.strftime('%d-%m %H:%M')}\n" 
-            f"Услуга: {service_name}\n"
-            f"Клиент: {name}"
+def notification_text(kind, slot_time, service_name, client_name):
+    title = "У вас новая запись на" if kind == NotificationKind.booking else "У вас отмена записи на"
+    return (
+        f"{title} {slot_time.strftime('%d-%m %H:%M')}\n"
+        f"Услуга: {service_name}\n"
+        f"Клиент: {client_name}"
+    )
+
+
+def retry_delay(attempts):
+    """Задержка перед следующей попыткой: 5 с, 10 с, 20 с... но не больше OUTBOX_MAX_BACKOFF."""
+    return timedelta(seconds=min(OUTBOX_BASE_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF))
+
+
+async def deliver_notifications(master_bot, batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Отправляет пачку уведомлений из очереди, у которых подошло время попытки.
+    Возвращает количество обработанных строк.
+    """
+    now = datetime.utcnow()
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(NotificationOutbox, Master.telegram_id, User.display_name)
+            .outerjoin(Master, Master.id == NotificationOutbox.master_id)
+            .outerjoin(User, User.telegram_id == NotificationOutbox.user_telegram_id)
+            .filter(
+                NotificationOutbox.sent_at.is_(None),
+                NotificationOutbox.next_attempt_at <= now,
+                NotificationOutbox.attempts < OUTBOX_MAX_ATTEMPTS
+            )
+            .order_by(NotificationOutbox.id)
+            .limit(batch_size)
         )
+        batch = result.all()
+
+        for notification, master_telegram_id, display_name in batch:
+            if master_telegram_id is None:
+                # Мастера удалили — доставлять некому
+                notification.sent_at = now
+                notification.last_error = "мастер не найден"
+                continue
+            if display_name:
+                username_cache.set(notification.user_telegram_id, display_name)
+            name = await get_username_by_telegram_id(notification.user_telegram_id, master_bot)
+            text = notification_text(notification.kind, notification.slot_time, notification.service_name, name)
+            try:
+                await master_bot.send_message(chat_id=master_telegram_id, text=text)
+                notification.sent_at = datetime.utcnow()
+            except TelegramRetryAfter as e:
+                # Telegram сам сообщает, когда можно повторить; попытку не засчитываем
+                notification.next_attempt_at = datetime.utcnow() + timedelta(seconds=e.retry_after)
+                notification.last_error = str(e)
+            except Exception as e:
+                notification.attempts += 1
+                notification.next_attempt_at = datetime.utcnow() + retry_delay(notification.attempts)
+                notification.last_error = str(e)
+                logging.warning("Не удалось отправить уведомление %s: %s", notification.id, e)
+
+        await session.commit()
+    return len(batch)
+
+
+async def notification_worker(master_bot, poll_interval=OUTBOX_POLL_INTERVAL):
+    """Фоновая задача бота мастеров: разбирает очередь уведомлений через одну сессию бота."""
+    while True:
         try:
-            await master_bot.send_message(chat_id=master_telegram_id, text=message)
-        except Exception as e:
-            pass
+            processed = await deliver_notifications(master_bot)
+        except Exception:
+            logging.exception("Ошибка при разборе очереди уведомлений")
+            processed = 0
+        # Полная пачка — в очереди, вероятно, есть ещё; иначе ждём новых уведомлений
+        if processed < OUTBOX_BATCH_SIZE:
+            await asyncio.sleep(poll_interval)
+
 
 async def start_polling(dp, master_bot):
     try:
@@ -89,7 +177,7 @@ async def start_polling(dp, master_bot):
         await master_bot.session.close()
 
 async def main():
-    async with Bot(token=API_TOKEN) as master_bot:
+    async with bot as master_bot:
         dp = Dispatcher()
 
         @dp.message(Command("start"))
@@ -145,8 +233,12 @@ async def main():
                 "Простите, но я еще не научился понимать Ваши сообщения, зато я могу уведомлять Вас о записях!"
             )
 
-        # Запуск бота
-        await start_polling(dp, master_bot)
+        # Запуск бота и обработчика очереди уведомлений
+        worker = asyncio.create_task(notification_worker(master_bot))
+        try:
+            await start_polling(dp, master_bot)
+        finally:
+            worker.cancel()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,10 @@
+from database import SessionLocal
+from utils.availability import migrate_slots_to_intervals
+
+# Переводит существующее расписание из 15-минутных строк timeslots в интервалы.
+# После миграции бот и сайт нужно запускать с AVAILABILITY_MODE=intervals.
+if __name__ == "__main__":
+    with SessionLocal() as session:
+        removed = migrate_slots_to_intervals(session)
+        session.commit()
+    print(f"Миграция завершена, удалено строк timeslots: {removed}")
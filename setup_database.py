@@ -1,8 +1,12 @@
 from sqlalchemy import create_engine
-from database import Base
+from database import Base, ensure_columns, ensure_indexes
 
 # Создаём подключение к базе данных
 engine = create_engine('sqlite:///database.db')
 
 # Создаём все таблицы в базе данных
-Base.metadata.create_all(engine)
\ No newline at end of file
+Base.metadata.create_all(engine)
+
+# Добавляем столбцы и индексы, которых нет в базах, созданных до их появления
+ensure_columns(engine)
+ensure_indexes(engine)
@@ -1,8 +1,30 @@
+import asyncio
+import itertools
+from datetime import datetime, timedelta, date
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, ANY
+
+import httpx
 import pytest
-from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
+import pytest_asyncio
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
-from unittest.mock import AsyncMock, MagicMock, ANY
-from datetime import datetime, timedelta
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import SendMessage, AnswerCallbackQuery
+from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
+from aiohttp.test_utils import TestServer, TestClient
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import main
+import utils.availability as availability
+from database import (
+    Base, Master, Service, User, TimeSlot, TimeSlotStatus, WorkShift, BookedInterval, AvailabilityChange,
+    Appointment, AppointmentStatus, Review, JobWatermark, SessionLocal, ensure_indexes,
+)
 from handlers.booking_handler import (
     date_selected_handler,
     confirm_booking_handler,
@@ -12,6 +34,37 @@ from handlers.booking_handler import (
     rate_handler,
     review_text_handler,
 )
+from handlers.general_handler import handle_unrecognized_message
+from handlers.services_handler import (
+    services_handler,
+    select_service_handler,
+    select_master_handler,
+    select_time_no_master_handler,
+    my_bookings_handler,
+    cancel_booking_handler,
+)
+from handlers.start_handler import first_interaction
+from states import BookingStates
+from utils import ttl_cache, rate_limiter, reminders, fsm_storage, catalog as catalog_module
+from utils.any_master import book_any_master
+from utils.availability_cache import (
+    AvailabilityCache,
+    run_starts,
+    bits_after,
+    find_day_slots,
+    prune_changes,
+    find_day_slots_page,
+)
+from utils.calendar import get_week_availability
+from utils.callbacks import Callback, CallbackRoutes, DATE, SLOT, callback_routes
+from utils.catalog import MasterLists
+from utils.completion import complete_past_appointments
+from utils.data_version import CATALOG, bump_data_version, MASTERS, get_data_versions
+from utils.fake_telegram import FakeTelegramSession, FakeTelegram
+from utils.fsm_storage import dump_data, load_data
+from utils.reminders import ReminderScheduler, reminder_worker
+from utils.user_queue import PerUserSerializer, DROPPED_CALLBACK_TEXT
+from utils.webhook import build_webhook_app, WEBHOOK_HANDLER
 
 @pytest.fixture
 def mock_state():
@@ -45,7 +98,7 @@ async def test_date_selected_handler(mock_callback_query, mock_state):
 
 @pytest.mark.asyncio
 async def test_confirm_booking_handler(mock_callback_query, mock_state):
-    mock_callback_query.data = "slot_1"
+    mock_callback_query.data = "slot_1_202412251000"
     mock_callback_query.from_user = MagicMock()
     mock_callback_query.from_user.id = 123
     mock_callback_query.message = AsyncMock()
@@ -60,7 +113,6 @@ async def test_confirm_booking_handler(mock_callback_query, mock_state):
     mock_callback_query.message.edit_text.assert_called()
 
 
-
 @pytest.mark.asyncio
 async def test_add_to_calendar(mock_callback_query, mock_state):
     mock_callback_query.data = "add_to_calendar"
@@ -133,7 +185,6 @@ async def test_save_booking(mock_callback_query, mock_state):
     mock_session.query().filter().all.return_value = [mock_slot, mock_slot]  # Достаточно слотов
 
     with pytest.MonkeyPatch.context() as mp:
-        from database import SessionLocal
         mp.setattr(SessionLocal, "__call__", lambda: mock_session)
 
         # Вызов тестируемой функции
@@ -144,17 +195,6 @@ async def test_save_booking(mock_callback_query, mock_state):
         assert mock_slot.status == "booked"
 
 
-from datetime import datetime, timedelta
-from unittest.mock import MagicMock, AsyncMock
-from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from handlers.booking_handler import date_selected_handler
-from aiogram.fsm.context import FSMContext
-from database import TimeSlot, TimeSlotStatus
-import pytest
-
-
-
-
 @pytest.mark.asyncio
 async def test_date_selected_handler_no_slots():
     mock_callback_query = MagicMock(spec=CallbackQuery)
@@ -174,7 +214,6 @@ async def test_date_selected_handler_no_slots():
     mock_session.query().filter().all.return_value = []  # No slots found
 
     with pytest.MonkeyPatch.context() as mp:
-        from database import SessionLocal
         mp.setattr(SessionLocal, "__call__", lambda: mock_session)
 
         await date_selected_handler(mock_callback_query, mock_state)
@@ -211,12 +250,6 @@ async def test_date_selected_handler_no_service_data():
             ]
         )
     )
-import pytest
-from unittest.mock import AsyncMock, MagicMock
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.context import FSMContext
-from handlers.general_handler import handle_unrecognized_message
-from database import Service
 
 
 @pytest.mark.asyncio
@@ -250,14 +283,6 @@ async def test_handle_unrecognized_message_with_service_selected():
     )
 
 
-
-import pytest
-from unittest.mock import AsyncMock, MagicMock
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.context import FSMContext
-from handlers.general_handler import handle_unrecognized_message
-
-
 @pytest.mark.asyncio
 async def test_handle_unrecognized_message_without_service_selected():
     # Создаем mock для Message
@@ -283,137 +308,972 @@ async def test_handle_unrecognized_message_without_service_selected():
     )
 
 
-
-from datetime import datetime, timedelta
-import pytest
-from unittest.mock import AsyncMock, MagicMock
-from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.context import FSMContext
-
-from handlers.services_handler import (
-    services_handler,
-    select_service_handler,
-    select_master_handler,
-    select_time_no_master_handler,
-    my_bookings_handler,
-    cancel_booking_handler
-)
-
-
 @pytest.mark.asyncio
-async def test_select_service_handler():
+async def test_select_service_handler(monkeypatch, async_memory_session):
+    async with async_memory_session() as session:
+        session.add(Service(id=1, name="Укладка", cost=1500, duration=120))
+        await session.commit()
+    monkeypatch.setattr("handlers.services_handler.service_catalog",
+                        catalog_module.ServiceCatalog(async_memory_session, check_interval=0))
+
     mock_callback_query = AsyncMock(spec=CallbackQuery)
     mock_callback_query.data = "service_1"
     mock_callback_query.message = AsyncMock()
-
-    mock_service = MagicMock()
-    mock_service.id = 1
-    mock_service.name = "Укладка"
-    mock_service.duration = 120
-
-    mock_session = MagicMock()
-    mock_session.query().filter().first.return_value = mock_service
-
     mock_state = AsyncMock(spec=FSMContext)
 
-    with pytest.MonkeyPatch.context() as mp:
-        from database import SessionLocal
-        mp.setattr(SessionLocal, "__call__", lambda: mock_session)
-
-        await select_service_handler(mock_callback_query, mock_state)
+    await select_service_handler(mock_callback_query, mock_state)
 
     mock_state.update_data.assert_called_once_with(
         service_id=1, service_name="Укладка", service_duration=120
     )
+    mock_state.set_state.assert_called_once_with(BookingStates.selecting_master)
+    mock_callback_query.message.edit_text.assert_called_once_with(
+        "Как вы хотите продолжить?",
+        reply_markup=InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="Выбрать мастера", callback_data="select_master")],
+                [InlineKeyboardButton(text="Выбрать время (мастер не важен)", callback_data="select_time_no_master")],
+                [InlineKeyboardButton(text="Назад", callback_data="back_to_menu")],
+            ]
+        )
+    )
 
 
 @pytest.mark.asyncio
-async def test_select_master_handler():
+async def test_select_master_handler(monkeypatch, async_memory_session):
+    async with async_memory_session() as session:
+        service = Service(id=1, name="Укладка", cost=1500, duration=120)
+        service.masters = [Master(id=1, name="Марина", login="m1", password="p", telegram_id="1"),
+                           Master(id=2, name="Ольга", login="m2", password="p", telegram_id="2",
+                                  total_rating=9, num_reviews=2)]
+        session.add(service)
+        await session.commit()
+    monkeypatch.setattr("handlers.services_handler.master_lists", MasterLists(async_memory_session, check_interval=0))
+
     mock_callback_query = AsyncMock(spec=CallbackQuery)
     mock_callback_query.message = AsyncMock()
     mock_callback_query.from_user = MagicMock()
     mock_callback_query.from_user.id = 123
-
-    mock_service = MagicMock()
-    mock_service.id = 1
-    mock_service.masters = [
-        MagicMock(id=1, name="Марина", rating=0),
-    ]
-
-    mock_session = MagicMock()
-    mock_session.query().filter().first.return_value = mock_service
-
     mock_state = AsyncMock(spec=FSMContext)
     mock_state.get_data.return_value = {"service_id": 1}
 
-    with pytest.MonkeyPatch.context() as mp:
-        from database import SessionLocal
-        mp.setattr(SessionLocal, "__call__", lambda: mock_session)
-
-        await select_master_handler(mock_callback_query, mock_state)
+    await select_master_handler(mock_callback_query, mock_state)
 
+    # Рейтинги посчитаны заранее при загрузке снимка, мастера идут в порядке id
     mock_callback_query.message.edit_text.assert_called_once_with(
         "Выберите мастера:",
         reply_markup=InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(text="Марина (Рейтинг: 0)", callback_data="master_1")],
+                [InlineKeyboardButton(text="Ольга (Рейтинг: 4.5)", callback_data="master_2")],
                 [InlineKeyboardButton(text="Назад", callback_data="service_1")],
                 [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
             ]
         )
     )
 
-from utils.booking import find_available_slots
-from datetime import datetime
-from unittest.mock import MagicMock
-from database import TimeSlotStatus
-
-def test_find_available_slots_with_valid_consecutive_slots():
-    slots = [
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 0), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 15), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 30), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 45), status=TimeSlotStatus.free, master_id=1),
+
+@pytest.fixture
+def memory_session():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(Master(id=1, name="Марина", login="m1", password="p", telegram_id="1"))
+    session.commit()
+    yield session
+    session.close()
+
+
+@pytest_asyncio.fixture
+async def async_memory_session():
+    """Фабрика асинхронных сессий к базе в памяти: все сессии видят одни и те же данные."""
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    await engine.dispose()
+
+
+def _day_quarters(day, hour_from=9, hour_to=12):
+    start = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour_from)
+    return [(start + timedelta(minutes=15 * i), TimeSlotStatus.free) for i in range((hour_to - hour_from) * 4)]
+
+
+@pytest.mark.parametrize("mode", ["slots", "intervals"])
+def test_availability_book_and_release(memory_session, monkeypatch, mode):
+    monkeypatch.setattr(availability, "AVAILABILITY_MODE", mode)
+    day = datetime(2030, 1, 10).date()
+    day_start = datetime(2030, 1, 10)
+    availability.replace_schedule(memory_session, 1, _day_quarters(day))
+    memory_session.commit()
+
+    free = availability.get_free_slots(memory_session, [1], day_start, day_start + timedelta(days=1))
+    assert len(free) == 12
+
+    anchor = availability.book_slots(memory_session, 1, datetime(2030, 1, 10, 10, 0), 60)
+    memory_session.commit()
+    assert anchor is not None
+    assert availability.book_slots(memory_session, 1, datetime(2030, 1, 10, 10, 30), 30) is None
+
+    windows = availability.get_free_windows(memory_session, [1], day_start, day_start + timedelta(days=1))
+    assert windows == [
+        (1, datetime(2030, 1, 10, 9, 0), datetime(2030, 1, 10, 10, 0)),
+        (1, datetime(2030, 1, 10, 11, 0), datetime(2030, 1, 10, 12, 0)),
+    ]
+
+    availability.release_slots(memory_session, 1, datetime(2030, 1, 10, 10, 0), 60)
+    memory_session.commit()
+    free = availability.get_free_slots(memory_session, [1], day_start, day_start + timedelta(days=1))
+    assert len(free) == 12
+
+
+@pytest.mark.parametrize("mode", ["slots", "intervals"])
+def test_book_appointment_is_all_or_nothing(memory_session, monkeypatch, mode):
+    monkeypatch.setattr(availability, "AVAILABILITY_MODE", mode)
+    day = datetime(2030, 1, 10).date()
+    day_start = datetime(2030, 1, 10)
+    availability.replace_schedule(memory_session, 1, _day_quarters(day))
+    memory_session.add_all([Service(id=1, name="Стрижка", cost=100, duration=60), User(id=1, telegram_id="7")])
+    memory_session.commit()
+
+    appointment = availability.book_appointment(memory_session, 1, 1, 1, datetime(2030, 1, 10, 10, 0), 60)
+    memory_session.commit()
+    assert appointment.timeslot.start_time == datetime(2030, 1, 10, 10, 0)
+
+    # Пересекается с уже занятым временем: ни одна четверть часа не должна остаться занятой
+    assert availability.book_appointment(memory_session, 1, 1, 1, datetime(2030, 1, 10, 9, 30), 60) is None
+    free = availability.get_free_slots(memory_session, [1], day_start, day_start + timedelta(days=1))
+    assert len(free) == 8
+    assert memory_session.query(Appointment).count() == 1
+
+
+@pytest.mark.parametrize("mode", ["slots", "intervals"])
+def test_cancel_appointment_frees_time_once(memory_session, monkeypatch, mode):
+    monkeypatch.setattr(availability, "AVAILABILITY_MODE", mode)
+    day = datetime(2030, 1, 10).date()
+    day_start = datetime(2030, 1, 10)
+    availability.replace_schedule(memory_session, 1, _day_quarters(day))
+    memory_session.add_all([Service(id=1, name="Стрижка", cost=100, duration=60), User(id=1, telegram_id="7")])
+    memory_session.commit()
+    appointment = availability.book_appointment(memory_session, 1, 1, 1, datetime(2030, 1, 10, 10, 0), 60)
+    memory_session.commit()
+
+    cancelled = availability.cancel_appointment(memory_session, appointment.id)
+    memory_session.commit()
+    assert cancelled == (1, datetime(2030, 1, 10, 10, 0), "Стрижка", "7")
+    assert len(availability.get_free_slots(memory_session, [1], day_start, day_start + timedelta(days=1))) == 12
+
+    # Повторная отмена не должна освобождать время, которое успел занять другой клиент
+    availability.book_appointment(memory_session, 1, 1, 1, datetime(2030, 1, 10, 10, 0), 60)
+    memory_session.commit()
+    assert availability.cancel_appointment(memory_session, appointment.id) is None
+    assert len(availability.get_free_slots(memory_session, [1], day_start, day_start + timedelta(days=1))) == 8
+
+def test_migrate_slots_to_intervals(memory_session, monkeypatch):
+    day = datetime(2030, 1, 10).date()
+    quarters = _day_quarters(day)
+    quarters[4] = (quarters[4][0], TimeSlotStatus.booked)
+    availability.replace_schedule(memory_session, 1, quarters)
+    memory_session.commit()
+
+    removed = availability.migrate_slots_to_intervals(memory_session)
+    memory_session.commit()
+
+    assert removed == 12
+    assert memory_session.query(TimeSlot).count() == 0
+    assert memory_session.query(WorkShift).count() == 1
+    booked = memory_session.query(BookedInterval).one()
+    assert (booked.start_time, booked.end_time) == (datetime(2030, 1, 10, 10, 0), datetime(2030, 1, 10, 10, 15))
+
+    # Повторный запуск не дублирует интервалы
+    assert availability.migrate_slots_to_intervals(memory_session) == 0
+
+    monkeypatch.setattr(availability, "AVAILABILITY_MODE", "intervals")
+    assert availability.get_schedule(memory_session, 1) == quarters
+
+
+def test_get_week_availability_single_query(memory_session, monkeypatch):
+    monkeypatch.setattr("utils.calendar.availability_cache", AvailabilityCache())
+    service = Service(id=1, name="Маникюр", cost=1000, duration=60)
+    master2 = Master(id=2, name="Анна", login="m2", password="p", telegram_id="2")
+    service.masters.extend([memory_session.get(Master, 1), master2])
+    memory_session.add_all([service, master2])
+    first_day = datetime(2030, 1, 7).date()
+    # У первого мастера окно только 45 минут, у второго — полноценное утро
+    availability.replace_schedule(memory_session, 1, _day_quarters(first_day, 9, 12)[:3])
+    availability.replace_schedule(memory_session, 2, _day_quarters(first_day + timedelta(days=2)))
+    memory_session.commit()
+
+    statements = []
+    event.listen(memory_session.get_bind(), "before_cursor_execute",
+                 lambda *args: statements.append(args[2]))
+
+    dates = get_week_availability(memory_session, 1, None, first_day, first_day + timedelta(days=6), 60)
+
+    assert dates == [first_day + timedelta(days=2)]
+    # Журнал изменений, мастера услуги и слоты всей недели
+    assert len(statements) == 3
+
+    statements.clear()
+    assert get_week_availability(memory_session, 1, None, first_day, first_day + timedelta(days=6), 60) == dates
+    assert statements == []
+
+
+def test_run_starts_bit_operations():
+    bitmap = 0b0111101110
+    assert run_starts(bitmap, 1) == bitmap
+    # Окна 1-3 и 5-8: тройки начинаются с битов 1, 5 и 6, четвёрка — только с бита 5
+    assert run_starts(bitmap, 3) == 0b0001100010
+    assert run_starts(bitmap, 4) == 0b0000100000
+    assert run_starts(bitmap, 5) == 0
+    day = datetime(2030, 1, 10).date()
+    assert bits_after(day, datetime(2030, 1, 10, 0, 20)) == ((1 << 96) - 1) & ~0b11
+    assert bits_after(day, datetime(2030, 1, 9, 12, 0)) == (1 << 96) - 1
+    assert bits_after(day, datetime(2030, 1, 11, 0, 0)) == 0
+
+
+def test_availability_cache_invalidation(memory_session):
+    day = datetime(2030, 1, 10).date()
+    availability.replace_schedule(memory_session, 1, _day_quarters(day, 9, 11))
+    memory_session.commit()
+    bot_cache = AvailabilityCache(sync_interval=0)
+    not_before = datetime(2030, 1, 1)
+
+    assert len(find_day_slots(bot_cache, memory_session, [1], day, 60, not_before)) == 5
+    assert len(find_day_slots(bot_cache, memory_session, [1], day, 60, not_before)) == 5
+    assert (bot_cache.hits, bot_cache.misses) == (1, 1)
+
+    # Изменение из другого процесса приходит через журнал availability_changes
+    availability.book_slots(memory_session, 1, datetime(2030, 1, 10, 9, 0), 60)
+    memory_session.add(AvailabilityChange(master_id=1, date=day))
+    memory_session.commit()
+
+    assert [slot.start_time for slot in find_day_slots(bot_cache, memory_session, [1], day, 60, not_before)] == [
+        datetime(2030, 1, 10, 10, 0)
+    ]
+    assert bot_cache.stats()["invalidations"] == 1
+
+
+def test_prune_changes_keeps_latest_and_cache_resets_on_gap(memory_session):
+    day = datetime(2030, 1, 10).date()
+    availability.replace_schedule(memory_session, 1, _day_quarters(day, 9, 11))
+    memory_session.add(AvailabilityChange(master_id=1, date=day, created_at=datetime(2030, 1, 1)))
+    memory_session.commit()
+    bot_cache = AvailabilityCache(sync_interval=0)
+    not_before = datetime(2030, 1, 1)
+    assert len(find_day_slots(bot_cache, memory_session, [1], day, 60, not_before)) == 5
+
+    # Изменения, которые этот процесс не успел прочитать, удалены очисткой журнала
+    availability.book_slots(memory_session, 1, datetime(2030, 1, 10, 9, 0), 60)
+    memory_session.add_all([
+        AvailabilityChange(master_id=1, date=day, created_at=datetime(2030, 1, 1, 0, 5)),
+        AvailabilityChange(master_id=1, date=day + timedelta(days=1), created_at=datetime(2030, 1, 1, 0, 10)),
+    ])
+    memory_session.commit()
+    assert prune_changes(memory_session, now=datetime(2030, 1, 2)) == 2
+    memory_session.commit()
+    # Последняя запись остаётся, чтобы номера изменений продолжали расти
+    assert [change.id for change in memory_session.query(AvailabilityChange)] == [3]
+
+    # По пропуску в номерах кэш понимает, что пропустил изменения, и сбрасывается целиком
+    assert [slot.start_time for slot in find_day_slots(bot_cache, memory_session, [1], day, 60, not_before)] == [
+        datetime(2030, 1, 10, 10, 0)
     ]
 
-    service_duration = 30
-    result = find_available_slots(slots, service_duration)
 
-    assert len(result) == 2  # Указываем, что ожидаем 2 слота
-    assert result[0].start_time == datetime(2024, 12, 25, 10, 0)
-    assert result[1].start_time == datetime(2024, 12, 25, 10, 30)
+def test_availability_cache_drops_past_dates(memory_session):
+    today = datetime.now().date()
+    bot_cache = AvailabilityCache(sync_interval=0)
+    bot_cache._bitmaps = {(1, today - timedelta(days=1)): 1, (1, today): 2, (1, today + timedelta(days=1)): 3}
+    bot_cache.sync(memory_session)
+    assert sorted(bot_cache._bitmaps) == [(1, today), (1, today + timedelta(days=1))]
+
+
+def _query_plans(session, run_queries):
+    # Выполняем запросы, перехватываем их SQL и смотрим план через EXPLAIN QUERY PLAN
+    executed = []
+    engine = session.get_bind()
+    listener = lambda conn, cursor, statement, params, context, many: executed.append((statement, params))
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        run_queries()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    connection = session.connection()
+    return [
+        " | ".join(row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", params))
+        for statement, params in executed
+    ]
 
 
+def test_hot_queries_use_indexes(memory_session):
+    start = datetime(2030, 1, 10)
+    plans = _query_plans(memory_session, lambda: [
+        availability.get_free_slots(memory_session, [1, 2], start, start + timedelta(days=7)),
+        availability.get_free_slots(memory_session, availability.candidate_masters(1), start, start + timedelta(days=7)),
+        memory_session.query(Appointment).filter(
+            Appointment.user_id == 1, Appointment.status != AppointmentStatus.cancelled
+        ).all(),
+        memory_session.query(Review).filter(Review.master_id == 1).all(),
+    ])
 
-def test_find_available_slots_with_different_masters():
-    slots = [
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 0), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 15), status=TimeSlotStatus.free, master_id=2),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 30), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 45), status=TimeSlotStatus.free, master_id=1),
-    ]
+    assert "COVERING INDEX ix_timeslots_master_status_start" in plans[0]
+    assert "COVERING INDEX ix_timeslots_master_status_start" in plans[1]
+    assert "ix_master_service_service_master" in plans[1]
+    assert "INDEX ix_appointments_user_status" in plans[2]
+    assert "INDEX ix_reviews_master" in plans[3]
+    assert not any("SCAN timeslots" in plan or "SCAN appointments" in plan or "SCAN reviews" in plan
+                   for plan in plans)
 
-    service_duration = 30
-    result = find_available_slots(slots, service_duration)
 
-    assert len(result) == 1  # Указываем, что доступен только один слот
-    assert result[0].start_time == datetime(2024, 12, 25, 10, 30)
+def test_ensure_indexes_on_existing_database():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX ix_timeslots_master_status_start")
 
+    ensure_indexes(engine)
+    ensure_indexes(engine)  # повторный вызов ничего не ломает
 
-def test_find_available_slots_with_multiple_available_slots():
-    slots = [
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 0), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 15), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 30), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 10, 45), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 11, 0), status=TimeSlotStatus.free, master_id=1),
-        MagicMock(start_time=datetime(2024, 12, 25, 11, 15), status=TimeSlotStatus.free, master_id=1),
+    with engine.connect() as connection:
+        names = {row[0] for row in connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "ix_timeslots_master_status_start" in names
+
+
+def test_ttl_cache_evicts_least_recently_used_and_expired(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ttl_cache.time, "monotonic", lambda: now[0])
+    cache = ttl_cache.TTLCache(maxsize=2, ttl=10)
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # вытесняет "b": к "a" обращались позже
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+    now[0] += 11
+    assert cache.get("a") is None
+    assert len(cache) == 1
+
+
+def test_token_bucket_spreads_bursts(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    bucket = rate_limiter.TokenBucket(rate=1, capacity=2)
+
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 1.0, 2.0]
+    now[0] = 10.0
+    assert bucket.reserve() == 0.0
+
+
+@pytest.mark.asyncio
+async def test_send_scheduler_retries_after_flood_limit(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(rate_limiter.asyncio, "sleep", fake_sleep)
+    method = SendMessage(chat_id=1, text="Напоминание")
+    make_request = AsyncMock(side_effect=[TelegramRetryAfter(method, "Flood control", 5), "ok"])
+    scheduler = rate_limiter.SendScheduler()
+
+    assert await scheduler(make_request, MagicMock(), method) == "ok"
+    assert make_request.await_count == 2
+    assert max(sleeps) == pytest.approx(5, abs=0.1)
+    stats = scheduler.stats()
+    assert (stats["sent"], stats["retries"], stats["queue_depth"]) == (1, 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_reminder_worker_sends_due_reminder_before_reload(monkeypatch, async_memory_session):
+
+    # Напоминание за 2 часа наступает, пока обработчик спит
+    start_time = datetime.utcnow() + timedelta(hours=2, seconds=0.3)
+    async with async_memory_session() as session:
+        session.add_all([
+            Master(id=1, name="Марина", login="m1", password="p", telegram_id="1"),
+            Service(id=1, name="Стрижка", cost=100, duration=60),
+            User(id=1, telegram_id="7"),
+            TimeSlot(id=1, master_id=1, start_time=start_time, status=TimeSlotStatus.booked),
+            Appointment(user_id=1, master_id=1, service_id=1, timeslot_id=1),
+        ])
+        await session.commit()
+    monkeypatch.setattr(reminders, "AsyncSessionLocal", async_memory_session)
+
+    scheduler = ReminderScheduler(offsets=(timedelta(hours=2),))
+    async with async_memory_session() as session:
+        assert await session.run_sync(scheduler.load) == 1
+    bot = MagicMock()
+    bot.send_message = AsyncMock()
+    # Часы обработчика убегают на час за вызов: перечитывание очереди положено на каждом пробуждении,
+    # в том числе на том, где напоминание уже наступило
+    clock = itertools.count(step=3600)
+    monkeypatch.setattr(reminders, "time", SimpleNamespace(monotonic=lambda: next(clock)))
+    worker = asyncio.create_task(reminder_worker(bot, scheduler, max_sleep=1, reload_interval=60))
+    try:
+        for _ in range(100):
+            if bot.send_message.await_count:
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        # Дожидаемся остановки, чтобы обработчик не держал соединение, пока база закрывается
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+    bot.send_message.assert_awaited_once_with(chat_id="7", text=ANY)
+
+
+def test_reminder_scheduler_fires_in_order_and_skips_cancelled():
+    scheduler = ReminderScheduler()
+    now = datetime(2030, 1, 1, 9, 0)
+    scheduler.add(1, datetime(2030, 1, 3, 12, 0), "Стрижка", "7", now)
+    scheduler.add(2, datetime(2030, 1, 2, 10, 0), "Маникюр", "8", now)
+    scheduler.add(3, datetime(2030, 1, 2, 11, 0), "Укладка", "9", now)
+    scheduler.remove(3)
+
+    assert scheduler.pop_due(datetime(2030, 1, 1, 9, 30)) == []
+    due = scheduler.pop_due(datetime(2030, 1, 2, 12, 0))
+    assert [(reminder.appointment_id, reminder.offset) for reminder in due] == [
+        (2, timedelta(hours=24)), (2, timedelta(hours=2)), (1, timedelta(hours=24))
     ]
+    assert scheduler.seconds_until_next(datetime(2030, 1, 3, 9, 0)) == 60
+    assert scheduler.seconds_until_next(datetime(2030, 1, 3, 9, 59, 30)) == 30
+
+
+def test_reminder_scheduler_load_uses_one_indexed_query(memory_session):
+    availability.replace_schedule(memory_session, 1, _day_quarters(datetime(2030, 1, 10).date()))
+    memory_session.add_all([Service(id=1, name="Стрижка", cost=100, duration=60), User(id=1, telegram_id="7")])
+    memory_session.commit()
+    availability.book_appointment(memory_session, 1, 1, 1, datetime(2030, 1, 10, 10, 0), 60)
+    memory_session.commit()
+
+    scheduler = ReminderScheduler()
+    plans = _query_plans(memory_session, lambda: scheduler.load(memory_session, datetime(2030, 1, 9, 11, 0)))
+
+    assert len(plans) == 1
+    assert "ix_timeslots_start" in plans[0]
+    assert "SCAN appointments" not in plans[0] and "SCAN timeslots" not in plans[0]
+    # Напоминание за сутки уже в прошлом, остаётся только за 2 часа
+    assert len(scheduler) == 1
+
+
+def test_complete_past_appointments_advances_watermark(memory_session):
+    availability.replace_schedule(memory_session, 1, _day_quarters(datetime(2030, 1, 10).date()))
+    memory_session.add_all([Service(id=1, name="Стрижка", cost=100, duration=60), User(id=1, telegram_id="7")])
+    memory_session.commit()
+    first = availability.book_appointment(memory_session, 1, 1, 1, datetime(2030, 1, 10, 9, 0), 60)
+    second = availability.book_appointment(memory_session, 1, 1, 1, datetime(2030, 1, 10, 11, 0), 60)
+    memory_session.commit()
+
+    plans = _query_plans(memory_session, lambda: complete_past_appointments(memory_session, datetime(2030, 1, 10, 12, 0)))
+    memory_session.commit()
+    assert (first.status, second.status) == (AppointmentStatus.completed, AppointmentStatus.scheduled)
+    assert memory_session.get(JobWatermark, "complete_appointments").value == datetime(2030, 1, 10, 10, 0)
+    assert any("ix_timeslots_start" in plan for plan in plans)
+
+    assert complete_past_appointments(memory_session, datetime(2030, 1, 10, 14, 0)) == 1
+    memory_session.commit()
+    assert second.status == AppointmentStatus.completed
+
+
+def test_fsm_data_serialization_is_compact_and_round_trips():
+    data = {"service_id": 2, "service_name": "Маникюр", "slot_time": datetime(2030, 1, 10, 10, 15),
+            "selected_date": datetime(2030, 1, 10).date()}
+
+    raw = dump_data(data)
+    assert raw == ('{"service_id":2,"service_name":"Маникюр","slot_time":{"$dt":"2030-01-10T10:15"},'
+                   '"selected_date":{"$d":"2030-01-10"}}')
+    assert load_data(raw) == data
+
+
+@pytest.mark.asyncio
+async def test_sqlite_fsm_storage_coalesces_writes_and_expires(monkeypatch, async_memory_session):
+
+    storage = fsm_storage.SQLiteStorage(async_memory_session, flush_interval=3600)
+    key = StorageKey(bot_id=1, chat_id=7, user_id=7)
+
+    await storage.update_data(key, {"service_id": 2})
+    await storage.update_data(key, {"slot_time": datetime(2030, 1, 10, 10, 0)})
+    await storage.set_state(key, BookingStates.confirming)
+    await storage.flush()
+    assert (storage.writes, storage.flushes) == (3, 1)
+
+    # Новый экземпляр (например, после перезапуска) читает состояние из базы
+    restarted = fsm_storage.SQLiteStorage(async_memory_session, flush_interval=3600)
+    assert await restarted.get_state(key) == BookingStates.confirming.state
+    assert await restarted.get_data(key) == {"service_id": 2, "slot_time": datetime(2030, 1, 10, 10, 0)}
+
+    # Брошенный сценарий записи через сутки забывается
+    monkeypatch.setattr(fsm_storage, "datetime", type("Later", (datetime,), {
+        "utcnow": classmethod(lambda cls: datetime.utcnow() + timedelta(days=2))
+    }))
+    assert await restarted.get_state(key) is None
+
+    await storage.close()
+    await restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_fsm_storage_retries_failed_flush_and_writes_through(async_memory_session):
+
+    key = StorageKey(bot_id=1, chat_id=7, user_id=7)
+    reader = fsm_storage.SQLiteStorage(async_memory_session, flush_interval=3600)
 
-    service_duration = 30
-    result = find_available_slots(slots, service_duration)
+    storage = fsm_storage.SQLiteStorage(async_memory_session, flush_interval=0.01)
+    write = storage._write
+    failures = [RuntimeError("database is locked")]
 
-    assert len(result) == 3  # Указываем, что доступны 3 начальных слота
-    assert result[0].start_time == datetime(2024, 12, 25, 10, 0)
-    assert result[1].start_time == datetime(2024, 12, 25, 10, 30)
-    assert result[2].start_time == datetime(2024, 12, 25, 11, 0)
+    async def flaky_write(*args):
+        if failures:
+            raise failures.pop()
+        await write(*args)
+
+    storage._write = flaky_write
+    await storage.update_data(key, {"service_id": 2})
+    # Первая запись упала, но без новых изменений изменения всё равно доходят до базы
+    for _ in range(100):
+        if storage.flushes:
+            break
+        await asyncio.sleep(0.01)
+    assert await reader.get_data(key) == {"service_id": 2}
+
+    # Сквозная запись: другой процесс видит изменение сразу после set_data
+    write_through = fsm_storage.SQLiteStorage(async_memory_session, flush_interval=0)
+    await write_through.update_data(key, {"master_id": 1})
+    assert await reader.get_data(key) == {"service_id": 2, "master_id": 1}
+
+    await storage.close()
+    await write_through.close()
+
+
+@pytest.mark.asyncio
+async def test_bounded_memory_storage_evicts_lru_and_idle(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(fsm_storage.time, "monotonic", lambda: now[0])
+    storage = fsm_storage.BoundedMemoryStorage(max_entries=2, idle_ttl=timedelta(minutes=10))
+    keys = [StorageKey(bot_id=1, chat_id=user, user_id=user) for user in (1, 2, 3)]
+
+    await storage.update_data(keys[0], {"service_id": 1})
+    await storage.update_data(keys[1], {"service_id": 2})
+    await storage.get_data(keys[0])
+    await storage.update_data(keys[2], {"service_id": 3})  # вытесняет keys[1]
+    assert await storage.get_data(keys[1]) == {}
+    assert await storage.get_data(keys[0]) == {"service_id": 1}
+    assert storage.stats()["evicted_lru"] == 1
+
+    now[0] = 11 * 60
+    assert await storage.get_data(keys[2]) == {}
+    assert storage.stats() == {"entries": 0, "approx_bytes": 0, "evicted_lru": 1, "evicted_idle": 2}
+
+    # После state.clear() пользователь не остаётся в памяти
+    await storage.update_data(keys[0], {"service_id": 1})
+    await storage.set_state(keys[0], None)
+    await storage.set_data(keys[0], {})
+    assert storage.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_service_catalog_reloads_only_after_version_bump(monkeypatch, async_memory_session):
+
+    async with async_memory_session() as session:
+        session.add(Service(id=1, name="Стрижка", cost=100, duration=60))
+        await session.commit()
+
+    statements = []
+    event.listen(async_memory_session.kw["bind"].sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    clock = [0.0]
+    monkeypatch.setattr(catalog_module.time, "monotonic", lambda: clock[0])
+    catalog = catalog_module.ServiceCatalog(async_memory_session, check_interval=5)
+
+    snapshot = await catalog.current()
+    assert snapshot.keyboard.inline_keyboard[0][0].callback_data == "service_1"
+    # Пока не прошёл интервал сверки, каталог отдаётся из памяти без запросов
+    statements.clear()
+    assert await catalog.current() is snapshot
+    assert statements == []
+
+    async with async_memory_session() as session:
+        session.add(Service(id=2, name="Укладка", cost=200, duration=30))
+        await session.run_sync(bump_data_version, CATALOG)
+        await session.commit()
+
+    # После изменения на сайте версия выросла — каталог перечитывается при ближайшей сверке
+    clock[0] = 6.0
+    assert (await catalog.get(2)).name == "Укладка"
+    # Сверка без изменений — один короткий запрос версии
+    clock[0] = 12.0
+    statements.clear()
+    assert (await catalog.current()).version == 1
+    assert len(statements) == 1
+    assert catalog.stats() == {"version": 1, "services": 2, "reloads": 2}
+
+
+@pytest.mark.asyncio
+async def test_display_name_refreshed_on_start_and_my_bookings(monkeypatch, async_memory_session):
+
+    async with async_memory_session() as session:
+        session.add(User(id=1, telegram_id="7", display_name="Аня"))
+        await session.commit()
+    monkeypatch.setattr("handlers.start_handler.AsyncSessionLocal", async_memory_session)
+    monkeypatch.setattr("handlers.services_handler.AsyncSessionLocal", async_memory_session)
+
+    async def display_names():
+        async with async_memory_session() as session:
+            return dict((await session.execute(select(User.telegram_id, User.display_name))).all())
+
+    message = AsyncMock()
+    message.from_user = SimpleNamespace(id=7, first_name="Анна", username="anna")
+    await first_interaction(message)
+    # Незнакомый пользователь на /start в базу не добавляется
+    message.from_user = SimpleNamespace(id=8, first_name="Ольга", username=None)
+    await first_interaction(message)
+    assert await display_names() == {"7": "Анна"}
+
+    callback_query = AsyncMock(spec=CallbackQuery)
+    callback_query.message = AsyncMock()
+    callback_query.from_user = SimpleNamespace(id=7, first_name=None, username="anna")
+    await my_bookings_handler(callback_query)
+    assert await display_names() == {"7": "anna"}
+
+
+@pytest.mark.asyncio
+async def test_master_lists_one_query_and_refresh_on_review(async_memory_session):
+
+    async with async_memory_session() as session:
+        service = Service(id=1, name="Стрижка", cost=100, duration=60)
+        service.masters = [Master(id=1, name="Марина", login="m1", password="p", telegram_id="1"),
+                           Master(id=2, name="Ольга", login="m2", password="p", telegram_id="2")]
+        session.add_all([service, User(id=1, telegram_id="7")])
+        await session.commit()
+
+    statements = []
+    event.listen(async_memory_session.kw["bind"].sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    lists = MasterLists(async_memory_session, check_interval=0)
+    buttons = await lists.buttons(1)
+    # Версия и все мастера всех услуг — два запроса, без отдельных запросов на мастера
+    assert len(statements) == 2
+    assert [row[0].text for row in buttons] == ["Марина (Рейтинг: 0)", "Ольга (Рейтинг: 0)"]
+    assert await lists.buttons(2) == []
+
+    async with async_memory_session() as session:
+        session.add(Review(user_id=1, master_id=2, rating=5, review_text="Отлично"))
+        await session.run_sync(bump_data_version, MASTERS)
+        await session.commit()
+
+    assert [master.rating for master in await lists.masters(1)] == [0, 5.0]
+    assert lists.stats() == {"version": 1, "reloads": 2, "services": 1}
+
+
+@pytest.mark.asyncio
+async def test_webhook_worker_pool_with_fake_telegram():
+
+    session = FakeTelegramSession()
+    bot = Bot(token="123456:ABCDEF", session=session)
+    dp = Dispatcher()
+    running, max_running = 0, 0
+
+    @dp.message()
+    async def echo(message: Message):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        await message.answer(message.text)
+
+    app = build_webhook_app(dp, bot, "/webhook", workers=3, secret_token="s3cret")
+    telegram = FakeTelegram()
+    async with TestClient(TestServer(app)) as client:
+        unauthorized = await client.post("/webhook", json=telegram.message("привет"))
+        assert unauthorized.status == 401
+
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+        responses = await asyncio.gather(*(
+            client.post("/webhook", json=telegram.message(f"сообщение {i}", user_id=100 + i), headers=headers)
+            for i in range(10)
+        ))
+        assert all(response.status == 200 for response in responses)
+        handler = app[WEBHOOK_HANDLER]
+        while handler.stats()["processed"] < 10:
+            await asyncio.sleep(0.01)
+
+    # Одновременно работает не больше обработчиков, чем задано
+    assert max_running == 3
+    assert sorted(method.text for method in session.sent()) == sorted(f"сообщение {i}" for i in range(10))
+    assert handler.stats()["failed"] == 0
+
+
+@pytest.mark.asyncio
+async def test_per_user_serializer_orders_updates_of_one_user():
+
+    bot = Bot(token="123456:ABCDEF", session=FakeTelegramSession())
+    dp = Dispatcher()
+    serializer = PerUserSerializer(max_pending=4)
+    dp.update.outer_middleware(serializer)
+    running = set()
+    overlapped = False
+
+    @dp.message()
+    async def collect(message: Message, state: FSMContext):
+        nonlocal overlapped
+        if running:
+            overlapped = True
+        running.add(message.from_user.id)
+        # Чтение и запись данных FSM разнесены во времени, как в настоящих хендлерах
+        texts = (await state.get_data()).get("texts", [])
+        await asyncio.sleep(0.01)
+        await state.update_data(texts=texts + [message.text])
+        running.discard(message.from_user.id)
+
+    telegram = FakeTelegram()
+    updates = [telegram.message(f"{user}-{i}", user_id=user) for i in range(5) for user in (1, 2)]
+    await asyncio.gather(*(dp.feed_raw_update(bot, update) for update in updates))
+
+    # Пользователи обрабатывались одновременно, но данные каждого не потеряны и идут по порядку
+    assert overlapped
+    for user in (1, 2):
+        data = await dp.fsm.get_context(bot, chat_id=user, user_id=user).get_data()
+        assert data["texts"] == [f"{user}-{i}" for i in range(4)]
+    assert serializer.stats()["dropped"] == 2
+    assert serializer.stats()["active_users"] == 0
+
+
+@pytest.mark.asyncio
+async def test_per_user_serializer_answers_dropped_callbacks():
+
+    session = FakeTelegramSession()
+    bot = Bot(token="123456:ABCDEF", session=session)
+    dp = Dispatcher()
+    dp.update.outer_middleware(PerUserSerializer(max_pending=1))
+    handled = []
+
+    @dp.callback_query()
+    async def slow(callback_query: CallbackQuery):
+        await asyncio.sleep(0.01)
+        handled.append(callback_query.data)
+
+    telegram = FakeTelegram()
+    await asyncio.gather(*(dp.feed_raw_update(bot, telegram.callback(f"tap_{i}", user_id=1)) for i in range(3)))
+
+    # Обработано только первое нажатие, на остальные бот ответил, а не оставил кнопку крутиться
+    assert handled == ["tap_0"]
+    answers = session.sent(AnswerCallbackQuery)
+    assert len(answers) == 2
+    assert all(answer.text == DROPPED_CALLBACK_TEXT for answer in answers)
+
+
+def test_callback_routes_resolve_by_prefix_and_reject_conflicts():
+
+    # Строки кнопок не изменились: старые сообщения в чатах продолжают работать
+    assert DATE.pack(day=date(2030, 1, 10), week_offset=-1) == "date_2030-01-10_-1"
+    assert SLOT.unpack("slot_3_203001101030") == (3, datetime(2030, 1, 10, 10, 30))
+
+    callback, handler = callback_routes.resolve("service_5")
+    assert handler.callback.__name__ == "select_service_handler"
+    assert callback.unpack("service_5").service_id == 5
+    assert callback_routes.resolve("services")[1].callback.__name__ == "services_handler"
+    assert callback_routes.resolve("select_master")[1].callback.__name__ == "select_master_handler"
+    assert callback_routes.resolve("noop") is None
+
+    routes = CallbackRoutes()
+    routes.add(Callback("rate", rating=int), lambda: None)
+    routes.add(Callback("ratings"), lambda: None)
+    with pytest.raises(ValueError):
+        routes.add(Callback("rate", rating=int), lambda: None)
+    with pytest.raises(ValueError):
+        routes.add(Callback("rate_all"), lambda: None)
+    # Более общий префикс, добавленный позже, тоже конфликт
+    routes.add(Callback("week_day", day=int), lambda: None)
+    with pytest.raises(ValueError):
+        routes.add(Callback("week", offset=int), lambda: None)
+
+
+@pytest.mark.asyncio
+async def test_callback_routes_dispatch_passes_parsed_payload():
+
+    routes = CallbackRoutes()
+    received = []
+
+    @routes.route(Callback("cancel_booking", appointment_id=int))
+    async def cancel(callback_query, state, payload=None):
+        received.append((payload.appointment_id, await state.get_state()))
+
+    dp = Dispatcher()
+    dp.include_router(routes.router)
+    bot = Bot(token="123456:ABCDEF", session=FakeTelegramSession())
+    telegram = FakeTelegram()
+    await dp.feed_raw_update(bot, telegram.callback("cancel_booking_42"))
+    await dp.feed_raw_update(bot, telegram.callback("cancel_booking_x"))
+    assert received == [(42, None)]
+
+
+def test_find_day_slots_page_walks_merged_slots_by_cursor(memory_session):
+
+    day = datetime(2030, 1, 10).date()
+    for master_id in (2, 3):
+        memory_session.add(Master(id=master_id, name=f"Мастер {master_id}", login=f"m{master_id}",
+                                  password="p", telegram_id=str(master_id)))
+    memory_session.flush()
+    availability.replace_schedule(memory_session, 1, _day_quarters(day, 9, 11))
+    availability.replace_schedule(memory_session, 2, _day_quarters(day, 10, 12))
+    availability.replace_schedule(memory_session, 3, _day_quarters(day, 9, 10))
+    memory_session.commit()
+    cache = AvailabilityCache(sync_interval=0)
+    not_before = datetime(2030, 1, 1)
+    everything = sorted(find_day_slots(cache, memory_session, [1, 2, 3], day, 60, not_before),
+                        key=lambda slot: (slot.start_time, slot.master_id))
+
+    pages, cursor, has_more = [], None, True
+    while has_more:
+        page, has_more = find_day_slots_page(cache, memory_session, [1, 2, 3], day, 60, not_before, cursor, limit=4)
+        assert len(page) <= 4
+        pages.append(page)
+        cursor = (page[-1].start_time, page[-1].master_id)
+
+    assert [slot for page in pages for slot in page] == everything
+    assert len(pages) == 3
+
+
+def test_find_day_slots_page_distinct_times_for_any_master(memory_session):
+
+    day = datetime(2030, 1, 10).date()
+    memory_session.add(Master(id=2, name="Ольга", login="m2", password="p", telegram_id="2"))
+    memory_session.flush()
+    availability.replace_schedule(memory_session, 1, _day_quarters(day, 9, 11))
+    availability.replace_schedule(memory_session, 2, _day_quarters(day, 10, 12))
+    memory_session.commit()
+    cache = AvailabilityCache(sync_interval=0)
+    not_before = datetime(2030, 1, 1)
+
+    times, cursor, has_more = [], None, True
+    while has_more:
+        page, has_more = find_day_slots_page(cache, memory_session, [1, 2], day, 60, not_before, cursor,
+                                             limit=3, distinct_times=True)
+        assert all(slot.master_id is None for slot in page)
+        times += [slot.start_time for slot in page]
+        cursor = (page[-1].start_time, None)
+
+    # 9:00–10:00 и 11:00 есть у одного мастера, 10:00–10:45 — у обоих, но показываются один раз
+    expected = [datetime(2030, 1, 10, 9, 0) + timedelta(minutes=15 * i) for i in range(9)]
+    assert times == expected
+
+
+@pytest.mark.parametrize("policy, expected_master", [("least_load", 3), ("rating", 2)])
+def test_book_any_master_assigns_free_master_by_policy(memory_session, policy, expected_master):
+
+    day = datetime(2030, 1, 10).date()
+    memory_session.add_all([
+        Master(id=2, name="Ольга", login="m2", password="p", telegram_id="2", total_rating=10, num_reviews=2),
+        Master(id=3, name="Анна", login="m3", password="p", telegram_id="3", total_rating=4, num_reviews=1),
+        Master(id=4, name="Вера", login="m4", password="p", telegram_id="4", total_rating=50, num_reviews=10),
+        Service(id=1, name="Стрижка", cost=100, duration=60), User(id=1, telegram_id="7"),
+    ])
+    memory_session.flush()
+    for master_id in (1, 2, 3):
+        availability.replace_schedule(memory_session, master_id, _day_quarters(day, 9, 13))
+    # У Веры в 10:00 нет смены, хоть рейтинг и лучший
+    availability.replace_schedule(memory_session, 4, _day_quarters(day, 12, 13))
+    memory_session.commit()
+    # Марина и Ольга уже заняты утром, у Анны записей нет
+    for master_id in (1, 2):
+        assert availability.book_appointment(memory_session, 1, master_id, 1, datetime(2030, 1, 10, 9, 0), 60)
+    memory_session.commit()
+
+    cache = AvailabilityCache(sync_interval=0)
+    appointment = book_any_master(memory_session, 1, 1, [1, 2, 3, 4], datetime(2030, 1, 10, 10, 0), 60,
+                                  policy=policy, cache=cache)
+    memory_session.commit()
+    assert appointment.master_id == expected_master
+
+
+@pytest.mark.parametrize("mode", ["slots", "intervals"])
+def test_find_nearest_start_skips_short_windows(memory_session, monkeypatch, mode):
+    monkeypatch.setattr(availability, "AVAILABILITY_MODE", mode)
+    memory_session.add(Master(id=2, name="Ольга", login="m2", password="p", telegram_id="2"))
+    # У первого мастера утром только полчаса, у второго час — но позже
+    availability.replace_schedule(memory_session, 1, _day_quarters(datetime(2030, 1, 10).date(), 9, 12))
+    availability.replace_schedule(memory_session, 2, _day_quarters(datetime(2030, 1, 10).date(), 10, 12))
+    memory_session.commit()
+    availability.book_slots(memory_session, 1, datetime(2030, 1, 10, 9, 30), 150)
+    memory_session.commit()
+
+    not_before = datetime(2030, 1, 10, 8, 0)
+    until = datetime(2030, 2, 1)
+    assert availability.find_nearest_start(memory_session, [1, 2], 30, not_before, until) == availability.FreeSlot(1, datetime(2030, 1, 10, 9, 0))
+    assert availability.find_nearest_start(memory_session, [1, 2], 60, not_before, until) == availability.FreeSlot(2, datetime(2030, 1, 10, 10, 0))
+    # Время начала строго позже not_before
+    assert availability.find_nearest_start(memory_session, [2], 60, datetime(2030, 1, 10, 10, 0), until) == \
+        availability.FreeSlot(2, datetime(2030, 1, 10, 10, 15))
+    assert availability.find_nearest_start(memory_session, [1, 2], 180, not_before, until) is None
+    assert availability.find_nearest_start(memory_session, [], 30, not_before, until) is None
+
+
+def test_find_nearest_start_scans_start_index(memory_session):
+    availability.replace_schedule(memory_session, 1, _day_quarters(datetime(2030, 1, 10).date()))
+    memory_session.commit()
+
+    plans = _query_plans(memory_session, lambda: availability.find_nearest_start(
+        memory_session, [1, 2, 3], 60, datetime(2030, 1, 10, 8, 0), datetime(2030, 2, 1)))
+    assert len(plans) == 1
+    # Строки идут по индексу времени; досортировка по мастеру — только внутри одного времени
+    assert "ix_timeslots_start" in plans[0] and "TEMP B-TREE FOR ORDER BY" not in plans[0]
+
+
+def test_get_data_versions_tracks_last_change(memory_session):
+    assert get_data_versions(memory_session, [MASTERS, CATALOG]) == ((0, 0), None)
+
+    bump_data_version(memory_session, MASTERS)
+    bump_data_version(memory_session, MASTERS)
+    memory_session.commit()
+    versions, updated_at = get_data_versions(memory_session, [MASTERS, CATALOG])
+    assert versions == (2, 0)
+    assert updated_at is not None and datetime.utcnow() - updated_at < timedelta(minutes=1)
+
+
+@pytest.mark.asyncio
+async def test_admin_masters_page_is_cached_by_data_version(async_memory_session):
+
+    async with async_memory_session() as session:
+        haircut = Service(id=1, name="Стрижка", cost=100, duration=60)
+        styling = Service(id=2, name="Укладка", cost=200, duration=30)
+        session.add_all([
+            Master(id=1, name="Марина", login="m1", password="p", telegram_id="1",
+                   total_rating=9, num_reviews=2, services=[haircut, styling]),
+            Master(id=2, name="Ольга", login="m2", password="p", telegram_id="2"),
+        ])
+        await session.run_sync(bump_data_version, MASTERS)
+        await session.commit()
+
+    async def get_test_db():
+        async with async_memory_session() as db:
+            yield db
+
+    main.app.dependency_overrides[main.get_db] = get_test_db
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            response = await client.get("/masters")
+            assert response.status_code == 200
+            assert response.headers["etag"] == '"masters-1-0"'
+            last_modified = response.headers["last-modified"]
+            # Мастера, их рейтинги и услуги собраны одним запросом
+            page = response.text
+            assert "Марина" in page and "Рейтинг: 4.5/5" in page
+            assert "Стрижка" in page and "Укладка" in page
+            assert "Ольга" in page and "Рейтинг: 0/5" in page
+
+            response = await client.get("/masters", headers={"If-None-Match": '"masters-1-0"'})
+            assert response.status_code == 304
+            assert response.headers["etag"] == '"masters-1-0"'
+            response = await client.get("/masters", headers={"If-Modified-Since": last_modified})
+            assert response.status_code == 304
+
+            # После изменения мастеров старая версия страницы уже не подходит
+            async with async_memory_session() as session:
+                await session.run_sync(bump_data_version, MASTERS)
+                await session.commit()
+            response = await client.get("/masters", headers={"If-None-Match": '"masters-1-0"'})
+            assert response.status_code == 200
+            assert response.headers["etag"] == '"masters-2-0"'
+    finally:
+        main.app.dependency_overrides.clear()
@@ -2,8 +2,9 @@ from datetime import datetime, timedelta
 from sqlalchemy.orm import sessionmaker
 from database import (
     Base, Service, Master, TimeSlot, Appointment, Review, Admin,
-    master_service_association, TimeSlotStatus, AppointmentStatus, User
+    master_service_association, TimeSlotStatus, AppointmentStatus, User, WorkShift, BookedInterval
 )
+from utils.availability import replace_schedule
 from sqlalchemy import create_engine
 
 # Настройка подключения к базе данных
@@ -17,6 +18,8 @@ def setup_test_data():
         # Очистка таблиц, кроме пользователей
         session.query(Appointment).delete()
         session.query(TimeSlot).delete()
+        session.query(WorkShift).delete()
+        session.query(BookedInterval).delete()
         session.query(master_service_association).delete()
         session.query(Master).delete()
         session.query(Service).delete()
@@ -50,18 +53,16 @@ def setup_test_data():
         next_week_end = next_week_start + timedelta(days=6)
 
         for master in session.query(Master).all():
+            quarters = []
             current_date = next_week_start
             while current_date <= next_week_end + timedelta(days=14):
                 current_time = current_date.replace(hour=9, minute=0, second=0, microsecond=0)
                 end_time = current_date.replace(hour=19, minute=0, second=0, microsecond=0)
                 while current_time < end_time:
-                    session.add(TimeSlot(
-                        master_id=master.id,
-                        start_time=current_time,
-                        status=TimeSlotStatus.free
-                    ))
+                    quarters.append((current_time, TimeSlotStatus.free))
                     current_time += timedelta(minutes=15)
                 current_date += timedelta(days=1)
+            replace_schedule(session, master.id, quarters)
         session.commit()
 
         # Добавление администратора
@@ -0,0 +1,13 @@
+import pytest
+
+import master_bot
+
+
+@pytest.fixture(autouse=True)
+def clear_resolver_caches():
+    # Тесты используют одни и те же telegram_id с разными ответами Telegram
+    master_bot.username_cache.clear()
+    master_bot.master_chat_cache.clear()
+    yield
+    master_bot.username_cache.clear()
+    master_bot.master_chat_cache.clear()
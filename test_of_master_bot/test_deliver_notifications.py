@@ -0,0 +1,67 @@
+import pytest
+import pytest_asyncio
+from datetime import datetime
+from unittest.mock import AsyncMock, patch
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from database import Base, Master, NotificationOutbox, NotificationKind
+from master_bot import deliver_notifications
+
+
+@pytest_asyncio.fixture
+async def outbox_session_maker():
+    # Отдельная база в памяти, чтобы не трогать database.db
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_maker() as session:
+        session.add(Master(id=1, name="Test Master", login="m1", password="p", telegram_id="12345"))
+        session.add(NotificationOutbox(
+            kind=NotificationKind.booking, master_id=1, user_telegram_id="123456789",
+            slot_time=datetime(2024, 12, 22, 15, 0), service_name="Test Service"
+        ))
+        await session.commit()
+    yield session_maker
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications_success(outbox_session_maker):
+    mock_bot = AsyncMock()
+    with patch("master_bot.async_session_maker", outbox_session_maker):
+        with patch("master_bot.get_username_by_telegram_id", return_value="Test User"):
+            assert await deliver_notifications(mock_bot) == 1
+            # Доставленное уведомление больше не отправляется
+            assert await deliver_notifications(mock_bot) == 0
+
+    mock_bot.send_message.assert_awaited_once_with(
+        chat_id="12345",
+        text=(
+            "У вас новая запись на 22-12 15:00\n"
+            "Услуга: Test Service\n"
+            "Клиент: Test User"
+        )
+    )
+    async with outbox_session_maker() as session:
+        notification = await session.get(NotificationOutbox, 1)
+        assert notification.sent_at is not None
+
+
+@pytest.mark.asyncio
+async def test_deliver_notifications_send_message_error(outbox_session_maker):
+    mock_bot = AsyncMock()
+    mock_bot.send_message.side_effect = Exception("Telegram API error")
+    with patch("master_bot.async_session_maker", outbox_session_maker):
+        with patch("master_bot.get_username_by_telegram_id", return_value="Test User"):
+            assert await deliver_notifications(mock_bot) == 1
+            # Повторная попытка будет только после задержки
+            assert await deliver_notifications(mock_bot) == 0
+
+    async with outbox_session_maker() as session:
+        notification = await session.get(NotificationOutbox, 1)
+        assert notification.sent_at is None
+        assert notification.attempts == 1
+        assert notification.next_attempt_at > datetime.utcnow()
+        assert notification.last_error == "Telegram API error"
@@ -51,3 +51,32 @@ async def test_get_username_by_telegram_id_with_no_name_or_username():
     with patch("aiogram.Bot.get_chat_member", mock_get_chat_member):
         username = await get_username_by_telegram_id(12345)
         assert username == "12345"
+
+
+@pytest.mark.asyncio
+async def test_get_username_by_telegram_id_is_cached():
+    mock_user = User(id=12345, is_bot=False, first_name="Fedya", username=None)
+    mock_get_chat_member = AsyncMock(return_value=ChatMember(user=mock_user, status="member"))
+
+    with patch("aiogram.Bot.get_chat_member", mock_get_chat_member):
+        assert await get_username_by_telegram_id(12345) == "Fedya"
+        assert await get_username_by_telegram_id(12345) == "Fedya"
+
+    # Повторное уведомление о том же клиенте не обращается к Telegram
+    mock_get_chat_member.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_get_username_by_telegram_id_uses_rate_limited_bot():
+    import master_bot
+    from utils.rate_limiter import SendScheduler
+
+    mock_user = User(id=12345, is_bot=False, first_name="Fedya", username=None)
+    mock_get_chat_member = AsyncMock(return_value=ChatMember(user=mock_user, status="member"))
+
+    with patch.object(master_bot.bot, "get_chat_member", mock_get_chat_member):
+        assert await get_username_by_telegram_id(12345) == "Fedya"
+
+    # Запрос ушёл через общий бот, у которого стоит ограничитель частоты
+    mock_get_chat_member.assert_awaited_once_with(12345, 12345)
+    assert any(isinstance(middleware, SendScheduler) for middleware in master_bot.bot.session.middleware)
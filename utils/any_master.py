@@ -0,0 +1,68 @@
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from database import Appointment, AppointmentStatus, Master, TimeSlot
+from utils.availability import book_appointment, SLOT_MINUTES
+from utils.availability_cache import availability_cache, run_starts
+
+# Кого назначать, когда клиенту не важен мастер: least_load — мастера с наименьшим
+# числом записей в этот день, rating — мастера с лучшим рейтингом
+ASSIGN_POLICY = os.getenv("ANY_MASTER_POLICY", "least_load")
+
+
+def free_masters(session, master_ids, start_time, duration, cache=availability_cache):
+    """Мастера из master_ids, у которых [start_time, start_time + duration) свободно по маскам кэша."""
+    day = start_time.date()
+    bitmaps = cache.get_bitmaps(session, master_ids, [day])
+    quarter = (start_time - datetime.combine(day, datetime.min.time())) // timedelta(minutes=SLOT_MINUTES)
+    required_slots = duration // SLOT_MINUTES
+    return [
+        master_id for master_id in master_ids
+        if run_starts(bitmaps[(master_id, day)], required_slots) >> quarter & 1
+    ]
+
+
+def order_masters(session, master_ids, day, policy=ASSIGN_POLICY):
+    """Мастера в порядке предпочтения для назначения; при равенстве — по id."""
+    if not master_ids:
+        return []
+    if policy == "rating":
+        ratings = {
+            master_id: total_rating / num_reviews if num_reviews > 0 else 0
+            for master_id, total_rating, num_reviews in session.execute(
+                select(Master.id, Master.total_rating, Master.num_reviews).where(Master.id.in_(master_ids))
+            )
+        }
+        return sorted(master_ids, key=lambda master_id: (-ratings.get(master_id, 0), master_id))
+
+    day_start = datetime.combine(day, datetime.min.time())
+    loads = dict(session.execute(
+        select(Appointment.master_id, func.count())
+        .join(Appointment.timeslot)
+        .where(
+            Appointment.master_id.in_(master_ids),
+            Appointment.status == AppointmentStatus.scheduled,
+            TimeSlot.start_time >= day_start,
+            TimeSlot.start_time < day_start + timedelta(days=1)
+        )
+        .group_by(Appointment.master_id)
+    ).all())
+    return sorted(master_ids, key=lambda master_id: (loads.get(master_id, 0), master_id))
+
+
+def book_any_master(session, user_id, service_id, master_ids, start_time, duration, policy=ASSIGN_POLICY,
+                    cache=availability_cache):
+    """
+    Записывает клиента к одному из мастеров, свободных в start_time, в порядке policy.
+    Если время у мастера успели занять, пробует следующего. Возвращает Appointment или None.
+    Неудачная попытка откатывает транзакцию, поэтому всё остальное должно быть сохранено заранее.
+    """
+    free = free_masters(session, master_ids, start_time, duration, cache)
+    candidates = order_masters(session, free, start_time.date(), policy)
+    for master_id in candidates:
+        appointment = book_appointment(session, user_id, master_id, service_id, start_time, duration)
+        if appointment is not None:
+            return appointment
+    return None
@@ -0,0 +1,423 @@
+import os
+from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, insert, literal
+
+from database import (
+    TimeSlot, TimeSlotStatus, WorkShift, BookedInterval, Appointment, Service, User, master_service_association
+)
+
+# Режим хранения расписания:
+#   slots     — каждая четверть часа отдельной строкой в timeslots (как было изначально)
+#   intervals — смены и занятость хранятся диапазонами в work_shifts / booked_intervals
+AVAILABILITY_MODE = os.getenv("AVAILABILITY_MODE", "slots")
+
+SLOT_MINUTES = 15
+SLOT_STEP = timedelta(minutes=SLOT_MINUTES)
+
+# Свободная четверть часа мастера. Хендлеры работают только с этим представлением,
+# поэтому им всё равно, в каком режиме хранится расписание.
+FreeSlot = namedtuple("FreeSlot", ["master_id", "start_time", "status"], defaults=[TimeSlotStatus.free])
+# Данные отменённой записи, нужные для уведомления мастера после коммита
+CancelledAppointment = namedtuple("CancelledAppointment", ["master_id", "start_time", "service_name", "user_telegram_id"])
+
+
+def use_intervals():
+    return AVAILABILITY_MODE == "intervals"
+
+
+def collapse_to_ranges(starts):
+    """Склеивает отсортированные начала четвертей часа в диапазоны [start, end)."""
+    ranges = []
+    for start in starts:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = start + SLOT_STEP
+        elif not ranges or ranges[-1][1] < start:
+            ranges.append([start, start + SLOT_STEP])
+    return [(start, end) for start, end in ranges]
+
+
+def _subtract_ranges(ranges, busy):
+    # ranges и busy отсортированы по началу; возвращает части ranges, не покрытые busy
+    result = []
+    for start, end in ranges:
+        cursor = start
+        for busy_start, busy_end in busy:
+            if busy_end <= cursor or busy_start >= end:
+                continue
+            if busy_start > cursor:
+                result.append((cursor, busy_start))
+            cursor = max(cursor, busy_end)
+            if cursor >= end:
+                break
+        if cursor < end:
+            result.append((cursor, end))
+    return result
+
+
+def candidate_masters(service_id, master_id=None):
+    """
+    Мастера для поиска слотов: выбранный мастер или подзапрос по всем мастерам услуги.
+    Подзапрос встраивается в запрос слотов, так что мастера и слоты читаются за один раз.
+    """
+    if master_id is not None:
+        return [master_id]
+    return select(master_service_association.c.master_id).where(
+        master_service_association.c.service_id == service_id
+    )
+
+
+def _is_empty(master_ids):
+    return isinstance(master_ids, (list, tuple, set, frozenset)) and not master_ids
+
+
+def _iter_quarters(start, end):
+    current = start
+    while current < end:
+        yield current
+        current += SLOT_STEP
+
+
+def get_free_windows(session, master_ids, start, end):
+    """Свободные окна мастеров в [start, end) — список (master_id, start, end) по (master_id, start)."""
+    if _is_empty(master_ids):
+        return []
+
+    if not use_intervals():
+        rows = session.query(TimeSlot.master_id, TimeSlot.start_time).filter(
+            TimeSlot.master_id.in_(master_ids),
+            TimeSlot.start_time >= start,
+            TimeSlot.start_time < end,
+            TimeSlot.status == TimeSlotStatus.free
+        ).order_by(TimeSlot.master_id, TimeSlot.start_time).all()
+        starts_by_master = defaultdict(list)
+        for master_id, start_time in rows:
+            starts_by_master[master_id].append(start_time)
+        return [
+            (master_id, window_start, window_end)
+            for master_id in sorted(starts_by_master)
+            for window_start, window_end in collapse_to_ranges(starts_by_master[master_id])
+        ]
+
+    shifts = session.query(WorkShift.master_id, WorkShift.start_time, WorkShift.end_time).filter(
+        WorkShift.master_id.in_(master_ids),
+        WorkShift.start_time < end,
+        WorkShift.end_time > start
+    ).order_by(WorkShift.master_id, WorkShift.start_time).all()
+    booked = session.query(BookedInterval.master_id, BookedInterval.start_time, BookedInterval.end_time).filter(
+        BookedInterval.master_id.in_(master_ids),
+        BookedInterval.start_time < end,
+        BookedInterval.end_time > start
+    ).order_by(BookedInterval.master_id, BookedInterval.start_time).all()
+
+    shifts_by_master = defaultdict(list)
+    for master_id, shift_start, shift_end in shifts:
+        shifts_by_master[master_id].append((max(shift_start, start), min(shift_end, end)))
+    booked_by_master = defaultdict(list)
+    for master_id, booked_start, booked_end in booked:
+        booked_by_master[master_id].append((booked_start, booked_end))
+
+    return [
+        (master_id, window_start, window_end)
+        for master_id in sorted(shifts_by_master)
+        for window_start, window_end in _subtract_ranges(shifts_by_master[master_id], booked_by_master[master_id])
+    ]
+
+
+def get_free_slots(session, master_ids, start, end):
+    """
+    Свободные четверти часа мастеров в [start, end), упорядоченные по (master_id, start_time).
+    master_ids — список id или подзапрос из candidate_masters.
+    """
+    if _is_empty(master_ids):
+        return []
+
+    if not use_intervals():
+        rows = session.query(TimeSlot.master_id, TimeSlot.start_time).filter(
+            TimeSlot.master_id.in_(master_ids),
+            TimeSlot.start_time >= start,
+            TimeSlot.start_time < end,
+            TimeSlot.status == TimeSlotStatus.free
+        ).order_by(TimeSlot.master_id, TimeSlot.start_time).all()
+        return [FreeSlot(master_id, start_time) for master_id, start_time in rows]
+
+    return [
+        FreeSlot(master_id, quarter)
+        for master_id, window_start, window_end in get_free_windows(session, master_ids, start, end)
+        for quarter in _iter_quarters(window_start, window_end)
+    ]
+
+
+def find_nearest_start(session, master_ids, duration, not_before, until):
+    """
+    Самое раннее время начала позже not_before (и раньше until), с которого у кого-то из мастеров
+    свободно duration минут подряд. Возвращает FreeSlot или None.
+    В режиме slots — один проход по индексу времени начала: строки читаются по мере продвижения
+    и чтение прекращается на первом подходящем окне.
+    """
+    if _is_empty(master_ids):
+        return None
+    required_slots = duration // SLOT_MINUTES
+
+    if not use_intervals():
+        rows = session.execute(
+            select(TimeSlot.master_id, TimeSlot.start_time)
+            .where(
+                TimeSlot.start_time > not_before,
+                TimeSlot.start_time < until,
+                TimeSlot.status == TimeSlotStatus.free,
+                # «+ 0» не даёт планировщику взять индекс по мастеру: тогда строки пришлось бы
+                # сортировать целиком, а по индексу времени они идут уже в нужном порядке
+                (TimeSlot.master_id + 0).in_(master_ids)
+            )
+            .order_by(TimeSlot.start_time, TimeSlot.master_id)
+            .execution_options(yield_per=256)
+        )
+        # Текущее окно каждого мастера: (начало, последняя четверть, число четвертей)
+        runs = {}
+        try:
+            for master_id, start_time in rows:
+                run = runs.get(master_id)
+                if run is not None and run[1] + SLOT_STEP == start_time:
+                    run = (run[0], start_time, run[2] + 1)
+                else:
+                    run = (start_time, start_time, 1)
+                if run[2] >= required_slots:
+                    return FreeSlot(master_id, run[0])
+                runs[master_id] = run
+        finally:
+            rows.close()
+        return None
+
+    # Окна в интервальном режиме уже собраны из смен и занятых интервалов
+    earliest = None
+    for master_id, window_start, window_end in get_free_windows(session, master_ids, not_before, until):
+        # Начало выравнивается на четверть часа строго после not_before
+        offset = (window_start - datetime.min) % SLOT_STEP
+        start = window_start + (SLOT_STEP - offset if offset else timedelta(0))
+        if start == not_before:
+            start += SLOT_STEP
+        if start + timedelta(minutes=duration) <= window_end and (earliest is None or start < earliest.start_time):
+            earliest = FreeSlot(master_id, start)
+    return earliest
+
+
+def get_schedule(session, master_id):
+    """Все рабочие четверти часа мастера со статусами — список (start_time, TimeSlotStatus)."""
+    if not use_intervals():
+        rows = session.query(TimeSlot.start_time, TimeSlot.status).filter(
+            TimeSlot.master_id == master_id
+        ).order_by(TimeSlot.start_time).all()
+        return [(start_time, status) for start_time, status in rows]
+
+    statuses = {}
+    for shift in session.query(WorkShift).filter(WorkShift.master_id == master_id).all():
+        for quarter in _iter_quarters(shift.start_time, shift.end_time):
+            statuses[quarter] = TimeSlotStatus.free
+    for interval in session.query(BookedInterval).filter(BookedInterval.master_id == master_id).all():
+        for quarter in _iter_quarters(interval.start_time, interval.end_time):
+            statuses[quarter] = TimeSlotStatus.booked
+    return sorted(statuses.items())
+
+
+def replace_schedule(session, master_id, quarters, start=None, end=None):
+    """
+    Заменяет расписание мастера в [start, end) (или целиком, если границы не заданы)
+    на quarters — список (start_time, TimeSlotStatus).
+    """
+    if not use_intervals():
+        query = session.query(TimeSlot).filter(TimeSlot.master_id == master_id)
+        if start is not None:
+            query = query.filter(TimeSlot.start_time >= start, TimeSlot.start_time < end)
+        query.delete()
+        for start_time, status in quarters:
+            session.add(TimeSlot(master_id=master_id, start_time=start_time, status=status))
+        return
+
+    # В интервальном режиме якорные слоты записей не трогаем: на них ссылаются appointments
+    for model in (WorkShift, BookedInterval):
+        query = session.query(model).filter(model.master_id == master_id)
+        if start is not None:
+            query = query.filter(model.start_time >= start, model.start_time < end)
+        query.delete()
+
+    quarters = sorted(quarters)
+    for shift_start, shift_end in collapse_to_ranges(q for q, _ in quarters):
+        session.add(WorkShift(master_id=master_id, start_time=shift_start, end_time=shift_end))
+    booked = (q for q, status in quarters if status == TimeSlotStatus.booked)
+    for booked_start, booked_end in collapse_to_ranges(booked):
+        session.add(BookedInterval(master_id=master_id, start_time=booked_start, end_time=booked_end))
+
+
+def book_slots(session, master_id, start_time, duration):
+    """
+    Занимает [start_time, start_time + duration) у мастера одним условным запросом.
+    Возвращает id якорного TimeSlot для Appointment.timeslot_id или None, если время уже занято;
+    в этом случае транзакция сессии откатывается.
+    """
+    end_time = start_time + timedelta(minutes=duration)
+
+    if not use_intervals():
+        # Свободные слоты переводятся в booked только если заняты все нужные четверти часа:
+        # одновременная запись на то же время обновит меньше строк и откатится
+        required_slots = duration // SLOT_MINUTES
+        claimed = session.execute(
+            update(TimeSlot).where(
+                TimeSlot.master_id == master_id,
+                TimeSlot.start_time >= start_time,
+                TimeSlot.start_time < end_time,
+                TimeSlot.status == TimeSlotStatus.free
+            ).values(status=TimeSlotStatus.booked).returning(TimeSlot.id, TimeSlot.start_time),
+            execution_options={"synchronize_session": False}
+        ).all()
+        anchor_id = next((slot_id for slot_id, slot_start in claimed if slot_start == start_time), None)
+        if len(claimed) < required_slots or anchor_id is None:
+            session.rollback()
+            return None
+        return anchor_id
+
+    # Интервал вставляется, только если он целиком внутри смены и ни с чем не пересекается
+    covered = select(WorkShift.id).where(
+        WorkShift.master_id == master_id,
+        WorkShift.start_time <= start_time,
+        WorkShift.end_time >= end_time
+    ).exists()
+    overlaps = select(BookedInterval.id).where(
+        BookedInterval.master_id == master_id,
+        BookedInterval.start_time < end_time,
+        BookedInterval.end_time > start_time
+    ).exists()
+    inserted = session.execute(
+        insert(BookedInterval).from_select(
+            ["master_id", "start_time", "end_time"],
+            select(
+                literal(master_id),
+                literal(start_time, BookedInterval.start_time.type),
+                literal(end_time, BookedInterval.end_time.type)
+            ).where(covered, ~overlaps)
+        )
+    )
+    if inserted.rowcount != 1:
+        session.rollback()
+        return None
+    return session.execute(
+        insert(TimeSlot).values(master_id=master_id, start_time=start_time, status=TimeSlotStatus.booked)
+        .returning(TimeSlot.id)
+    ).scalar_one()
+
+
+def book_appointment(session, user_id, master_id, service_id, start_time, duration):
+    """
+    Занимает время и создаёт запись в одной транзакции.
+    Возвращает Appointment или None, если время уже занято (транзакция при этом откатывается).
+    """
+    timeslot_id = book_slots(session, master_id, start_time, duration)
+    if timeslot_id is None:
+        return None
+    appointment = Appointment(
+        user_id=user_id,
+        master_id=master_id,
+        service_id=service_id,
+        timeslot_id=timeslot_id,
+        status="scheduled"
+    )
+    session.add(appointment)
+    return appointment
+
+
+def release_slots(session, master_id, start_time, duration):
+    """Освобождает [start_time, start_time + duration) у мастера."""
+    end_time = start_time + timedelta(minutes=duration)
+
+    if not use_intervals():
+        session.execute(
+            update(TimeSlot).where(
+                TimeSlot.master_id == master_id,
+                TimeSlot.start_time >= start_time,
+                TimeSlot.start_time < end_time,
+                TimeSlot.status == TimeSlotStatus.booked
+            ).values(status=TimeSlotStatus.free),
+            execution_options={"synchronize_session": False}
+        )
+        return
+
+    # Вычитаем диапазон из занятых интервалов, оставляя непокрытые края
+    overlapping = session.query(BookedInterval).filter(
+        BookedInterval.master_id == master_id,
+        BookedInterval.start_time < end_time,
+        BookedInterval.end_time > start_time
+    ).all()
+    for interval in overlapping:
+        if interval.start_time < start_time:
+            session.add(BookedInterval(master_id=master_id, start_time=interval.start_time, end_time=start_time))
+        if interval.end_time > end_time:
+            session.add(BookedInterval(master_id=master_id, start_time=end_time, end_time=interval.end_time))
+        session.delete(interval)
+
+
+def cancel_appointment(session, appointment_id):
+    """
+    Отменяет запись и освобождает её время в текущей транзакции, не загружая объекты в сессию.
+    Возвращает CancelledAppointment для уведомлений или None, если запись не найдена или уже отменена.
+    """
+    row = session.execute(
+        select(
+            Appointment.master_id, TimeSlot.start_time, Service.duration, Service.name, User.telegram_id
+        ).join(Appointment.timeslot).join(Appointment.service).join(Appointment.user).where(
+            Appointment.id == appointment_id,
+            Appointment.status != "cancelled"
+        )
+    ).first()
+    if row is None:
+        return None
+
+    # Условие на статус защищает от двойной отмены: иначе второй запрос освободил бы время,
+    # которое к этому моменту мог занять другой клиент
+    cancelled = session.execute(
+        update(Appointment).where(
+            Appointment.id == appointment_id,
+            Appointment.status != "cancelled"
+        ).values(status="cancelled"),
+        execution_options={"synchronize_session": False}
+    )
+    if cancelled.rowcount != 1:
+        return None
+
+    master_id, start_time, duration, service_name, user_telegram_id = row
+    release_slots(session, master_id, start_time, duration)
+    return CancelledAppointment(master_id, start_time, service_name, user_telegram_id)
+
+
+def migrate_slots_to_intervals(session):
+    """
+    Схлопывает строки timeslots в смены и занятые интервалы.
+    Мастера, у которых уже есть смены, пропускаются, поэтому миграцию можно запускать повторно.
+    Возвращает количество удалённых строк timeslots.
+    """
+    migrated_masters = {master_id for (master_id,) in session.query(WorkShift.master_id).distinct()}
+    anchor_ids = {timeslot_id for (timeslot_id,) in session.query(Appointment.timeslot_id)}
+
+    rows = session.query(TimeSlot.id, TimeSlot.master_id, TimeSlot.start_time, TimeSlot.status).order_by(
+        TimeSlot.master_id, TimeSlot.start_time
+    ).yield_per(1000)
+
+    quarters_by_master = defaultdict(list)
+    obsolete_ids = []
+    for slot_id, master_id, start_time, status in rows:
+        if master_id in migrated_masters:
+            continue
+        quarters_by_master[master_id].append((start_time, status))
+        if slot_id not in anchor_ids:
+            obsolete_ids.append(slot_id)
+
+    for master_id, quarters in quarters_by_master.items():
+        for shift_start, shift_end in collapse_to_ranges(q for q, _ in quarters):
+            session.add(WorkShift(master_id=master_id, start_time=shift_start, end_time=shift_end))
+        booked = (q for q, status in quarters if status == TimeSlotStatus.booked)
+        for booked_start, booked_end in collapse_to_ranges(booked):
+            session.add(BookedInterval(master_id=master_id, start_time=booked_start, end_time=booked_end))
+
+    for i in range(0, len(obsolete_ids), 500):
+        session.query(TimeSlot).filter(TimeSlot.id.in_(obsolete_ids[i:i + 500])).delete(synchronize_session=False)
+    return len(obsolete_ids)
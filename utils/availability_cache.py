@@ -0,0 +1,271 @@
+import heapq
+import time
+from datetime import datetime, timedelta
+from itertools import groupby, islice
+from operator import itemgetter
+
+from sqlalchemy import func, event, delete, or_, select
+
+from database import AvailabilityChange, master_service_association
+from utils.availability import get_free_slots, FreeSlot, SLOT_MINUTES
+
+QUARTERS_PER_DAY = 24 * 60 // SLOT_MINUTES  # 96 четвертей часа в сутках
+# Как часто (в секундах) процесс читает журнал изменений, сделанных другими процессами
+SYNC_INTERVAL = 5
+# Сколько хранить записи журнала: с большим запасом больше SYNC_INTERVAL. Процесс, который
+# не читал журнал дольше, замечает пропуск в номерах и сбрасывает весь кэш
+CHANGES_RETENTION = timedelta(hours=1)
+
+
+def run_starts(bitmap, length):
+    """Биты, с которых начинается length подряд идущих единиц в bitmap."""
+    result = bitmap
+    covered = 1
+    while covered < length and result:
+        step = min(covered, length - covered)
+        result &= result >> step
+        covered += step
+    return result
+
+
+def bits_after(date, moment):
+    """Маска четвертей часа даты date, которые начинаются строго позже moment."""
+    day_start = datetime.combine(date, datetime.min.time())
+    if moment < day_start:
+        return (1 << QUARTERS_PER_DAY) - 1
+    first_quarter = (moment - day_start) // timedelta(minutes=SLOT_MINUTES) + 1
+    if first_quarter >= QUARTERS_PER_DAY:
+        return 0
+    return ((1 << QUARTERS_PER_DAY) - 1) >> first_quarter << first_quarter
+
+
+def free_bitmaps(slots):
+    """Маски свободных четвертей часа по парам (мастер, дата) для свободных слотов slots."""
+    bitmaps = {}
+    for slot in slots:
+        key = (slot.master_id, slot.start_time.date())
+        quarter = (slot.start_time.hour * 60 + slot.start_time.minute) // SLOT_MINUTES
+        bitmaps[key] = bitmaps.get(key, 0) | 1 << quarter
+    return bitmaps
+
+
+def iter_bits(bitmap):
+    while bitmap:
+        lowest = bitmap & -bitmap
+        yield lowest.bit_length() - 1
+        bitmap ^= lowest
+
+
+class AvailabilityCache:
+    """
+    Занятость мастеров в памяти процесса: для каждой пары (мастер, дата) — 96-битная маска,
+    где единица означает свободную четверть часа. Маски строятся лениво и сбрасываются,
+    когда запись, отмена или правка расписания затрагивают мастера и дату.
+    """
+
+    def __init__(self, sync_interval=SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self._bitmaps = {}
+        self._service_masters = {}
+        self._last_change_id = None
+        self._last_sync = 0.0
+        self._today = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def sync(self, session):
+        """Применяет изменения из журнала availability_changes, сделанные другими процессами."""
+        now = time.monotonic()
+        if self._last_change_id is not None and now - self._last_sync < self.sync_interval:
+            return
+        self._last_sync = now
+
+        today = datetime.now().date()
+        if today != self._today:
+            # На прошедшие даты записаться нельзя — их маски больше не понадобятся
+            self._today = today
+            for key in [key for key in self._bitmaps if key[1] < today]:
+                del self._bitmaps[key]
+
+        if self._last_change_id is None:
+            self._last_change_id = session.query(func.max(AvailabilityChange.id)).scalar() or 0
+            return
+
+        changes = session.query(AvailabilityChange.id, AvailabilityChange.master_id, AvailabilityChange.date).filter(
+            AvailabilityChange.id > self._last_change_id
+        ).order_by(AvailabilityChange.id).all()
+        if changes and changes[0][0] > self._last_change_id + 1:
+            # Часть непрочитанных изменений уже удалена из журнала — какие маски устарели, не узнать
+            self.invalidations += 1
+            self.clear()
+        for change_id, master_id, date in changes:
+            if date is None:
+                self.invalidate_master(master_id)
+            else:
+                self.invalidate(master_id, date)
+            self._last_change_id = change_id
+
+    def get_service_masters(self, session, service_id):
+        self.sync(session)
+        if service_id in self._service_masters:
+            self.hits += 1
+            return self._service_masters[service_id]
+        self.misses += 1
+        master_ids = sorted(
+            master_id for (master_id,) in session.query(master_service_association.c.master_id).filter(
+                master_service_association.c.service_id == service_id
+            )
+        )
+        self._service_masters[service_id] = master_ids
+        return master_ids
+
+    def get_bitmaps(self, session, master_ids, dates):
+        """Маски для всех пар (мастер, дата); недостающие загружаются одним запросом."""
+        self.sync(session)
+        keys = [(master_id, date) for master_id in master_ids for date in dates]
+        missing = [key for key in keys if key not in self._bitmaps]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            # Если во время загрузки кто-то сбросил маски, загруженное могло устареть — не кэшируем его
+            epoch = self.invalidations
+            missing_masters = sorted({master_id for master_id, _ in missing})
+            missing_dates = sorted({date for _, date in missing})
+            start = datetime.combine(missing_dates[0], datetime.min.time())
+            end = datetime.combine(missing_dates[-1], datetime.min.time()) + timedelta(days=1)
+
+            loaded = dict.fromkeys(missing, 0)
+            for key, bitmap in free_bitmaps(get_free_slots(session, missing_masters, start, end)).items():
+                if key in loaded:
+                    loaded[key] = bitmap
+            if epoch == self.invalidations:
+                self._bitmaps.update(loaded)
+            return {key: self._bitmaps[key] if key in self._bitmaps else loaded[key] for key in keys}
+
+        return {key: self._bitmaps[key] for key in keys}
+
+    def invalidate(self, master_id, date):
+        self.invalidations += 1
+        self._bitmaps.pop((master_id, date), None)
+
+    def invalidate_master(self, master_id):
+        self.invalidations += 1
+        for key in [key for key in self._bitmaps if key[0] == master_id]:
+            del self._bitmaps[key]
+        # Мастера могли добавить к услуге или убрать из неё
+        self._service_masters.clear()
+
+    def clear(self):
+        self._bitmaps.clear()
+        self._service_masters.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "entries": len(self._bitmaps),
+        }
+
+
+availability_cache = AvailabilityCache()
+
+
+def record_change(session, master_id, date=None):
+    """
+    Сбрасывает маску в текущем процессе и пишет изменение в журнал для остальных процессов.
+    Вызывается в той же транзакции, что и изменение расписания.
+    """
+    session.add(AvailabilityChange(master_id=master_id, date=date))
+
+    def invalidate(*_):
+        if date is None:
+            availability_cache.invalidate_master(master_id)
+        else:
+            availability_cache.invalidate(master_id, date)
+
+    # Сбрасываем сразу и ещё раз после коммита: маску могли перечитать, пока транзакция не завершилась
+    invalidate()
+    event.listen(getattr(session, "sync_session", session), "after_commit", invalidate, once=True)
+
+
+def prune_changes(session, now=None, retention=CHANGES_RETENTION):
+    """
+    Удаляет из журнала изменения старше retention. Последнюю запись оставляем всегда:
+    иначе номера в пустой таблице начнутся заново и процессы не увидят новых изменений.
+    """
+    cutoff = (now or datetime.utcnow()) - retention
+    result = session.execute(delete(AvailabilityChange).where(
+        AvailabilityChange.id < select(func.max(AvailabilityChange.id)).scalar_subquery(),
+        or_(AvailabilityChange.created_at.is_(None), AvailabilityChange.created_at < cutoff)
+    ))
+    return result.rowcount
+
+
+def find_day_slots(cache, session, master_ids, date, service_duration, not_before):
+    """Возможные времена начала услуги на дату по маскам — список FreeSlot по (master_id, start_time)."""
+    bitmaps = cache.get_bitmaps(session, master_ids, [date])
+    required_slots = service_duration // SLOT_MINUTES
+    mask = bits_after(date, not_before)
+    day_start = datetime.combine(date, datetime.min.time())
+    return [
+        FreeSlot(master_id, day_start + timedelta(minutes=quarter * SLOT_MINUTES))
+        for master_id in master_ids
+        for quarter in iter_bits(run_starts(bitmaps[(master_id, date)] & mask, required_slots))
+    ]
+
+
+def _master_starts(master_id, starts):
+    # (четверть, мастер) по возрастанию времени
+    for quarter in iter_bits(starts):
+        yield quarter, master_id
+
+
+def find_day_slots_page(cache, session, master_ids, date, service_duration, not_before, after=None, limit=8,
+                        distinct_times=False):
+    """
+    Одна страница времён начала на дату в порядке (start_time, master_id), строго после after.
+    Времена мастеров сливаются кучей и перебираются только до конца страницы.
+    distinct_times — каждое время один раз, без мастера (master_id=None): мастер назначается при записи.
+    Возвращает (список FreeSlot, есть ли что-то дальше).
+    """
+    bitmaps = cache.get_bitmaps(session, master_ids, [date])
+    required_slots = service_duration // SLOT_MINUTES
+    mask = bits_after(date, not_before)
+    day_start = datetime.combine(date, datetime.min.time())
+    after_key = None
+    if after is not None:
+        after_time, after_master = after
+        after_key = ((after_time - day_start) // timedelta(minutes=SLOT_MINUTES), after_master)
+        # Четверти раньше курсора отбрасываем маской, а не перебором; курсор без мастера
+        # означает, что время курсора уже показано целиком
+        first_quarter = after_key[0] + 1 if after_master is None else after_key[0]
+        mask &= ~((1 << first_quarter) - 1)
+    merged = heapq.merge(*(
+        _master_starts(master_id, run_starts(bitmaps[(master_id, date)] & mask, required_slots))
+        for master_id in master_ids
+    ))
+    if after_key is not None and after_key[1] is not None:
+        merged = (item for item in merged if item > after_key)
+    if distinct_times:
+        merged = ((quarter, None) for quarter, _ in groupby(merged, key=itemgetter(0)))
+    page = list(islice(merged, limit + 1))
+    return [
+        FreeSlot(master_id, day_start + timedelta(minutes=quarter * SLOT_MINUTES))
+        for quarter, master_id in page[:limit]
+    ], len(page) > limit
+
+
+def find_dates_with_slots(cache, session, master_ids, dates, service_duration, not_before):
+    """Даты, на которые хотя бы у одного мастера есть окно нужной длины."""
+    bitmaps = cache.get_bitmaps(session, master_ids, dates)
+    required_slots = service_duration // SLOT_MINUTES
+    return [
+        date for date in dates
+        if any(run_starts(bitmaps[(master_id, date)] & bits_after(date, not_before), required_slots)
+               for master_id in master_ids)
+    ]
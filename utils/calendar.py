@@ -1,14 +1,23 @@
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from database import SessionLocal, TimeSlot, TimeSlotStatus, master_service_association
-from sqlalchemy.orm import joinedload
+from database import AsyncSessionLocal
+from utils import slot_finder
+from utils.callbacks import DATE, CHANGE_WEEK, NEAREST_SLOT
+from utils.availability import candidate_masters, find_nearest_start
+from utils.availability_cache import availability_cache, find_day_slots_page, find_dates_with_slots
 from datetime import datetime, timedelta
 from aiogram.fsm.context import FSMContext
 
+# Сколько времён показывать на одной странице выбора времени
+SLOT_PAGE_SIZE = 8
+# Запись открыта на текущую неделю и ещё столько недель вперёд
+MAX_WEEKS = 3
+
+
 async def show_calendar(message: Message, state: FSMContext, week_offset: int):
     # Определяем текущий понедельник
     today = datetime.now().date()
     current_week_start = today - timedelta(days=today.weekday())  # Понедельник текущей недели
-    max_weeks = 3  # Максимальное количество дополнительных недель (текущая неделя + 3 = 4 недели)
+    max_weeks = MAX_WEEKS  # Максимальное количество дополнительных недель (текущая неделя + 3 = 4 недели)
     week_offset = max(0, min(week_offset, max_weeks))  # Ограничиваем week_offset
 
     # Начало недели для отображения
@@ -25,38 +34,10 @@ async def show_calendar(message: Message, state: FSMContext, week_offset: int):
         await message.edit_text("Ошибка: данные услуги или длительности отсутствуют. Пожалуйста, начните заново.")
         return
 
-    dates_with_slots = []
-    with SessionLocal() as session:
-        # Получаем мастеров, предоставляющих выбранную услугу
-        if master_id is None:
-            masters = session.query(master_service_association).filter(
-                master_service_association.c.service_id == service_id
-            ).all()
-            master_ids = [master.master_id for master in masters]
-        else:
-            master_ids = [master_id]
-
-        for i in range(7):  # Проходим по дням недели
-            date = week_start + timedelta(days=i)
-            if date < today:
-                continue
-            start_datetime = datetime.combine(date, datetime.min.time())
-            end_datetime = start_datetime + timedelta(days=1)
-
-            # Получаем все свободные слоты мастеров, предоставляющих выбранную услугу
-            all_slots = session.query(TimeSlot).options(
-                joinedload(TimeSlot.master)
-            ).filter(
-                TimeSlot.master_id.in_(master_ids),
-                TimeSlot.start_time >= start_datetime,
-                TimeSlot.start_time < end_datetime,
-                TimeSlot.status == TimeSlotStatus.free
-            ).order_by(TimeSlot.master_id, TimeSlot.start_time).all()
-
-            available_slots = find_available_slots(all_slots, service_duration)
-
-            if available_slots:
-                dates_with_slots.append(date)
+    async with AsyncSessionLocal() as session:
+        dates_with_slots = await session.run_sync(
+            get_week_availability, service_id, master_id, max(week_start, today), week_end, service_duration
+        )
 
     if not dates_with_slots:
         week_start_str = week_start.strftime("%d.%m")
@@ -67,16 +48,19 @@ async def show_calendar(message: Message, state: FSMContext, week_offset: int):
 
     # Формируем кнопки для дат
     date_buttons = [
-        [InlineKeyboardButton(text=date.strftime("%d %b %Y"), callback_data=f"date_{date.isoformat()}_{week_offset}")]
+        [InlineKeyboardButton(text=date.strftime("%d %b %Y"), callback_data=DATE.pack(day=date, week_offset=week_offset))]
         for date in dates_with_slots
     ]
 
+    # Вместо листания недель можно сразу перейти к первому свободному времени
+    date_buttons.insert(0, [InlineKeyboardButton(text="🔎 Ближайшее свободное время", callback_data=NEAREST_SLOT.pack())])
+
     # Кнопки навигации по неделям
     navigation_buttons = []
     if week_offset > 0:
-        navigation_buttons.append(InlineKeyboardButton(text="⬅️ Пред. неделя", callback_data=f"change_week_{week_offset - 1}"))
+        navigation_buttons.append(InlineKeyboardButton(text="⬅️ Пред. неделя", callback_data=CHANGE_WEEK.pack(week_offset=week_offset - 1)))
     if week_offset < max_weeks:
-        navigation_buttons.append(InlineKeyboardButton(text="След. неделя ➡️", callback_data=f"change_week_{week_offset + 1}"))
+        navigation_buttons.append(InlineKeyboardButton(text="След. неделя ➡️", callback_data=CHANGE_WEEK.pack(week_offset=week_offset + 1)))
 
     # Кнопка "Назад"
     back_callback = "select_master" if master_id is not None else f"service_{service_id}"
@@ -99,29 +83,49 @@ async def show_calendar(message: Message, state: FSMContext, week_offset: int):
             raise
 
 
-def find_available_slots(slots, service_duration):
-    required_slots = service_duration // 15
-    available_slots = []
-    i = 0
-    while i < len(slots):
-        master_id = slots[i].master_id
-        start_index = i
-        end_index = i + required_slots
-        consecutive_slots = slots[start_index:end_index]
-
-        if len(consecutive_slots) < required_slots:
-            i += 1
-            continue
-
-        is_consecutive = True
-        for j in range(required_slots - 1):
-            if (consecutive_slots[j + 1].start_time != consecutive_slots[j].start_time + timedelta(minutes=15) or
-                    consecutive_slots[j + 1].status != TimeSlotStatus.free):
-                is_consecutive = False
-                break
-
-        if is_consecutive:
-            if consecutive_slots[0].start_time > (datetime.utcnow() + timedelta(hours=2, minutes=45)):
-                available_slots.append(consecutive_slots[0])
-        i += 1
-    return available_slots
+def get_candidate_master_ids(session, service_id, master_id):
+    if master_id is not None:
+        return [master_id]
+    return availability_cache.get_service_masters(session, service_id)
+
+
+def get_week_availability(session, service_id, master_id, first_date, last_date, service_duration):
+    """
+    Даты из [first_date, last_date], на которые есть подходящее окно у выбранного мастера
+    (или у любого мастера услуги). Ответ строится по маскам занятости из кэша:
+    при прогретом кэше экран календаря не делает запросов к базе.
+    """
+    if first_date > last_date:
+        return []
+    dates = [first_date + timedelta(days=i) for i in range((last_date - first_date).days + 1)]
+    master_ids = get_candidate_master_ids(session, service_id, master_id)
+    return find_dates_with_slots(
+        availability_cache, session, master_ids, dates, service_duration, slot_finder.earliest_start()
+    )
+
+
+def get_day_slots_page(session, service_id, master_id, date, service_duration, after=None, limit=SLOT_PAGE_SIZE):
+    """
+    Страница времён начала на дату после курсора after = (start_time, master_id).
+    Если мастер не выбран, одинаковые времена разных мастеров показываются один раз.
+    """
+    master_ids = get_candidate_master_ids(session, service_id, master_id)
+    return find_day_slots_page(
+        availability_cache, session, master_ids, date, service_duration, slot_finder.earliest_start(), after, limit,
+        distinct_times=master_id is None
+    )
+
+
+def booking_horizon(today=None):
+    """Момент, до которого открыта запись: конец последней доступной недели."""
+    today = today or datetime.now().date()
+    week_start = today - timedelta(days=today.weekday())
+    return datetime.combine(week_start + timedelta(weeks=MAX_WEEKS + 1), datetime.min.time())
+
+
+def get_nearest_slot(session, service_id, master_id, service_duration):
+    """Ближайшее время, на которое можно записаться к выбранному мастеру или к любому мастеру услуги."""
+    return find_nearest_start(
+        session, candidate_masters(service_id, master_id), service_duration,
+        slot_finder.earliest_start(), booking_horizon()
+    )
@@ -0,0 +1,158 @@
+import logging
+from collections import namedtuple
+from datetime import date, datetime
+
+from aiogram import Router
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import CallableObject
+
+# Время в callback_data без разделителей: callback_data ограничена 64 байтами
+CALLBACK_TIME_FORMAT = "%Y%m%d%H%M"
+
+# Как значения полей записываются в callback_data и читаются обратно
+_CODECS = {
+    int: (str, int),
+    str: (str, str),
+    date: (date.isoformat, date.fromisoformat),
+    datetime: (lambda value: value.strftime(CALLBACK_TIME_FORMAT),
+               lambda text: datetime.strptime(text, CALLBACK_TIME_FORMAT)),
+}
+
+
+class Callback:
+    """
+    Вид callback_data кнопки: имя и типизированные поля через "_".
+    Callback("services") — кнопка без данных, callback_data "services";
+    Callback("service", service_id=int) — callback_data вида "service_3".
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.key = f"{name}_" if fields else name
+        self.payload_type = namedtuple(f"{name.title().replace('_', '')}Payload", list(fields))
+
+    @property
+    def is_prefix(self):
+        return bool(self.fields)
+
+    def pack(self, **values):
+        if not self.fields:
+            return self.name
+        return self.key + "_".join(_CODECS[kind][0](values[field]) for field, kind in self.fields.items())
+
+    def unpack(self, data):
+        """Разбирает callback_data; ValueError, если она не подходит под этот вид."""
+        if not self.fields:
+            if data != self.name:
+                raise ValueError(f"Ожидалась callback_data {self.name!r}, получена {data!r}")
+            return self.payload_type()
+        if not data.startswith(self.key):
+            raise ValueError(f"callback_data {data!r} не начинается с {self.key!r}")
+        # В значениях полей нет "_" (у отрицательных чисел только "-"), поэтому делим по "_"
+        parts = data[len(self.key):].split("_", len(self.fields) - 1)
+        if len(parts) != len(self.fields):
+            raise ValueError(f"В callback_data {data!r} не хватает полей {list(self.fields)}")
+        return self.payload_type(*(_CODECS[kind][1](part) for part, kind in zip(parts, self.fields.values())))
+
+    def __repr__(self):
+        return f"<Callback({self.key!r})>"
+
+
+class _Node:
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children = {}
+        self.route = None
+
+
+class CallbackRoutes:
+    """
+    Маршрутизация нажатий на кнопки по префиксному дереву callback_data.
+    Обработчик находится за один проход по символам callback_data, независимо от числа маршрутов,
+    а данные кнопки разбираются один раз и передаются обработчику аргументом payload.
+    Маршрут, который совпадает с уже зарегистрированным или перекрывает его, — ошибка при импорте.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self.routes = {}
+        self.router = Router(name="callbacks")
+        self.router.callback_query.register(self._dispatch)
+
+    def route(self, callback):
+        def decorator(handler):
+            self.add(callback, handler)
+            return handler
+        return decorator
+
+    def add(self, callback, handler):
+        node = self._root
+        for char in callback.key:
+            # Префиксный маршрут по пути: он перехватил бы и новый маршрут
+            if node.route is not None and node.route[0].is_prefix:
+                raise ValueError(f"{callback} перекрывается маршрутом {node.route[0]} ({node.route[1].callback.__qualname__})")
+            node = node.children.setdefault(char, _Node())
+        if node.route is not None:
+            raise ValueError(f"{callback} уже обрабатывает {node.route[1].callback.__qualname__}")
+        if callback.is_prefix and node.children:
+            raise ValueError(f"{callback} перекрывает уже зарегистрированные маршруты")
+        node.route = (callback, CallableObject(handler))
+        self.routes[callback.key] = handler
+
+    def resolve(self, data):
+        """(Callback, обработчик) для callback_data или None."""
+        node = self._root
+        for char in data:
+            if node.route is not None and node.route[0].is_prefix:
+                return node.route
+            node = node.children.get(char)
+            if node is None:
+                return None
+        # Совпадение целиком: кнопка без данных (или префикс без данных — его отвергнет unpack)
+        return node.route
+
+    async def _dispatch(self, callback_query, **data):
+        found = self.resolve(callback_query.data or "")
+        if found is None:
+            return UNHANDLED
+        callback, handler = found
+        try:
+            payload = callback.unpack(callback_query.data)
+        except ValueError as e:
+            logging.warning("Не удалось разобрать нажатие кнопки: %s", e)
+            return UNHANDLED
+        return await handler.call(callback_query, payload=payload, **data)
+
+
+callback_routes = CallbackRoutes()
+
+# Главное меню и общие кнопки
+START = Callback("start")
+BACK_TO_MENU = Callback("back_to_menu")
+PREVIOUS_STEP = Callback("previous_step")
+# Выбор услуги и мастера
+SERVICES = Callback("services")
+SERVICE = Callback("service", service_id=int)
+SELECT_MASTER = Callback("select_master")
+SELECT_TIME_NO_MASTER = Callback("select_time_no_master")
+MASTER = Callback("master", master_id=int)
+# Календарь и время
+CHANGE_WEEK = Callback("change_week", week_offset=int)
+DATE = Callback("date", day=date, week_offset=int)
+SLOT = Callback("slot", master_id=int, start_time=datetime)
+# Время без мастера: мастер назначается при подтверждении записи
+ANY_SLOT = Callback("any_slot", start_time=datetime)
+NEAREST_SLOT = Callback("nearest_slot")
+SLOTS_NEXT = Callback("slots_next")
+SLOTS_PREV = Callback("slots_prev")
+# Запись
+CONFIRM_BOOKING = Callback("confirm_booking")
+ADD_TO_CALENDAR = Callback("add_to_calendar")
+MY_BOOKINGS = Callback("my_bookings")
+CANCEL_BOOKING = Callback("cancel_booking", appointment_id=int)
+# Отзывы
+LEAVE_REVIEW = Callback("leave_review")
+REVIEW = Callback("review", appointment_id=int)
+RATE = Callback("rate", rating=int)
@@ -0,0 +1,143 @@
+import time
+from collections import namedtuple
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import select
+
+from database import Service, Master, master_service_association, AsyncSessionLocal
+from utils.data_version import CATALOG, MASTERS, get_data_version
+from utils.callbacks import SERVICE, MASTER
+
+# Как часто (в секундах) бот сверяет версию данных с базой
+CHECK_INTERVAL = 5
+
+ServiceInfo = namedtuple("ServiceInfo", ["id", "name", "cost", "duration"])
+CatalogSnapshot = namedtuple("CatalogSnapshot", ["version", "services", "keyboard"])
+MasterInfo = namedtuple("MasterInfo", ["id", "name", "rating"])
+# masters: service_id -> мастера услуги; buttons: service_id -> готовые строки кнопок выбора мастера
+MasterListsSnapshot = namedtuple("MasterListsSnapshot", ["version", "masters", "buttons"])
+
+
+def build_services_keyboard(services):
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=f"{service.name} - {service.cost} руб.",
+                                  callback_data=SERVICE.pack(service_id=service.id))]
+            for service in services
+        ] + [
+            [InlineKeyboardButton(text="Назад в меню", callback_data="back_to_menu")],
+        ]
+    )
+
+
+def load_snapshot(session):
+    version = get_data_version(session, CATALOG)
+    services = [
+        ServiceInfo(*row)
+        for row in session.execute(select(Service.id, Service.name, Service.cost, Service.duration).order_by(Service.id))
+    ]
+    return CatalogSnapshot(version, {service.id: service for service in services}, build_services_keyboard(services))
+
+
+def load_master_lists(session):
+    """Мастера всех услуг с рейтингами одним запросом по таблице связей."""
+    version = get_data_version(session, MASTERS)
+    rows = session.execute(
+        select(master_service_association.c.service_id, Master.id, Master.name,
+               Master.total_rating, Master.num_reviews)
+        .join(Master, Master.id == master_service_association.c.master_id)
+        .order_by(master_service_association.c.service_id, Master.id)
+    )
+    masters = {}
+    for service_id, master_id, name, total_rating, num_reviews in rows:
+        # Так же, как Master.rating
+        rating = total_rating / num_reviews if num_reviews > 0 else 0
+        masters.setdefault(service_id, []).append(MasterInfo(master_id, name, rating))
+    buttons = {
+        service_id: [
+            [InlineKeyboardButton(text=f"{master.name} (Рейтинг: {master.rating})",
+                                  callback_data=MASTER.pack(master_id=master.id))]
+            for master in service_masters
+        ]
+        for service_id, service_masters in masters.items()
+    }
+    return MasterListsSnapshot(version, masters, buttons)
+
+
+class VersionedSnapshot:
+    """
+    Снимок редко меняющихся данных в памяти бота.
+    Раз в check_interval секунд сверяет версию name в data_versions и перезагружает снимок
+    функцией loader, только если данные изменились; в остальное время обращений к базе нет.
+    """
+
+    def __init__(self, name, loader, session_maker=AsyncSessionLocal, check_interval=CHECK_INTERVAL):
+        self.name = name
+        self.loader = loader
+        self.session_maker = session_maker
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0.0
+        self.reloads = 0
+
+    async def current(self):
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._checked_at < self.check_interval:
+            return self._snapshot
+        self._checked_at = now
+        async with self.session_maker() as session:
+            if self._snapshot is None or await session.run_sync(get_data_version, self.name) != self._snapshot.version:
+                self._snapshot = await session.run_sync(self.loader)
+                self.reloads += 1
+        return self._snapshot
+
+    async def refresh(self):
+        # Данные могли измениться после снимка: сверяемся с базой, не дожидаясь интервала
+        self._checked_at = 0.0
+        return await self.current()
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def stats(self):
+        return {
+            "version": self._snapshot.version if self._snapshot else None,
+            "reloads": self.reloads,
+        }
+
+
+class ServiceCatalog(VersionedSnapshot):
+    """Каталог услуг вместе с готовой клавиатурой выбора услуги."""
+
+    def __init__(self, session_maker=AsyncSessionLocal, check_interval=CHECK_INTERVAL):
+        super().__init__(CATALOG, load_snapshot, session_maker, check_interval)
+
+    async def get(self, service_id):
+        service = (await self.current()).services.get(service_id)
+        if service is None:
+            # Кнопка могла прийти из более нового каталога, чем снимок
+            service = (await self.refresh()).services.get(service_id)
+        return service
+
+    def stats(self):
+        return {**super().stats(), "services": len(self._snapshot.services) if self._snapshot else 0}
+
+
+class MasterLists(VersionedSnapshot):
+    """Мастера каждой услуги с уже посчитанными рейтингами и кнопками выбора."""
+
+    def __init__(self, session_maker=AsyncSessionLocal, check_interval=CHECK_INTERVAL):
+        super().__init__(MASTERS, load_master_lists, session_maker, check_interval)
+
+    async def masters(self, service_id):
+        return (await self.current()).masters.get(service_id, [])
+
+    async def buttons(self, service_id):
+        return (await self.current()).buttons.get(service_id, [])
+
+    def stats(self):
+        return {**super().stats(), "services": len(self._snapshot.masters) if self._snapshot else 0}
+
+
+service_catalog = ServiceCatalog()
+master_lists = MasterLists()
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from database import Appointment, AppointmentStatus, TimeSlot, JobWatermark, AsyncSessionLocal
+from utils.availability_cache import prune_changes
+
+JOB_NAME = "complete_appointments"
+# Запись считается состоявшейся, когда с её начала прошло столько времени
+COMPLETION_DELAY = timedelta(hours=2)
+RUN_INTERVAL = 15 * 60
+
+
+def complete_past_appointments(session, now=None):
+    """
+    Переводит прошедшие записи из scheduled в completed одним UPDATE.
+    Обрабатываются только записи, начавшиеся после прошлого запуска (отметка в job_watermarks),
+    поэтому запрос идёт по индексу времени начала слотов, а не по всей таблице.
+    Возвращает количество обновлённых записей.
+    """
+    cutoff = (now or datetime.utcnow()) - COMPLETION_DELAY
+    watermark = session.get(JobWatermark, JOB_NAME)
+
+    started = select(TimeSlot.id).where(TimeSlot.start_time <= cutoff)
+    if watermark is not None:
+        started = started.where(TimeSlot.start_time > watermark.value)
+
+    result = session.execute(
+        update(Appointment).where(
+            Appointment.timeslot_id.in_(started),
+            Appointment.status == AppointmentStatus.scheduled
+        ).values(status=AppointmentStatus.completed),
+        execution_options={"synchronize_session": False}
+    )
+
+    if watermark is None:
+        session.add(JobWatermark(name=JOB_NAME, value=cutoff))
+    else:
+        watermark.value = cutoff
+    return result.rowcount
+
+
+async def completion_worker(interval=RUN_INTERVAL):
+    """Фоновая задача бота клиентов: периодически закрывает прошедшие записи и чистит журнал изменений."""
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                completed = await session.run_sync(complete_past_appointments)
+                await session.run_sync(prune_changes)
+                await session.commit()
+            if completed:
+                logging.info("Отмечено состоявшимися записей: %s", completed)
+        except Exception:
+            logging.exception("Ошибка при закрытии прошедших записей")
+        await asyncio.sleep(interval)
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+from database import DataVersion
+
+# Каталог услуг: названия, цены, длительности
+CATALOG = "catalog"
+# Мастера услуг и их рейтинги
+MASTERS = "masters"
+
+
+def bump_data_version(session, name):
+    """Увеличивает версию данных name в текущей транзакции."""
+    now = datetime.utcnow()
+    statement = insert(DataVersion).values(name=name, version=1, updated_at=now)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=["name"], set_={"version": DataVersion.version + 1, "updated_at": now}
+    ))
+
+
+def get_data_version(session, name):
+    return session.execute(select(DataVersion.version).where(DataVersion.name == name)).scalar() or 0
+
+
+def get_data_versions(session, names):
+    """
+    Версии нескольких наборов данных одним запросом: (версии в порядке names, время последнего изменения).
+    Время — None, если ни один набор ещё не менялся.
+    """
+    rows = {
+        name: (version, updated_at)
+        for name, version, updated_at in session.execute(
+            select(DataVersion.name, DataVersion.version, DataVersion.updated_at).where(DataVersion.name.in_(names))
+        )
+    }
+    versions = tuple(rows.get(name, (0, None))[0] for name in names)
+    updated = [updated_at for _, updated_at in rows.values() if updated_at is not None]
+    return versions, max(updated, default=None)
@@ -0,0 +1,93 @@
+import itertools
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, EditMessageText, SendDocument, GetMe
+from aiogram.types import Chat, Message, User
+
+# Пользователь, от имени которого «Telegram» присылает обновления
+DEFAULT_USER = {"id": 7, "is_bot": False, "first_name": "Клиент", "username": "client"}
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    Сессия бота без обращений к Telegram: запросы запоминаются в requests,
+    а в ответ возвращаются правдоподобные объекты. Для локальных проверок и нагрузочных тестов:
+    Bot(token=..., session=FakeTelegramSession()).
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="Бот", username="fake_bot")
+        if isinstance(method, (SendMessage, EditMessageText, SendDocument)):
+            chat_id = method.chat_id if method.chat_id is not None else 0
+            return Message(
+                message_id=getattr(method, "message_id", None) or next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def sent(self, method_type=SendMessage):
+        """Запросы данного типа в порядке отправки."""
+        return [method for method in self.requests if isinstance(method, method_type)]
+
+
+class FakeTelegram:
+    """Источник обновлений: собирает их так, как их присылает Telegram, со сквозной нумерацией."""
+
+    def __init__(self, user=DEFAULT_USER):
+        self.user = user
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+
+    def _chat(self, user_id):
+        return {"id": user_id, "type": "private"}
+
+    def _user(self, user_id):
+        return {**self.user, "id": user_id}
+
+    def message(self, text, user_id=None):
+        user_id = user_id or self.user["id"]
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(datetime.now().timestamp()),
+                "chat": self._chat(user_id),
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }
+
+    def callback(self, data, user_id=None, message_id=None):
+        user_id = user_id or self.user["id"]
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "chat_instance": str(user_id),
+                "from": self._user(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id or next(self._message_ids),
+                    "date": int(datetime.now().timestamp()),
+                    "chat": self._chat(user_id),
+                    "from": {"id": 1, "is_bot": True, "first_name": "Бот"},
+                    "text": "-",
+                },
+            },
+        }
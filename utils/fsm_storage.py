@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert
+
+from database import FSMRecord, AsyncSessionLocal
+
+# Сценарий записи, к которому не возвращались сутки, считается брошенным
+FSM_TTL = timedelta(hours=24)
+# Изменения одного пользователя за это время собираются в одну запись в базу
+FLUSH_INTERVAL = 0.5
+CLEANUP_INTERVAL = 10 * 60
+
+
+def _encode(value):
+    # datetime и date хранятся короткими строками с пометкой типа
+    if isinstance(value, datetime):
+        exact_minute = not value.second and not value.microsecond
+        return {"$dt": value.isoformat(timespec="minutes" if exact_minute else "auto")}
+    if isinstance(value, date):
+        return {"$d": value.isoformat()}
+    raise TypeError(f"Не удаётся сохранить значение типа {type(value).__name__} в состоянии FSM")
+
+
+def _decode(value):
+    if len(value) == 1:
+        if "$dt" in value:
+            return datetime.fromisoformat(value["$dt"])
+        if "$d" in value:
+            return date.fromisoformat(value["$d"])
+    return value
+
+
+def dump_data(data):
+    return json.dumps(data, default=_encode, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_data(raw):
+    return json.loads(raw, object_hook=_decode) if raw else {}
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states.
+    Записи копятся в памяти и сбрасываются в базу одной пачкой раз в FLUSH_INTERVAL, поэтому
+    несколько шагов подряд (update_data, set_state) дают одну запись. Чтение сначала смотрит
+    в ещё не сброшенные изменения. Состояния старше ttl считаются брошенными и удаляются.
+    Отложенная запись годится только для одного процесса бота: другие процессы не видят
+    несброшенных изменений. При flush_interval=0 каждое изменение сразу пишется в базу.
+    """
+
+    def __init__(self, session_maker=AsyncSessionLocal, ttl=FSM_TTL,
+                 flush_interval=FLUSH_INTERVAL, cleanup_interval=CLEANUP_INTERVAL):
+        self.session_maker = session_maker
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._pending = {}
+        self._flushing = {}
+        self._flush_task = None
+        self._last_cleanup = time.monotonic()
+        self.writes = 0
+        self.flushes = 0
+
+    async def _mark(self, key, **fields):
+        self._pending.setdefault(self.key_builder.build(key), {}).update(fields)
+        self.writes += 1
+        if self.flush_interval <= 0:
+            # Сквозная запись: ошибка базы достаётся обработчику, а не теряется в фоне
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception:
+            logging.exception("Не удалось сохранить состояния FSM, повторим через %s с", self.flush_interval)
+            # Изменения вернулись в очередь — без повтора они ждали бы следующего изменения
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _unsaved(self, key):
+        # Изменения, которые ещё не попали в базу: сначала сбрасываемые сейчас, поверх — новые
+        return {**self._flushing.get(key, {}), **self._pending.get(key, {})}
+
+    async def _load(self, key):
+        async with self.session_maker() as session:
+            return (await session.execute(
+                select(FSMRecord.state, FSMRecord.data).where(
+                    FSMRecord.key == key,
+                    FSMRecord.updated_at >= datetime.utcnow() - self.ttl
+                )
+            )).first()
+
+    async def set_state(self, key, state=None):
+        await self._mark(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        unsaved = self._unsaved(self.key_builder.build(key))
+        if "state" in unsaved:
+            return unsaved["state"]
+        row = await self._load(self.key_builder.build(key))
+        return row.state if row else None
+
+    async def set_data(self, key, data):
+        await self._mark(key, data=dict(data))
+
+    async def get_data(self, key):
+        unsaved = self._unsaved(self.key_builder.build(key))
+        if "data" in unsaved:
+            return dict(unsaved["data"])
+        row = await self._load(self.key_builder.build(key))
+        return load_data(row.data) if row else {}
+
+    async def flush(self):
+        """Записывает накопленные изменения: по одному запросу на каждый вид изменения."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        self._flushing = pending
+        now = datetime.utcnow()
+
+        finished, by_fields = [], {}
+        for key, fields in pending.items():
+            # Завершённый сценарий (state.clear()) просто удаляем
+            if fields.get("state", "") is None and fields.get("data") == {}:
+                finished.append(key)
+                continue
+            row = {"key": key, "updated_at": now}
+            if "state" in fields:
+                row["state"] = fields["state"]
+            if "data" in fields:
+                row["data"] = dump_data(fields["data"])
+            by_fields.setdefault(tuple(sorted(fields)), []).append(row)
+
+        try:
+            await self._write(finished, by_fields, now)
+        except Exception:
+            # Не теряем изменения: вернём их в очередь, поверх них останутся более новые
+            for key, fields in pending.items():
+                self._pending[key] = {**fields, **self._pending.get(key, {})}
+            raise
+        finally:
+            self._flushing = {}
+        self.flushes += 1
+
+    async def _write(self, finished, by_fields, now):
+        async with self.session_maker() as session:
+            if finished:
+                await session.execute(delete(FSMRecord).where(FSMRecord.key.in_(finished)))
+            for fields, rows in by_fields.items():
+                statement = insert(FSMRecord)
+                updated = {name: statement.excluded[name] for name in fields + ("updated_at",)}
+                await session.execute(statement.on_conflict_do_update(index_elements=["key"], set_=updated), rows)
+            if time.monotonic() - self._last_cleanup >= self.cleanup_interval:
+                self._last_cleanup = time.monotonic()
+                await session.execute(delete(FSMRecord).where(FSMRecord.updated_at < now - self.ttl))
+            await session.commit()
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    Хранилище FSM в памяти процесса с ограничениями: не больше max_entries пользователей
+    (вытесняются давно не заходившие) и не дольше idle_ttl без обращений.
+    В отличие от MemoryStorage, память не растёт с каждым новым пользователем.
+    """
+
+    def __init__(self, max_entries=10000, idle_ttl=FSM_TTL):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl.total_seconds()
+        # key -> [state, data, время последнего обращения, размер data в байтах]; порядок — по обращениям
+        self._entries = OrderedDict()
+        self.approx_bytes = 0
+        self.evicted_lru = 0
+        self.evicted_idle = 0
+
+    def _expire(self, now):
+        # Самые старые обращения в начале, поэтому просматриваем только протухшие записи
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry[2] < self.idle_ttl:
+                break
+            self._drop(key)
+            self.evicted_idle += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.approx_bytes -= entry[3]
+
+    def _touch(self, key, create=False):
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get(key)
+        if entry is None:
+            if not create:
+                return None
+            entry = self._entries[key] = [None, {}, now, 0]
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evicted_lru += 1
+        entry[2] = now
+        self._entries.move_to_end(key)
+        return entry
+
+    def _forget_if_empty(self, key, entry):
+        # После state.clear() пользователь не занимает память
+        if entry[0] is None and not entry[1]:
+            self._drop(key)
+
+    async def set_state(self, key, state=None):
+        entry = self._touch(key, create=True)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._forget_if_empty(key, entry)
+
+    async def get_state(self, key):
+        entry = self._touch(key)
+        return entry[0] if entry else None
+
+    async def set_data(self, key, data):
+        entry = self._touch(key, create=True)
+        entry[1] = dict(data)
+        # Оценка по repr: в памяти могут оказаться и значения, которые не сериализуются в JSON
+        size = len(repr(entry[1]).encode())
+        self.approx_bytes += size - entry[3]
+        entry[3] = size
+        self._forget_if_empty(key, entry)
+
+    async def get_data(self, key):
+        entry = self._touch(key)
+        return dict(entry[1]) if entry else {}
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "approx_bytes": self.approx_bytes,
+            "evicted_lru": self.evicted_lru,
+            "evicted_idle": self.evicted_idle,
+        }
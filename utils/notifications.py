@@ -0,0 +1,33 @@
+from sqlalchemy import update
+
+from database import NotificationOutbox, NotificationKind, User
+
+
+def enqueue_notification(session, kind, master_id, user_telegram_id, slot_time, service_name):
+    """
+    Ставит уведомление мастеру в очередь. Вызывается в транзакции записи или отмены:
+    уведомление появится только вместе с ней, а отправит его бот мастеров.
+    """
+    session.add(NotificationOutbox(
+        kind=NotificationKind(kind),
+        master_id=master_id,
+        user_telegram_id=str(user_telegram_id),
+        slot_time=slot_time,
+        service_name=service_name
+    ))
+
+
+def client_display_name(telegram_user):
+    """Имя клиента для уведомлений мастеру — так же, как его показывает бот мастеров."""
+    return telegram_user.first_name or telegram_user.username or str(telegram_user.id)
+
+
+def remember_display_name(session, telegram_user):
+    """Обновляет сохранённое имя клиента, если он сменил его в Telegram; новых пользователей не создаёт."""
+    display_name = client_display_name(telegram_user)
+    session.execute(
+        update(User).where(
+            User.telegram_id == str(telegram_user.id),
+            User.display_name.is_distinct_from(display_name)
+        ).values(display_name=display_name)
+    )
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    SendMessage, SendDocument, EditMessageText, EditMessageReplyMarkup, DeleteMessage
+)
+
+from utils.ttl_cache import TTLCache
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и около одного в секунду в один чат
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+MAX_RETRIES = 3
+
+# Запросы, которые отправляют или меняют сообщения и попадают под ограничения
+RATE_LIMITED_METHODS = (SendMessage, SendDocument, EditMessageText, EditMessageReplyMarkup, DeleteMessage)
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+    reserve() сразу забирает токен (в долг, если их нет) и возвращает, сколько секунд нужно подождать,
+    поэтому ожидающие отправки выстраиваются в порядке обращения.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: пропускает исходящие сообщения через общую корзину токенов и корзину чата,
+    при 429 ждёт retry_after и повторяет запрос. Подключается через bot.session.middleware(...).
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_retries=MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        # Корзины неактивных чатов забываются: через минуту простоя корзина всё равно полная
+        self.chat_buckets = TTLCache(maxsize=10000, ttl=60)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.sent = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # Запись продлевается при каждой отправке в чат
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _wait_turn(self, chat_id):
+        if chat_id is not None:
+            await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+        await asyncio.sleep(self.global_bucket.reserve())
+        # После 429 Telegram ограничивает весь бот, поэтому ждут все отправки
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, RATE_LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        started = time.monotonic()
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_turn(chat_id)
+                try:
+                    response = await make_request(bot, method)
+                    break
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.retries += 1
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                    logging.warning("Telegram просит подождать %s с перед отправкой в чат %s", e.retry_after, chat_id)
+        finally:
+            self.queue_depth -= 1
+
+        latency = time.monotonic() - started
+        self.sent += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        return response
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "sent": self.sent,
+            "retries": self.retries,
+            "avg_latency": self.total_latency / self.sent if self.sent else 0.0,
+            "max_latency": self.max_latency,
+        }
@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from database import Appointment, AppointmentStatus, TimeSlot, Service, User, AsyncSessionLocal
+
+# За сколько до начала записи клиент получает напоминания
+REMINDER_OFFSETS = (timedelta(hours=24), timedelta(hours=2))
+# Даже без новых записей обработчик просыпается не реже раза в минуту
+MAX_SLEEP = 60
+# Записаться можно не дальше чем на 4 недели вперёд, загружаем с запасом
+LOAD_HORIZON = timedelta(days=35)
+
+Reminder = namedtuple("Reminder", ["appointment_id", "start_time", "service_name", "user_telegram_id", "offset"])
+
+
+def reminder_text(reminder):
+    when = "завтра" if reminder.offset >= timedelta(hours=24) else "сегодня"
+    return (
+        f"Напоминаем о записи {when}: {reminder.service_name}\n"
+        f"Время: {reminder.start_time.strftime('%d.%m %H:%M')}"
+    )
+
+
+class ReminderScheduler:
+    """
+    Напоминания о предстоящих записях в куче по времени отправки.
+    Записи добавляются и снимаются по мере бронирования и отмены; отменённые записи
+    удаляются из кучи лениво — их элементы пропускаются, когда доходит очередь.
+    """
+
+    def __init__(self, offsets=REMINDER_OFFSETS):
+        self.offsets = offsets
+        self._heap = []
+        self._appointments = {}
+        self.wakeup = asyncio.Event()
+
+    def load(self, session, now=None):
+        """Перестраивает кучу одним запросом по индексу времени начала записей."""
+        now = now or datetime.utcnow()
+        rows = session.execute(
+            select(Appointment.id, TimeSlot.start_time, Service.name, User.telegram_id)
+            .join(Appointment.timeslot).join(Appointment.service).join(Appointment.user)
+            .where(
+                TimeSlot.start_time > now + min(self.offsets),
+                TimeSlot.start_time <= now + LOAD_HORIZON,
+                Appointment.status == AppointmentStatus.scheduled
+            )
+        ).all()
+        self._heap = []
+        self._appointments = {}
+        for appointment_id, start_time, service_name, user_telegram_id in rows:
+            self._heap.extend(self._register(appointment_id, start_time, service_name, user_telegram_id, now))
+        heapq.heapify(self._heap)
+        return len(rows)
+
+    def _register(self, appointment_id, start_time, service_name, user_telegram_id, now):
+        # Элементы кучи для ещё не наступивших напоминаний о записи
+        self._appointments[appointment_id] = (start_time, service_name, user_telegram_id)
+        return [(start_time - offset, appointment_id, offset) for offset in self.offsets if start_time - offset > now]
+
+    def add(self, appointment_id, start_time, service_name, user_telegram_id, now=None):
+        now = now or datetime.utcnow()
+        for entry in self._register(appointment_id, start_time, service_name, user_telegram_id, now):
+            heapq.heappush(self._heap, entry)
+        self.wakeup.set()
+
+    def remove(self, appointment_id):
+        self._appointments.pop(appointment_id, None)
+
+    def pop_due(self, now=None):
+        """Напоминания, время которых наступило."""
+        now = now or datetime.utcnow()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, appointment_id, offset = heapq.heappop(self._heap)
+            appointment = self._appointments.get(appointment_id)
+            # Запись отменили или перенесли — элемент кучи устарел
+            if appointment is None or appointment[0] - offset != fire_at:
+                continue
+            start_time, service_name, user_telegram_id = appointment
+            due.append(Reminder(appointment_id, start_time, service_name, user_telegram_id, offset))
+        # Записи, по которым больше нечего отправлять, не держим в памяти
+        for reminder in due:
+            if reminder.offset == min(self.offsets):
+                self._appointments.pop(reminder.appointment_id, None)
+        return due
+
+    def seconds_until_next(self, now=None, max_sleep=MAX_SLEEP):
+        now = now or datetime.utcnow()
+        if not self._heap:
+            return max_sleep
+        return max(0.0, min(max_sleep, (self._heap[0][0] - now).total_seconds()))
+
+    def __len__(self):
+        return len(self._heap)
+
+
+reminder_scheduler = ReminderScheduler()
+
+
+async def reminder_worker(bot, scheduler=reminder_scheduler, max_sleep=MAX_SLEEP, reload_interval=None):
+    """
+    Фоновая задача бота клиентов: спит до ближайшего напоминания и отправляет его.
+    reload_interval — раз во сколько секунд перечитывать очередь из базы; нужен, когда записи
+    принимают несколько экземпляров бота и часть из них не попадает в кучу этого процесса.
+    """
+    reloaded_at = time.monotonic()
+    while True:
+        for reminder in scheduler.pop_due():
+            try:
+                await bot.send_message(chat_id=reminder.user_telegram_id, text=reminder_text(reminder))
+            except Exception as e:
+                logging.warning("Не удалось отправить напоминание о записи %s: %s", reminder.appointment_id, e)
+        # Перечитываем только после отправки: load пропускает уже наступившие напоминания,
+        # и всё, что подошло за время сна, иначе потерялось бы
+        if reload_interval is not None and time.monotonic() - reloaded_at >= reload_interval:
+            reloaded_at = time.monotonic()
+            try:
+                async with AsyncSessionLocal() as session:
+                    await session.run_sync(scheduler.load)
+            except Exception:
+                logging.exception("Не удалось перечитать напоминания")
+        scheduler.wakeup.clear()
+        try:
+            await asyncio.wait_for(scheduler.wakeup.wait(), scheduler.seconds_until_next(
+                max_sleep=max_sleep if reload_interval is None else min(max_sleep, reload_interval)
+            ))
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,8 @@
+from datetime import datetime, timedelta
+
+# Клиент не может записаться раньше, чем через 2 часа 45 минут
+LEAD_TIME = timedelta(hours=2, minutes=45)
+
+
+def earliest_start():
+    return datetime.utcnow() + LEAD_TIME
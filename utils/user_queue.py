@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import time
+
+from aiogram import BaseMiddleware
+
+# Сколько обновлений одного пользователя может ждать своей очереди; остальные отбрасываются
+MAX_PENDING_PER_USER = 3
+# Ответ на отброшенное нажатие кнопки, чтобы у пользователя не крутились часики
+DROPPED_CALLBACK_TEXT = "Подождите, предыдущее действие ещё выполняется."
+
+
+class _UserQueue:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        # asyncio.Lock пропускает ожидающих в порядке прихода
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class PerUserSerializer(BaseMiddleware):
+    """
+    Внешний middleware обновлений: обновления одного пользователя обрабатываются строго по очереди,
+    разных пользователей — одновременно. Так быстрые нажатия не перетирают друг другу
+    state.update_data, а пропускная способность растёт с числом пользователей.
+    Подключается через dp.update.outer_middleware(...).
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_PER_USER):
+        self.max_pending = max_pending
+        self._users = {}
+        self.processed = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        queue = self._users.get(user.id)
+        if queue is None:
+            queue = self._users[user.id] = _UserQueue()
+        if queue.pending >= self.max_pending:
+            self.dropped += 1
+            logging.warning("Пользователь %s присылает обновления быстрее, чем они обрабатываются; "
+                            "обновление %s пропущено", user.id, event.update_id)
+            if event.callback_query is not None:
+                try:
+                    await event.callback_query.answer(DROPPED_CALLBACK_TEXT)
+                except Exception as e:
+                    logging.warning("Не удалось ответить на пропущенное нажатие %s: %s", event.update_id, e)
+            return None
+
+        queue.pending += 1
+        queued_at = time.monotonic()
+        try:
+            async with queue.lock:
+                wait = time.monotonic() - queued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.processed += 1
+                return await handler(event, data)
+        finally:
+            queue.pending -= 1
+            # Очереди пользователей, у которых ничего не ждёт, не держим в памяти
+            if queue.pending == 0:
+                del self._users[user.id]
+
+    def stats(self):
+        return {
+            "active_users": len(self._users),
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "avg_queue_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_queue_wait": self.max_wait,
+        }
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+# Сколько обновлений один процесс обрабатывает одновременно
+WEBHOOK_WORKERS = 8
+# Сколько принятых, но ещё не обработанных обновлений может ждать в очереди.
+# Когда очередь полна, ответ Telegram задерживается, и он сам сбавляет темп
+QUEUE_SIZE = 1000
+# Сколько секунд при остановке даётся на обработку уже принятых обновлений
+SHUTDOWN_TIMEOUT = 10
+
+
+class WorkerPoolRequestHandler(SimpleRequestHandler):
+    """
+    Приём обновлений от Telegram через вебхук.
+    Обновление сразу кладётся в очередь и Telegram получает ответ, а обрабатывают очередь
+    workers задач; в отличие от SimpleRequestHandler число одновременно работающих хендлеров
+    ограничено и не растёт вместе с наплывом обновлений.
+    """
+
+    def __init__(self, dispatcher, bot, workers=WEBHOOK_WORKERS, queue_size=QUEUE_SIZE,
+                 secret_token=None, **data):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._worker_tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.total_queue_wait = 0.0
+
+    async def start(self, *args, **kwargs):
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _handle_request_background(self, bot, request):
+        update = await request.json(loads=bot.session.json_loads)
+        await self._queue.put((time.monotonic(), update))
+        self.received += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _worker(self):
+        while True:
+            queued_at, update = await self._queue.get()
+            self.total_queue_wait += time.monotonic() - queued_at
+            try:
+                await self._background_feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logging.exception("Ошибка при обработке обновления %s", update.get("update_id"))
+            finally:
+                self._queue.task_done()
+
+    async def close(self):
+        try:
+            await asyncio.wait_for(self._queue.join(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("Не обработано обновлений при остановке: %s", self._queue.qsize())
+        for task in self._worker_tasks:
+            task.cancel()
+        await super().close()
+
+    def stats(self):
+        handled = self.processed + self.failed
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "avg_queue_wait": self.total_queue_wait / handled if handled else 0.0,
+        }
+
+
+WEBHOOK_HANDLER = web.AppKey("webhook_handler", WorkerPoolRequestHandler)
+
+
+def build_webhook_app(dispatcher, bot, path, workers=WEBHOOK_WORKERS, secret_token=None, **data):
+    """Приложение aiohttp, которое принимает обновления бота по адресу path."""
+    app = web.Application()
+    handler = WorkerPoolRequestHandler(dispatcher, bot, workers=workers, secret_token=secret_token, **data)
+    handler.register(app, path=path)
+    app.on_startup.append(handler.start)
+    setup_application(app, dispatcher, bot=bot)
+    app[WEBHOOK_HANDLER] = handler
+    return app